@@ -223,6 +223,17 @@ class Port(object):
             device_owner=d['device_owner'],
             name=d['name'])
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'fixed_ips': [fip.to_dict() for fip in self.fixed_ips],
+            'mac_address': self.mac_address,
+            'network_id': self.network_id,
+            'device_owner': self.device_owner,
+            'name': self.name,
+        }
+
 
 class FixedIp(object):
     def __init__(self, subnet_id, ip_address):
@@ -236,6 +247,10 @@ class FixedIp(object):
     def from_dict(cls, d):
         return cls(d['subnet_id'], d['ip_address'])
 
+    def to_dict(self):
+        return {'subnet_id': self.subnet_id,
+                'ip_address': str(self.ip_address)}
+
 
 class FloatingIP(object):
     def __init__(self, id_, floating_ip, fixed_ip):
@@ -22,7 +22,9 @@ from novaclient import exceptions as novaclient_exceptions
 from oslo_config import cfg
 from oslo_log import log as logging
 
+from akanda.rug.api import neutron
 from akanda.rug.common.i18n import _LW
+from akanda.rug.openstack.common import timeutils
 
 LOG = logging.getLogger(__name__)
 
@@ -75,6 +77,37 @@ class InstanceInfo(object):
             if self.last_boot:
                 self.boot_duration = (datetime.utcnow() - self.last_boot)
 
+    def to_dict(self):
+        return {
+            'id': self.id_,
+            'name': self.name,
+            'image_uuid': self.image_uuid,
+            'booting': self.booting,
+            'last_boot': (timeutils.strtime(self.last_boot)
+                          if self.last_boot else None),
+            'management_port': (self.management_port.to_dict()
+                                if self.management_port else None),
+            'ports': [p.to_dict() for p in self.ports],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        mgt_port = d.get('management_port')
+        info = cls(
+            d['id'],
+            d['name'],
+            management_port=(neutron.Port.from_dict(mgt_port)
+                             if mgt_port else None),
+            ports=[neutron.Port.from_dict(p) for p in d.get('ports', [])],
+            image_uuid=d.get('image_uuid'),
+            booting=d.get('booting', False),
+        )
+        # Keep the original boot time, not the time this was loaded.
+        last_boot = d.get('last_boot')
+        info.last_boot = timeutils.parse_strtime(last_boot) \
+            if last_boot else None
+        return info
+
 
 class Nova(object):
     def __init__(self, conf):
@@ -0,0 +1,50 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Commands related to resources.
+"""
+import logging
+
+from akanda.rug import commands
+from akanda.rug.cli import message
+
+
+class ResourceTrace(message.MessageSending):
+    """log the recent state machine transitions of a resource"""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        p = super(ResourceTrace, self).get_parser(prog_name)
+        p.add_argument(
+            'resource_id',
+        )
+        return p
+
+    def make_message(self, parsed_args):
+        resource_id = parsed_args.resource_id.lower()
+        self.log.info(
+            'sending %s instruction for resource %r',
+            commands.RESOURCE_TRACE,
+            resource_id,
+        )
+        # No tenant is given, so every worker gets the message and the
+        # one managing the resource logs its transitions.
+        return {
+            'command': commands.RESOURCE_TRACE,
+            'resource_id': resource_id,
+        }
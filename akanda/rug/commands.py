@@ -41,6 +41,14 @@ ROUTER_MANAGE = 'router-manage'
 ROUTER_UPDATE = 'router-update'
 ROUTER_REBUILD = 'router-rebuild'
 
+# Log the recent state machine transitions of a resource
+RESOURCE_TRACE = 'resource-trace'
+
+# Sent at startup to hand a worker the resources saved in the snapshots
+# of earlier processes. Expects a 'resources' argument in the payload
+# with the saved records.
+RESOURCE_RESTORE = 'resource-restore'
+
 # Put a tenant in debug/manage mode
 # Expects a 'tenant_id' argument in the payload with the UUID of the tenant
 TENANT_DEBUG = 'tenant-debug'
@@ -53,3 +61,8 @@ CONFIG_RELOAD = 'config-reload'
 POLL = 'poll'
 
 GLOBAL_DEBUG = 'global-debug'
+
+# Sent by the scheduler to move a tenant to another worker process.
+# Expects a 'tenant_id' argument in the payload; the worker replies
+# with whether the tenant was released and the resources it had.
+TENANT_HANDOFF = 'tenant-handoff'
@@ -0,0 +1,129 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Consistent hash ring used to shard resources across owners.
+"""
+
+import bisect
+import hashlib
+import struct
+
+import six
+
+DEFAULT_REPLICAS = 64
+
+
+def _hash(key):
+    """Returns a stable 64-bit integer hash for key."""
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class HashRing(object):
+    """A consistent hash ring with virtual nodes.
+
+    Each node is placed on the ring ``replicas * weight`` times, so
+    adding or removing a node only moves the keys owned by that node
+    (roughly 1/N of them) instead of reshuffling everything.
+    Lookups are a binary search of the sorted ring.
+    """
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS, weights=None):
+        """
+        :param nodes: Initial node names.
+        :type nodes: iterable of str
+        :param replicas: Number of virtual nodes per unit of weight.
+        :type replicas: int
+        :param weights: Optional relative weight for each node name.
+                        Nodes not listed have a weight of 1.
+        :type weights: dict
+        :raises: ValueError if there are nodes but none of them has a
+                 weight of 1 or more, since nothing could be placed.
+        """
+        if replicas < 1:
+            raise ValueError('replicas must be at least 1')
+        self.replicas = replicas
+        self._weights = {}
+        self._ring_keys = []
+        self._ring_nodes = []
+        weights = weights or {}
+        for node in nodes:
+            self._weights[node] = int(weights.get(node, 1))
+        self._check_weights(self._weights)
+        self._rebuild()
+
+    @staticmethod
+    def _check_weights(weights):
+        if weights and max(weights.values()) < 1:
+            raise ValueError('at least one node needs a weight of 1 or more')
+
+    def _rebuild(self):
+        ring = []
+        for node, weight in self._weights.items():
+            if weight < 1:
+                continue
+            for i in xrange(self.replicas * weight):
+                ring.append((_hash('%s-%d' % (node, i)), node))
+        ring.sort()
+        self._ring_keys = [h for h, _ in ring]
+        self._ring_nodes = [n for _, n in ring]
+
+    @property
+    def nodes(self):
+        return sorted(self._weights)
+
+    def __len__(self):
+        return len(self._weights)
+
+    def __contains__(self, node):
+        return node in self._weights
+
+    def add_node(self, node, weight=1):
+        """Add a node to the ring, or change the weight of an existing one.
+
+        :raises: ValueError if no node would be left with a weight of 1
+                 or more. The ring is not changed.
+        """
+        weights = dict(self._weights)
+        weights[node] = int(weight)
+        self._check_weights(weights)
+        self._weights = weights
+        self._rebuild()
+
+    def remove_node(self, node):
+        """Remove a node from the ring.
+
+        :raises: KeyError if the node is not on the ring.
+        :raises: ValueError if the nodes left all have a weight of 0.
+                 The ring is not changed.
+        """
+        weights = dict(self._weights)
+        del weights[node]
+        self._check_weights(weights)
+        self._weights = weights
+        self._rebuild()
+
+    def get_node(self, key):
+        """Returns the node owning key, or None if the ring is empty.
+        """
+        if not self._ring_keys:
+            return None
+        idx = bisect.bisect(self._ring_keys, _hash(key))
+        if idx == len(self._ring_keys):
+            idx = 0
+        return self._ring_nodes[idx]
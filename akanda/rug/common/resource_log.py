@@ -0,0 +1,117 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Logging for the resources managed by the rug.
+"""
+
+import logging as std_logging
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+
+RESOURCE_LOG_OPTS = [
+    cfg.IntOpt(
+        'resource_log_burst',
+        default=5,
+        help='number of repetitive messages, such as long queue '
+             'warnings and failed alive checks, logged for a resource '
+             'before they are limited to one every '
+             'resource_log_interval seconds'),
+    cfg.IntOpt(
+        'resource_log_interval',
+        default=60,
+        help='seconds between the repetitive messages logged for a '
+             'resource once its burst is used up, 0 to log them all'),
+]
+cfg.CONF.register_opts(RESOURCE_LOG_OPTS)
+
+# The one logger every resource logs through. Named loggers are never
+# freed, so one per resource would grow with every resource ever seen.
+LOG = logging.getLogger('akanda.rug.resource')
+
+
+class ResourceLogAdapter(std_logging.LoggerAdapter):
+    """Logs for one resource, with its name in front of every message.
+
+    Messages that repeat for as long as something is wrong with a
+    resource can be logged with log_limited(). Each kind is limited by
+    a token bucket of its own, holding resource_log_burst tokens and
+    gaining one every resource_log_interval seconds, and the number of
+    messages left out is added to the next one logged.
+    """
+
+    def __init__(self, name, logger=None):
+        # oslo_log formats a resource passed this way as %(resource)s.
+        super(ResourceLogAdapter, self).__init__(
+            logger if logger is not None else LOG,
+            {'resource': {'name': name}})
+        self.name = name
+        # kind -> [tokens, when they were counted, messages left out],
+        # only for the kinds that were logged.
+        self._buckets = {}
+
+    def process(self, msg, kwargs):
+        # The resource is also passed to the handlers, together with
+        # anything the caller passed itself.
+        extra = kwargs.get('extra')
+        kwargs['extra'] = dict(self.extra, **extra) if extra else self.extra
+        return '%s: %s' % (self.name, msg), kwargs
+
+    def debug(self, msg, *args, **kwargs):
+        # LoggerAdapter calls process() before the level is checked,
+        # and most debug messages are not wanted.
+        if self.isEnabledFor(std_logging.DEBUG):
+            super(ResourceLogAdapter, self).debug(msg, *args, **kwargs)
+
+    def _take(self, kind):
+        """Take a token for a message of the given kind.
+
+        :returns: The number of messages left out since the last one
+                  logged, or None if this one should be left out too.
+        """
+        interval = cfg.CONF.resource_log_interval
+        if interval <= 0:
+            return 0
+        burst = max(cfg.CONF.resource_log_burst, 1)
+        now = time.time()
+        bucket = self._buckets.get(kind)
+        if bucket is None:
+            bucket = self._buckets[kind] = [burst, now, 0]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) / interval)
+            bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return None
+        bucket[0] -= 1
+        suppressed, bucket[2] = bucket[2], 0
+        return suppressed
+
+    def log_limited(self, level, kind, msg, *args, **kwargs):
+        """Log a message that may repeat, unless messages of the same
+        kind have been logged too often for this resource lately.
+        """
+        if not self.isEnabledFor(level):
+            return
+        suppressed = self._take(kind)
+        if suppressed is None:
+            return
+        if suppressed:
+            msg = '%s (%d similar messages suppressed)' % (msg, suppressed)
+        self.log(level, msg, *args, **kwargs)
@@ -23,6 +23,8 @@ import oslo_messaging
 
 from akanda.rug.common.i18n import _LW
 
+cfg.CONF.import_group('coordination', 'akanda.rug.coordination')
+
 LOG = logging.getLogger(__name__)
 
 
@@ -133,6 +135,10 @@ class Connection(object):
         target = get_target(topic=topic, fanout=False,
                             exchange=exchange)
         pool = 'akanda.' + topic
+        if cfg.CONF.coordination.enabled:
+            # Every node in a cluster needs to see every notification
+            # to pick out the ones for the tenants it owns.
+            pool += '.' + cfg.CONF.host
         server = oslo_messaging.get_notification_listener(
             transport, [target], endpoints, pool=pool)
         LOG.debug(
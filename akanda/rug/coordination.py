@@ -0,0 +1,295 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Cluster membership and tenant ownership for multiple rug nodes.
+
+Every node heartbeats into a shared membership backend and places the
+live members on a hash ring. A node only manages the tenants the ring
+assigns to it, and ownership moves automatically as nodes join or
+leave.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import importutils
+
+from akanda.rug.common import hash_ring
+from akanda.rug.common.i18n import _LE, _LI
+
+
+LOG = logging.getLogger(__name__)
+
+COORDINATION_OPTS = [
+    cfg.BoolOpt('enabled',
+                default=False,
+                help='share tenants with the other rug nodes using the '
+                     'same membership backend'),
+    cfg.StrOpt('backend',
+               default='file',
+               help='membership backend, either one of "file" or "sqlite" '
+                    'or the import path of a MembershipBackend subclass'),
+    cfg.StrOpt('path',
+               default='/var/lib/akanda-rug/members',
+               help='location of the membership data, which must be shared '
+                    'by every node in the cluster'),
+    cfg.IntOpt('heartbeat_interval',
+               default=5,
+               help='seconds between membership heartbeats'),
+    cfg.IntOpt('member_timeout',
+               default=30,
+               help='seconds without a heartbeat before a node is '
+                    'considered gone and its tenants are taken over'),
+    cfg.IntOpt('hash_replicas',
+               default=hash_ring.DEFAULT_REPLICAS,
+               help='number of virtual nodes per rug node on the hash ring'),
+]
+cfg.CONF.register_group(cfg.OptGroup(name='coordination',
+                                     title='Multi-node Coordination Options'))
+cfg.CONF.register_opts(COORDINATION_OPTS, group='coordination')
+
+
+class MembershipBackend(object):
+    """Base class for the shared record of live cluster members.
+    """
+
+    def __init__(self, path, timeout):
+        """
+        :param path: Location of the shared membership data.
+        :type path: str
+        :param timeout: Seconds after which a silent member is dropped.
+        :type timeout: int
+        """
+        self.path = path
+        self.timeout = timeout
+
+    def heartbeat(self, member_id):
+        """Record that the member is alive, joining it if needed.
+        """
+        raise NotImplementedError()
+
+    def leave(self, member_id):
+        """Remove the member immediately.
+        """
+        raise NotImplementedError()
+
+    def get_members(self):
+        """Returns the ids of the members that are alive.
+        """
+        raise NotImplementedError()
+
+
+class FileBackend(MembershipBackend):
+    """Keeps the members in a JSON file guarded by an advisory lock.
+    """
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, members):
+        # Write a new file and rename it so readers never see a
+        # partial update.
+        tmp = '%s.%s' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(members, f)
+        os.rename(tmp, self.path)
+
+    def heartbeat(self, member_id):
+        with self._locked():
+            members = self._read()
+            members[member_id] = time.time()
+            self._write(members)
+
+    def leave(self, member_id):
+        with self._locked():
+            members = self._read()
+            if members.pop(member_id, None) is not None:
+                self._write(members)
+
+    def get_members(self):
+        with self._locked():
+            members = self._read()
+        cutoff = time.time() - self.timeout
+        return sorted(m for m, seen in members.items() if seen >= cutoff)
+
+
+class SqliteBackend(MembershipBackend):
+    """Keeps the members in a sqlite database.
+    """
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute('CREATE TABLE IF NOT EXISTS members '
+                     '(member_id TEXT PRIMARY KEY, last_seen REAL)')
+        return conn
+
+    def heartbeat(self, member_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO members VALUES (?, ?)',
+                             (member_id, time.time()))
+        finally:
+            conn.close()
+
+    def leave(self, member_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM members WHERE member_id = ?',
+                             (member_id,))
+        finally:
+            conn.close()
+
+    def get_members(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT member_id FROM members WHERE last_seen >= ? '
+                'ORDER BY member_id',
+                (time.time() - self.timeout,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [r[0] for r in rows]
+
+
+AVAILABLE_BACKENDS = {
+    'file': FileBackend,
+    'sqlite': SqliteBackend,
+}
+
+
+def get_backend():
+    """Returns the membership backend named in the configuration.
+    """
+    conf = cfg.CONF.coordination
+    if conf.backend in AVAILABLE_BACKENDS:
+        backend_cls = AVAILABLE_BACKENDS[conf.backend]
+    else:
+        backend_cls = importutils.import_class(conf.backend)
+    return backend_cls(conf.path, conf.member_timeout)
+
+
+class Coordinator(object):
+    """Tracks the cluster members and which of them owns each tenant.
+    """
+
+    def __init__(self, backend, member_id,
+                 replicas=hash_ring.DEFAULT_REPLICAS, on_change=None):
+        """
+        :param backend: Where the cluster members are recorded.
+        :type backend: MembershipBackend
+        :param member_id: The id of this node.
+        :type member_id: str
+        :param replicas: Number of virtual nodes per member on the ring.
+        :type replicas: int
+        :param on_change: Called with the old and new rings when the
+                          membership changes.
+        :type on_change: callable
+        """
+        self.backend = backend
+        self.member_id = member_id
+        self.replicas = replicas
+        self.on_change = on_change
+        self.ring = hash_ring.HashRing([member_id], replicas=replicas)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def owns(self, target, ring=None):
+        """Returns True if this node owns the tenant.
+        """
+        ring = ring or self.ring
+        try:
+            key = str(uuid.UUID(target.strip()))
+        except (AttributeError, TypeError, ValueError):
+            key = target
+        return ring.get_node(key) == self.member_id
+
+    def refresh(self, notify=True):
+        """Heartbeat and update the ring from the current membership.
+
+        :param notify: Call on_change if the membership changed.
+        :returns: True if the membership changed.
+        """
+        self.backend.heartbeat(self.member_id)
+        members = set(self.backend.get_members())
+        # A slow heartbeat should not make a node give up its own
+        # tenants while it is still running.
+        members.add(self.member_id)
+        if members == set(self.ring.nodes):
+            return False
+        old = self.ring
+        self.ring = hash_ring.HashRing(members, replicas=self.replicas)
+        LOG.info(_LI('cluster membership changed from %s to %s'),
+                 old.nodes, self.ring.nodes)
+        if notify and self.on_change is not None:
+            self.on_change(old, self.ring)
+        return True
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                LOG.exception(_LE('Error refreshing cluster membership'))
+
+    def start(self, interval):
+        """Join the cluster and start heartbeating in a thread.
+
+        Nothing is being managed before joining, so the initial
+        membership does not trigger on_change.
+        """
+        self.refresh(notify=False)
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval,),
+            name='ClusterCoordinator',
+        )
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop heartbeating and leave the cluster.
+        """
+        self._stopped.set()
+        try:
+            self.backend.leave(self.member_id)
+        except Exception:
+            LOG.exception(_LE('Error leaving the cluster'))
@@ -126,3 +126,10 @@ class Connection(object):
         :returns: tuple (False, None) if cluster is not in global debug mode or
                   (True, "reason") if it is.
         """
+
+    @abc.abstractmethod
+    def debug_version(self):
+        """Returns a counter that changes whenever any debug mode changes
+
+        :returns: int version of the debug mode settings
+        """
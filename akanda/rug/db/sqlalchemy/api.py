@@ -71,6 +71,21 @@ class Connection(api.Connection):
     def __init__(self):
         pass
 
+    def _bump_debug_version(self):
+        query = model_query(models.DebugVersion).filter_by(id=1)
+        if query.update({'version': models.DebugVersion.version + 1}):
+            return
+        version = models.DebugVersion()
+        version.update({
+            'id': 1,
+            'version': 1,
+        })
+        try:
+            version.save()
+        except db_exc.DBDuplicateEntry:
+            # Someone else created the row first.
+            query.update({'version': models.DebugVersion.version + 1})
+
     def _enable_debug(self, model, uuid, reason=None):
         model.update({
             'uuid': uuid,
@@ -80,10 +95,12 @@ class Connection(api.Connection):
             model.save()
         except db_exc.DBDuplicateEntry:
             pass
+        self._bump_debug_version()
 
     def _disable_debug(self, model=None, uuid=None):
         query = model_query(model)
         query.filter_by(uuid=uuid).delete()
+        self._bump_debug_version()
 
     def _check_debug(self, model, uuid):
         query = model_query(model)
@@ -155,10 +172,12 @@ class Connection(api.Connection):
             gdb.save()
         except db_exc.DBDuplicateEntry:
             pass
+        self._bump_debug_version()
 
     def disable_global_debug(self):
         query = model_query(models.GlobalDebug)
         query.filter_by(status=1).delete()
+        self._bump_debug_version()
 
     def global_debug(self):
         query = model_query(models.GlobalDebug)
@@ -166,3 +185,9 @@ class Connection(api.Connection):
         if not res:
             return (False, None)
         return (True, res[0].reason)
+
+    def debug_version(self):
+        res = model_query(models.DebugVersion).filter_by(id=1).first()
+        if not res:
+            return 0
+        return res.version
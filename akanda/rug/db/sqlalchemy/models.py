@@ -111,3 +111,14 @@ class GlobalDebug(Base):
     id = Column(Integer, primary_key=True)
     status = Column(Integer)
     reason = Column(String(255), nullable=True)
+
+
+class DebugVersion(Base):
+    """Stores a single row counting changes to the debug modes"""
+
+    __tablename__ = 'debug_version'
+    __table_args__ = (
+        table_args(),
+    )
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
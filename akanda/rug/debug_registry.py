@@ -0,0 +1,146 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""In-memory copy of the debug mode settings.
+"""
+
+import threading
+
+from oslo_log import log as logging
+
+from akanda.rug.common.i18n import _LE
+
+
+LOG = logging.getLogger(__name__)
+
+
+class DebugRegistry(object):
+    """Answers debug mode questions without a database query.
+
+    The settings are loaded from the database once and kept up to date
+    in place when this process changes them. Changes made by other
+    processes are picked up by refresh(), which only reloads when the
+    database's debug version counter has moved.
+    """
+
+    def __init__(self, db_api):
+        """
+        :param db_api: The database connection holding the settings.
+        :type db_api: akanda.rug.db.api.Connection
+        """
+        self.db_api = db_api
+        self._lock = threading.Lock()
+        self._version = None
+        self._global = (False, None)
+        self._tenants = {}
+        self._resources = {}
+        self._stopped = threading.Event()
+        self.refresh()
+
+    def refresh(self):
+        """Reload the settings if they changed in the database.
+
+        :returns: True if the settings were reloaded.
+        """
+        version = self.db_api.debug_version()
+        if version == self._version:
+            return False
+        # Read the version first, so a change made while we load is
+        # seen on the next refresh.
+        global_debug = self.db_api.global_debug()
+        tenants = dict(self.db_api.tenants_in_debug())
+        resources = dict(self.db_api.resources_in_debug())
+        with self._lock:
+            self._version = version
+            self._global = global_debug
+            self._tenants = tenants
+            self._resources = resources
+        LOG.debug('loaded debug modes version %s', version)
+        return True
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                LOG.exception(_LE('Could not refresh debug modes'))
+
+    def start(self, interval):
+        """Refresh the settings periodically in a thread.
+        """
+        t = threading.Thread(
+            target=self._run,
+            args=(interval,),
+            name='DebugRegistry',
+        )
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def stop(self):
+        self._stopped.set()
+
+    def global_debug(self):
+        return self._global
+
+    def tenant_in_debug(self, tenant_uuid):
+        with self._lock:
+            if tenant_uuid in self._tenants:
+                return (True, self._tenants[tenant_uuid])
+        return (False, None)
+
+    def tenants_in_debug(self):
+        with self._lock:
+            return set(self._tenants.items())
+
+    def resource_in_debug(self, resource_uuid):
+        with self._lock:
+            if resource_uuid in self._resources:
+                return (True, self._resources[resource_uuid])
+        return (False, None)
+
+    def resources_in_debug(self):
+        with self._lock:
+            return set(self._resources.items())
+
+    def enable_global_debug(self, reason=None):
+        self.db_api.enable_global_debug(reason)
+        self._global = (True, reason)
+
+    def disable_global_debug(self):
+        self.db_api.disable_global_debug()
+        self._global = (False, None)
+
+    def enable_tenant_debug(self, tenant_uuid, reason=None):
+        self.db_api.enable_tenant_debug(tenant_uuid, reason)
+        with self._lock:
+            self._tenants[tenant_uuid] = reason
+
+    def disable_tenant_debug(self, tenant_uuid):
+        self.db_api.disable_tenant_debug(tenant_uuid)
+        with self._lock:
+            self._tenants.pop(tenant_uuid, None)
+
+    def enable_resource_debug(self, resource_uuid, reason=None):
+        self.db_api.enable_resource_debug(resource_uuid, reason)
+        with self._lock:
+            self._resources[resource_uuid] = reason
+
+    def disable_resource_debug(self, resource_uuid):
+        self.db_api.disable_resource_debug(resource_uuid)
+        with self._lock:
+            self._resources.pop(resource_uuid, None)
@@ -11,7 +11,7 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from oslo_log import log as logging
+from akanda.rug.common import resource_log
 
 
 class BaseDriver(object):
@@ -21,8 +21,11 @@ class BaseDriver(object):
     def __init__(self, worker_context, id, log=None):
         """This is the abstract for rug drivers.
 
+        :param worker_context: passed to post_init(), or None to leave
+                               calling post_init() to the caller
         :param id: logical resource id
-        :param log: override default log
+        :param log: override the logger the resource's messages are
+                    logged through
         """
         self.id = id
         self.external_port = None
@@ -31,12 +34,10 @@ class BaseDriver(object):
         self.image_uuid = None
         self.name = 'ak-%s-%s' % (self.RESOURCE_NAME, self.id)
 
-        if log:
-            self.log = log
-        else:
-            self.log = logging.getLogger(self.name)
+        self.log = resource_log.ResourceLogAdapter(self.name, log)
 
-        self.post_init(worker_context)
+        if worker_context is not None:
+            self.post_init(worker_context)
 
     def post_init(self, worker_context):
         """post init hook
@@ -20,6 +20,7 @@
 
 import threading
 import time
+import zlib
 
 from oslo_config import cfg
 
@@ -35,26 +36,57 @@ HEALTH_INSPECTOR_OPTS = [
     cfg.IntOpt('health_check_period',
                default=60,
                help='seconds between health checks'),
+    cfg.IntOpt('health_check_slots',
+               default=60,
+               help='number of slices each health check period is divided '
+                    'into. Each resource is polled during the slice chosen '
+                    'by its id, spreading the polls evenly over the period. '
+                    'Set to 1 to poll every resource at the same time.'),
 ]
 CONF.register_opts(HEALTH_INSPECTOR_OPTS)
 
+# Keys in the body of a wildcard POLL event that limit it to the
+# resources in one slice of the health check period.
+POLL_SLOT = 'poll_slot'
+POLL_SLOTS = 'poll_slots'
+
+
+def poll_slot(resource_id, slots):
+    """Returns the slice of the health check period a resource is polled in.
+    """
+    return (zlib.crc32(str(resource_id)) & 0xffffffff) % slots
+
+
+def in_poll_slot(resource_id, body):
+    """Returns True if a POLL with the given body applies to the resource.
+    """
+    if not body or POLL_SLOT not in body:
+        return True
+    return poll_slot(resource_id, body[POLL_SLOTS]) == body[POLL_SLOT]
+
 
 def _health_inspector(scheduler):
     """Runs in the thread.
     """
     period = CONF.health_check_period
+    slots = max(CONF.health_check_slots, 1)
+    slot = 0
     while True:
-        time.sleep(period)
+        time.sleep(float(period) / slots)
         LOG.debug('waking up')
         r = event.Resource(
             id='*',
             tenant_id='*',
             driver='*',
         )
+        body = {}
+        if slots > 1:
+            body = {POLL_SLOT: slot, POLL_SLOTS: slots}
+            slot = (slot + 1) % slots
         e = event.Event(
             resource=r,
             crud=event.POLL,
-            body={},
+            body=body,
         )
         scheduler.handle_message('*', e)
 
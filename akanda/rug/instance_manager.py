@@ -15,12 +15,16 @@
 # under the License.
 
 from datetime import datetime
+import hashlib
+from logging import DEBUG
 import time
 
 from oslo_config import cfg
 
+from akanda.rug.api import nova
 from akanda.rug.drivers import states
 from akanda.rug.common.i18n import _LE, _LI
+from akanda.rug.openstack.common import jsonutils
 
 CONF = cfg.CONF
 INSTANCE_MANAGER_OPTS = [
@@ -41,6 +45,11 @@ INSTANCE_MANAGER_OPTS = [
 CONF.register_opts(INSTANCE_MANAGER_OPTS)
 
 
+def config_digest(config):
+    """Returns a short digest identifying an instance configuration."""
+    return hashlib.md5(jsonutils.dumps(config, sort_keys=True)).hexdigest()
+
+
 def synchronize_driver_state(f):
     """Wrapper that triggers a driver's synchronize_state function"""
     def wrapper(self, *args, **kw):
@@ -97,7 +106,8 @@ class BootAttemptCounter(object):
 
 class InstanceManager(object):
 
-    def __init__(self, driver, resource_id, worker_context):
+    def __init__(self, driver, resource_id, worker_context,
+                 state_callback=None, snapshot=None):
         """The instance manager is your interface to the running instance.
         wether it be virtual, container or physical.
 
@@ -106,19 +116,44 @@ class InstanceManager(object):
         :param driver: driver object
         :param resource_id: UUID of logical resource
         :param worker_context:
+        :param state_callback: Invoked with the resource id and the new
+                               state whenever the state changes.
+        :type state_callback: callable
+        :param snapshot: What an earlier process's instance manager for
+                         the resource knew, from snapshot(). It is used
+                         instead of looking the instance up again.
+        :type snapshot: dict
         """
         self.driver = driver
         self.id = resource_id
         self.log = self.driver.log
 
+        self._state_callback = state_callback
+        self._state = None
         self.state = states.DOWN
 
         self.instance_info = None
         self.last_error = None
+        # Digest of the last configuration pushed to the instance.
+        self.config_digest = None
         self._boot_counter = BootAttemptCounter()
         self._last_synced_status = None
 
-        self.state = self.update_state(worker_context, silent=True)
+        if snapshot and snapshot.get('instance_info'):
+            self.restore(snapshot)
+        else:
+            self.state = self.update_state(worker_context, silent=True)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        changed = value != self._state
+        self._state = value
+        if changed and self._state_callback is not None:
+            self._state_callback(self.id, value)
 
     @property
     def attempts(self):
@@ -135,6 +170,34 @@ class InstanceManager(object):
         """
         self._boot_counter.reset()
 
+    def snapshot(self):
+        """Returns what is known about the instance, for restore().
+
+        :returns: A JSON serializable dict.
+        """
+        return {
+            'state': self.state,
+            'config_digest': self.config_digest,
+            # The status last sent to neutron, so it is not sent again.
+            'synced_status': getattr(self.driver, '_last_synced_status',
+                                     None),
+            'instance_info': (self.instance_info.to_dict()
+                              if self.instance_info else None),
+        }
+
+    def restore(self, snapshot):
+        """Pick up from a snapshot() taken by an earlier process.
+
+        Nothing is looked up. The next update_state() finds out
+        whether the instance has changed since.
+        """
+        self.instance_info = nova.InstanceInfo.from_dict(
+            snapshot['instance_info'])
+        self.config_digest = snapshot.get('config_digest')
+        if snapshot.get('synced_status'):
+            self.driver._last_synced_status = snapshot['synced_status']
+        self.state = snapshot['state']
+
     @synchronize_driver_state
     def update_state(self, worker_context, silent=False):
         """Updates state of the instance and, by extension, its logical resource
@@ -162,9 +225,10 @@ class InstanceManager(object):
                     self.state = states.UP
                 break
             if not silent:
-                self.log.debug('Alive check failed. Attempt %d of %d',
-                               i,
-                               cfg.CONF.max_retries)
+                self.log.log_limited(DEBUG, 'alive_check',
+                                     'Alive check failed. Attempt %d of %d',
+                                     i,
+                                     cfg.CONF.max_retries)
             time.sleep(cfg.CONF.retry_delay)
         else:
             old_state = self.state
@@ -400,6 +464,7 @@ class InstanceManager(object):
                     )
                 time.sleep(cfg.CONF.retry_delay)
             else:
+                self.config_digest = config_digest(config)
                 self.state = states.CONFIGURED
                 self.log.info('Instance config updated')
                 return
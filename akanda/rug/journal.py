@@ -0,0 +1,193 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Local journal of the work waiting in a worker's state machines.
+"""
+
+import glob
+import json
+import os
+import threading
+import uuid
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from akanda.rug.common.i18n import _LW
+from akanda.rug import event
+
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_OPTS = [
+    cfg.StrOpt(
+        'journal_dir',
+        default='/var/lib/akanda-rug/journal',
+        help='directory where worker processes journal the work waiting '
+             'in their state machines, so it is replayed after a restart. '
+             'Leave empty to disable the journal.'),
+    cfg.IntOpt(
+        'journal_compact_threshold',
+        default=1000,
+        help='number of journal records written before the journal is '
+             'rewritten with only the resources that still have work'),
+]
+cfg.CONF.register_opts(JOURNAL_OPTS)
+
+SUFFIX = '.journal'
+
+
+def journal_path(directory, name, pid):
+    """Returns a new journal file for a worker process.
+
+    The name is unique, since a restarted worker often gets the same
+    pid as the one before it, whose journal is still to be replayed.
+    """
+    return os.path.join(
+        directory, '%s-%d-%s%s' % (name, pid, uuid.uuid4().hex, SUFFIX))
+
+
+def _encode(resource, actions):
+    return json.dumps({
+        'driver': resource.driver,
+        'id': resource.id,
+        'tenant_id': resource.tenant_id,
+        'actions': actions,
+    }) + '\n'
+
+
+class Journal(object):
+    """Append-only record of the actions waiting in state machine inboxes.
+
+    Each line holds a resource and the actions it has waiting, including
+    any action a worker thread is busy with. A later line for the same
+    resource replaces the earlier ones, and an empty list means the
+    resource has no work left. Once more than compact_threshold lines
+    have been written, and they are mostly stale, the file is rewritten
+    with only the resources that still have work.
+    """
+
+    def __init__(self, path, compact_threshold=1000):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        # resource id -> (resource, sorted actions)
+        self._pending = {}
+        self._lines = 0
+        self._file = open(path, 'a')
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _write(self, resource, actions):
+        if actions:
+            self._pending[resource.id] = (resource, actions)
+        elif self._pending.pop(resource.id, None) is None:
+            # Nothing was recorded, so there is nothing to clear.
+            return
+        self._file.write(_encode(resource, actions))
+        self._file.flush()
+        self._lines += 1
+        if (self._lines > self.compact_threshold and
+                self._lines > 2 * len(self._pending)):
+            self._compact()
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for resource, actions in self._pending.values():
+                f.write(_encode(resource, actions))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.rename(tmp, self.path)
+        self._file = open(self.path, 'a')
+        self._lines = len(self._pending)
+
+    def add(self, resource, actions):
+        """Record actions delivered to a resource's state machine.
+
+        They are added to the ones already recorded, since those may be
+        in progress and no longer in the state machine's inbox.
+        """
+        with self._lock:
+            old = self._pending.get(resource.id, (None, []))[1]
+            new = sorted(set(old).union(actions))
+            if new != old:
+                self._write(resource, new)
+
+    def record(self, resource, actions):
+        """Record all of the actions a resource has left to do.
+        """
+        with self._lock:
+            new = sorted(actions)
+            if new != self._pending.get(resource.id, (None, []))[1]:
+                self._write(resource, new)
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+def load(paths):
+    """Read the work recorded in journals left by earlier processes.
+
+    A torn last line, from a process that died while writing it, is
+    skipped.
+
+    :returns: A list of Events, one per action still waiting.
+    """
+    pending = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        LOG.warning(_LW('Skipping bad record in %s'), path)
+                        continue
+                    pending[record['id']] = record
+        except IOError as err:
+            LOG.warning(_LW('Could not read journal %s: %s'), path, err)
+    events = []
+    for record in pending.values():
+        resource = event.Resource(
+            driver=record['driver'],
+            id=record['id'],
+            tenant_id=record['tenant_id'],
+        )
+        for action in record['actions']:
+            events.append(event.Event(resource=resource, crud=action,
+                                      body={}))
+    return events
+
+
+def find(directory, name=None, pid=None):
+    """Returns the journal files in directory, oldest first.
+
+    :param name: Only return the journals of the worker process with
+                 this name and pid.
+    """
+    if name is None:
+        pattern = '*' + SUFFIX
+    else:
+        pattern = '%s-%d-*%s' % (name, pid, SUFFIX)
+    return sorted(glob.glob(os.path.join(directory, pattern)),
+                  key=os.path.getmtime)
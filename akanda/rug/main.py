@@ -28,12 +28,15 @@ from oslo_log import log
 
 from akanda.rug.common.i18n import _LE, _LI
 from akanda.rug.common import config as ak_cfg
+from akanda.rug import coordination
 from akanda.rug import daemon
 from akanda.rug import health
+from akanda.rug import journal
 from akanda.rug import metadata
 from akanda.rug import notifications
 from akanda.rug import scheduler
 from akanda.rug import populate
+from akanda.rug import snapshot
 from akanda.rug import worker
 from akanda.rug.api import neutron as neutron_api
 
@@ -173,18 +176,49 @@ def main(argv=sys.argv[1:]):
     # Set up a factory to make Workers that know how many threads to
     # run.
     worker_factory = functools.partial(
-        worker.Worker,
+        worker.create_worker,
         notifier=publisher
     )
 
+    # Share the tenants with the other rug nodes, if there are any.
+    coordinator = None
+    if cfg.CONF.coordination.enabled:
+        coordinator = coordination.Coordinator(
+            backend=coordination.get_backend(),
+            member_id=cfg.CONF.host,
+            replicas=cfg.CONF.coordination.hash_replicas,
+        )
+
+    # Collect the journals and snapshots left by the previous run
+    # before the new workers start writing their own.
+    journals = []
+    if cfg.CONF.journal_dir:
+        journals = journal.find(cfg.CONF.journal_dir)
+    snapshots = []
+    if cfg.CONF.snapshot_dir:
+        snapshots = snapshot.find(cfg.CONF.snapshot_dir)
+
     # Set up the scheduler that knows how to manage the routers and
     # dispatch messages.
     sched = scheduler.Scheduler(
         worker_factory=worker_factory,
+        coordinator=coordinator,
     )
 
-    # Prepopulate the workers with existing routers on startup
-    populate.pre_populate_workers(sched)
+    # Join the cluster before populating so only our own tenants are
+    # loaded.
+    if coordinator is not None:
+        coordinator.start(cfg.CONF.coordination.heartbeat_interval)
+
+    # Restore what the last run knew about the resources and replay
+    # the work that was pending when it stopped, then prepopulate the
+    # workers with the other existing routers
+    restored = set()
+    if snapshots:
+        restored = populate.restore_snapshots(sched, snapshots)
+    if journals:
+        populate.replay_journals(sched, journals)
+    populate.pre_populate_workers(sched, restored)
 
     # Set up the periodic health check
     health.start_inspector(cfg.CONF.health_check_period, sched)
@@ -194,6 +228,9 @@ def main(argv=sys.argv[1:]):
     try:
         shuffle_notifications(notification_queue, sched)
     finally:
+        if coordinator is not None:
+            LOG.info(_LI('Leaving the cluster.'))
+            coordinator.stop()
         LOG.info(_LI('Stopping scheduler.'))
         sched.stop()
         LOG.info(_LI('Stopping notification publisher.'))
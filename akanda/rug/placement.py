@@ -0,0 +1,211 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Load-aware placement of tenants on worker processes.
+"""
+
+import collections
+import threading
+import time
+
+# Weight given to the most recent window when updating event rates.
+RATE_DECAY = 0.5
+# Rates below this are forgotten to keep the table from growing.
+MIN_RATE = 0.001
+
+
+class Migration(object):
+    """A tenant being handed off from one worker to another.
+    """
+
+    def __init__(self, tenant_id, src, dst):
+        self.tenant_id = tenant_id
+        self.src = src
+        self.dst = dst
+        self.started = time.time()
+        # Messages that arrive while the handoff is in progress.
+        self.held = []
+
+
+class PlacementTable(object):
+    """Tracks which worker owns each tenant and how busy the tenants are.
+
+    Event rates are an exponentially decaying average per tenant,
+    updated once per window. A worker's load is the sum of the rates
+    of its tenants plus its backlog spread over one window.
+    """
+
+    def __init__(self, num_workers, window=60.0):
+        """
+        :param num_workers: Size of the worker pool.
+        :type num_workers: int
+        :param window: Seconds over which event rates are measured.
+        :type window: float
+        """
+        self.num_workers = num_workers
+        self.window = float(window)
+        self.lock = threading.RLock()
+        self._owners = {}
+        self._rates = {}
+        self._total_rate = 0.0
+        self._counts = collections.Counter()
+        self._window_start = time.time()
+        self._migrations = {}
+
+    def _roll(self, now=None):
+        now = now or time.time()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        total = 0
+        for tenant_id in set(self._rates) | set(self._counts):
+            count = self._counts.get(tenant_id, 0)
+            total += count
+            rate = (RATE_DECAY * count / elapsed +
+                    (1 - RATE_DECAY) * self._rates.get(tenant_id, 0.0))
+            if rate < MIN_RATE:
+                self._rates.pop(tenant_id, None)
+            else:
+                self._rates[tenant_id] = rate
+        self._total_rate = (RATE_DECAY * total / elapsed +
+                            (1 - RATE_DECAY) * self._total_rate)
+        self._counts.clear()
+        self._window_start = now
+
+    def record(self, tenant_id):
+        """Count an event for the tenant.
+        """
+        with self.lock:
+            self._roll()
+            self._counts[tenant_id] += 1
+
+    def rate(self, tenant_id):
+        with self.lock:
+            self._roll()
+            return self._rates.get(tenant_id, 0.0)
+
+    def is_quiet(self, threshold):
+        """Returns True if the overall event rate is below threshold.
+        """
+        with self.lock:
+            self._roll()
+            return self._total_rate < threshold
+
+    def loads(self, backlogs):
+        """Returns the load of each worker.
+
+        :param backlogs: Number of messages waiting for each worker.
+        :type backlogs: list of int
+        """
+        with self.lock:
+            self._roll()
+            loads = [b / self.window for b in backlogs]
+            for tenant_id, idx in self._owners.items():
+                loads[idx] += self._rates.get(tenant_id, 0.0)
+            return loads
+
+    def owner(self, tenant_id, backlogs):
+        """Returns the worker index owning the tenant.
+
+        A tenant seen for the first time is assigned to the least
+        loaded worker, using the number of tenants to break ties.
+
+        :param backlogs: Callable returning the backlog of each worker.
+        """
+        with self.lock:
+            idx = self._owners.get(tenant_id)
+            if idx is None:
+                loads = self.loads(backlogs())
+                counts = [0] * self.num_workers
+                for i in self._owners.values():
+                    counts[i] += 1
+                idx = min(range(self.num_workers),
+                          key=lambda i: (loads[i], counts[i]))
+                self._owners[tenant_id] = idx
+            return idx
+
+    def tenants(self, idx):
+        with self.lock:
+            return [t for t, i in self._owners.items() if i == idx]
+
+    def pick_migration(self, backlogs, ratio):
+        """Choose a hot tenant to move off the busiest worker.
+
+        :param backlogs: Number of messages waiting for each worker.
+        :type backlogs: list of int
+        :param ratio: How far above the mean load the busiest worker
+                      has to be before anything is moved.
+        :type ratio: float
+        :returns: (tenant_id, src, dst) or None
+        """
+        with self.lock:
+            if self._migrations or self.num_workers < 2:
+                return None
+            loads = self.loads(backlogs)
+            mean = sum(loads) / len(loads)
+            src = max(range(self.num_workers), key=lambda i: loads[i])
+            dst = min(range(self.num_workers), key=lambda i: loads[i])
+            if not mean or loads[src] < mean * ratio:
+                return None
+            candidates = sorted(
+                ((self._rates.get(t, 0.0), t) for t in self.tenants(src)),
+                reverse=True,
+            )
+            for rate, tenant_id in candidates:
+                # Only move a tenant if doing so lowers the peak load.
+                if rate and loads[dst] + rate < loads[src]:
+                    return (tenant_id, src, dst)
+            return None
+
+    def start_migration(self, tenant_id, dst):
+        with self.lock:
+            m = Migration(tenant_id, self._owners.get(tenant_id), dst)
+            self._migrations[tenant_id] = m
+            return m
+
+    def hold(self, tenant_id, item):
+        """Keep item until the tenant's migration is finished.
+
+        :returns: True if the tenant is being migrated and the item
+                  was held, False otherwise.
+        """
+        with self.lock:
+            m = self._migrations.get(tenant_id)
+            if m is None:
+                return False
+            m.held.append(item)
+            return True
+
+    def finish_migration(self, tenant_id, released):
+        """Complete or abandon a migration.
+
+        :param released: True if the old worker let go of the tenant.
+        :returns: The items held during the migration.
+        """
+        with self.lock:
+            m = self._migrations.pop(tenant_id, None)
+            if m is None:
+                return []
+            if released:
+                self._owners[tenant_id] = m.dst
+            return m.held
+
+    def expired_migrations(self, timeout):
+        with self.lock:
+            now = time.time()
+            return [t for t, m in self._migrations.items()
+                    if now - m.started > timeout]
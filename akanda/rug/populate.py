@@ -18,20 +18,88 @@
 """Populate the workers with the existing routers
 """
 
+import collections
+import os
 import threading
+import time
 
+from oslo_config import cfg
 from oslo_log import log as logging
 
+from akanda.rug.common.i18n import _LI
+from akanda.rug import commands
 from akanda.rug import event
 from akanda.rug import drivers
+from akanda.rug import journal
+from akanda.rug import snapshot
+
+cfg.CONF.import_group('coordination', 'akanda.rug.coordination')
 
 LOG = logging.getLogger(__name__)
 
 
-def _pre_populate_workers(scheduler):
+def replay_journals(scheduler, paths):
+    """Send the work left in the journals of stopped workers to the
+    current ones, then remove those journals.
+
+    The workers journal the replayed work again themselves.
+    """
+    events = journal.load(paths)
+    LOG.info(_LI('Replaying %d journaled events from %d journals'),
+             len(events), len(paths))
+    for message in events:
+        scheduler.handle_message(message.resource.tenant_id, message)
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            LOG.debug('could not remove journal %s', path)
+
+
+def restore_snapshots(scheduler, paths):
+    """Send the resources saved in the snapshots of stopped workers to
+    the current ones, then remove those snapshots.
+
+    :returns: The ids of the restored resources. They are not polled
+              when the workers are populated, the health checks get to
+              them over the following health check period instead.
+    """
+    records = snapshot.load(paths, cfg.CONF.snapshot_max_age)
+    by_tenant = collections.defaultdict(list)
+    for record in records:
+        by_tenant[record['tenant_id']].append(record)
+    LOG.info(_LI('Restoring %d resources of %d tenants from %d snapshots'),
+             len(records), len(by_tenant), len(paths))
+    for tenant_id, resources in by_tenant.items():
+        message = event.Event(
+            resource=event.Resource(driver='*', id='*', tenant_id=tenant_id),
+            crud=event.COMMAND,
+            body={'command': commands.RESOURCE_RESTORE,
+                  'tenant_id': tenant_id,
+                  'resources': resources},
+        )
+        scheduler.handle_message(tenant_id, message)
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            LOG.debug('could not remove snapshot %s', path)
+    return set(r['resource_id'] for r in records)
+
+
+def _owned_by(scheduler, resource, workers):
+    owners = scheduler.dispatcher.pick_workers(resource.tenant_id)
+    return any(o is w for o in owners for w in workers)
+
+
+def _pre_populate_workers(scheduler, workers=None, restored=()):
     """Loops through enabled drivers triggering each drivers pre_populate_hook
     which is a static method for each driver.
 
+    :param workers: If given, only resources owned by these scheduler
+                    workers are sent a POLL.
+    :param restored: The ids of resources restored from snapshots,
+                     which are not sent a POLL.
     """
     for driver in drivers.enabled_drivers():
         resources = driver.pre_populate_hook()
@@ -47,6 +115,11 @@ def _pre_populate_workers(scheduler):
                   driver.RESOURCE_NAME)
 
         for resource in resources:
+            if resource.id in restored:
+                continue
+            if workers is not None and \
+                    not _owned_by(scheduler, resource, workers):
+                continue
             message = event.Event(
                 resource=resource,
                 crud=event.POLL,
@@ -55,16 +128,94 @@ def _pre_populate_workers(scheduler):
             scheduler.handle_message(resource.tenant_id, message)
 
 
-def pre_populate_workers(scheduler):
+def pre_populate_workers(scheduler, restored=()):
     """Start the pre-populating task
+
+    :param restored: The ids of resources restored from snapshots,
+                     which are left to the health checks.
     """
 
     t = threading.Thread(
         target=_pre_populate_workers,
-        args=(scheduler,),
+        args=(scheduler, None, restored),
         name='PrePopulateWorkers'
     )
 
     t.setDaemon(True)
     t.start()
     return t
+
+
+def _repopulate_workers(scheduler, workers, journals, snapshots):
+    restored = ()
+    if snapshots:
+        restored = restore_snapshots(scheduler, snapshots)
+    if journals:
+        replay_journals(scheduler, journals)
+    _pre_populate_workers(scheduler, workers, restored)
+
+
+def repopulate_workers(scheduler, workers, journals=None, snapshots=None):
+    """Start re-populating workers that have been restarted
+
+    The resources in the snapshots of the dead processes are restored
+    and the work left in their journals is replayed first, then only
+    the other resources owned by the given workers are polled.
+    """
+
+    t = threading.Thread(
+        target=_repopulate_workers,
+        args=(scheduler, workers, journals, snapshots),
+        name='RepopulateWorkers'
+    )
+
+    t.setDaemon(True)
+    t.start()
+    return t
+
+
+def _rebalance_cluster(scheduler, old_ring, new_ring):
+    """Poll the resources this node gained and release the ones it lost
+    when the cluster membership changes.
+    """
+    coordinator = scheduler.coordinator
+    lost = set()
+    for driver in drivers.enabled_drivers():
+        for resource in driver.pre_populate_hook() or []:
+            owned = coordinator.owns(resource.tenant_id, new_ring)
+            was_owned = coordinator.owns(resource.tenant_id, old_ring)
+            if owned and not was_owned:
+                message = event.Event(
+                    resource=resource,
+                    crud=event.POLL,
+                    body={}
+                )
+                scheduler.handle_message(resource.tenant_id, message)
+            elif was_owned and not owned:
+                lost.add(resource.tenant_id)
+
+    LOG.debug('Releasing %d tenants to other nodes', len(lost))
+    for tenant_id in lost:
+        scheduler.release_tenant(tenant_id)
+    # Workers refuse to release busy tenants, so keep asking until
+    # they have all been let go or the ring changes again.
+    while lost:
+        time.sleep(cfg.CONF.coordination.heartbeat_interval)
+        if coordinator.ring is not new_ring or \
+                not scheduler.retry_releases():
+            break
+
+
+def rebalance_cluster(scheduler, old_ring, new_ring):
+    """Start moving tenants after a change in the cluster membership
+    """
+
+    t = threading.Thread(
+        target=_rebalance_cluster,
+        args=(scheduler, old_ring, new_ring),
+        name='RebalanceCluster'
+    )
+
+    t.setDaemon(True)
+    t.start()
+    return t
@@ -0,0 +1,163 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Index of the state machines managed by a worker process.
+"""
+
+import collections
+import threading
+
+
+class ResourceIndex(object):
+    """Finds state machines without scanning all of them.
+
+    State machines are looked up by resource id directly, and the ids
+    are also kept in secondary indexes by tenant, driver and instance
+    state. The instance state index is kept current by set_state(),
+    which the InstanceManager calls whenever its state changes.
+
+    Resources whose state machines were set aside while idle are
+    remembered separately, by their compact records, so they can be
+    found and brought back.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resources = {}
+        self._keys = {}
+        self._by_tenant = collections.defaultdict(set)
+        self._by_driver = collections.defaultdict(set)
+        self._by_state = collections.defaultdict(set)
+        self._dormant = {}
+
+    def __len__(self):
+        return len(self._resources)
+
+    def __contains__(self, resource_id):
+        return resource_id in self._resources
+
+    @staticmethod
+    def _discard(index, key, resource_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(resource_id)
+            if not ids:
+                del index[key]
+
+    def _remove(self, resource_id):
+        keys = self._keys.pop(resource_id, None)
+        if keys is None:
+            return None
+        tenant_id, driver, state = keys
+        self._discard(self._by_tenant, tenant_id, resource_id)
+        self._discard(self._by_driver, driver, resource_id)
+        self._discard(self._by_state, state, resource_id)
+        return self._resources.pop(resource_id)
+
+    def add(self, sm):
+        """Index a state machine, replacing any with the same resource id.
+        """
+        resource_id = sm.resource_id
+        tenant_id = sm.tenant_id
+        driver = getattr(sm.driver, 'RESOURCE_NAME', None)
+        state = getattr(sm.instance, 'state', None)
+        with self._lock:
+            self._remove(resource_id)
+            self._dormant.pop(resource_id, None)
+            self._resources[resource_id] = sm
+            self._keys[resource_id] = (tenant_id, driver, state)
+            self._by_tenant[tenant_id].add(resource_id)
+            self._by_driver[driver].add(resource_id)
+            self._by_state[state].add(resource_id)
+
+    def remove(self, resource_id):
+        """Forget a resource.
+
+        :returns: The state machine that was removed, or None.
+        """
+        with self._lock:
+            return self._remove(resource_id)
+
+    def get(self, resource_id):
+        """Returns the state machine for a resource, or None.
+        """
+        return self._resources.get(resource_id)
+
+    def set_state(self, resource_id, state):
+        """Move a resource to the index of its new instance state.
+
+        Resources that are not indexed yet are ignored, add() reads the
+        state when they are.
+        """
+        with self._lock:
+            keys = self._keys.get(resource_id)
+            if keys is None or keys[2] == state:
+                return
+            tenant_id, driver, old_state = keys
+            self._discard(self._by_state, old_state, resource_id)
+            self._by_state[state].add(resource_id)
+            self._keys[resource_id] = (tenant_id, driver, state)
+
+    def find(self, tenant_id=None, driver=None, state=None):
+        """Returns the state machines matching all of the given values.
+
+        Only the smallest of the matching secondary indexes is walked.
+        """
+        with self._lock:
+            candidates = [
+                index.get(key, ())
+                for index, key in ((self._by_tenant, tenant_id),
+                                   (self._by_driver, driver),
+                                   (self._by_state, state))
+                if key is not None
+            ]
+            if not candidates:
+                return list(self._resources.values())
+            smallest = min(candidates, key=len)
+            wanted = (tenant_id, driver, state)
+            return [
+                self._resources[resource_id]
+                for resource_id in smallest
+                if all(w is None or w == k
+                       for w, k in zip(wanted, self._keys[resource_id]))
+            ]
+
+    def add_dormant(self, record):
+        """Replace a resource's state machine with its compact record.
+        """
+        with self._lock:
+            self._remove(record.resource_id)
+            self._dormant[record.resource_id] = record
+
+    def remove_dormant(self, resource_id):
+        with self._lock:
+            return self._dormant.pop(resource_id, None)
+
+    def get_dormant(self, resource_id):
+        """Returns the compact record of a dormant resource, or None.
+        """
+        return self._dormant.get(resource_id)
+
+    def dormant_count(self):
+        return len(self._dormant)
+
+    def state_counts(self):
+        """Returns the number of resources in each instance state.
+        """
+        with self._lock:
+            return dict((state, len(ids))
+                        for state, ids in self._by_state.items())
@@ -0,0 +1,92 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Striped locks for the resources managed by a worker process.
+"""
+
+import threading
+
+
+DEFAULT_STRIPES = 64
+
+
+class ResourceLocks(object):
+    """Locks and busy flags for resources, spread over a fixed set of
+    stripes.
+
+    A resource is busy from when its state machine is put in the work
+    queue until a worker thread has finished updating it and found no
+    more work, so only one copy is queued or running at a time. The
+    flags are kept in a set per stripe and removed when cleared, so
+    nothing is left behind for resources that are deleted or set
+    aside.
+
+    Each resource maps to one of the stripe locks, which should be
+    held while its state machine is given work or its flag is looked
+    at or changed. Resources on different stripes do not wait for each
+    other.
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        stripes = max(1, stripes)
+        self._locks = [threading.Lock() for i in range(stripes)]
+        self._busy = [set() for i in range(stripes)]
+
+    def __len__(self):
+        return sum(len(busy) for busy in self._busy)
+
+    def __contains__(self, resource_id):
+        return self.is_busy(resource_id)
+
+    def _stripe(self, resource_id):
+        return hash(resource_id) % len(self._locks)
+
+    def lock(self, resource_id):
+        """Returns the lock for the stripe a resource belongs to.
+        """
+        return self._locks[self._stripe(resource_id)]
+
+    def mark_busy(self, resource_id):
+        """Flag a resource as busy.
+
+        The resource's stripe lock should be held before calling this
+        method.
+
+        :returns: True if the resource was not busy already.
+        """
+        busy = self._busy[self._stripe(resource_id)]
+        if resource_id in busy:
+            return False
+        busy.add(resource_id)
+        return True
+
+    def clear_busy(self, resource_id):
+        """Clear a resource's busy flag.
+
+        The resource's stripe lock should be held before calling this
+        method.
+
+        :returns: True if the resource was busy.
+        """
+        busy = self._busy[self._stripe(resource_id)]
+        if resource_id not in busy:
+            return False
+        busy.discard(resource_id)
+        return True
+
+    def is_busy(self, resource_id):
+        return resource_id in self._busy[self._stripe(resource_id)]
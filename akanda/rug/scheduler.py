@@ -19,14 +19,22 @@
 """
 
 import multiprocessing
+import threading
+import time
 import uuid
 
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from akanda.rug import commands
+from akanda.rug.common import hash_ring
 from akanda.rug.common.i18n import _, _LE, _LI, _LW
 from akanda.rug import daemon
+from akanda.rug import event
+from akanda.rug import journal
+from akanda.rug import placement
+from akanda.rug import populate
+from akanda.rug import snapshot
 
 
 LOG = logging.getLogger(__name__)
@@ -35,45 +43,245 @@ SCHEDULER_OPTS = [
     cfg.IntOpt('num_worker_processes',
                default=16,
                help='the number of worker processes to run'),
+    cfg.IntOpt('worker_hash_replicas',
+               default=hash_ring.DEFAULT_REPLICAS,
+               help='the number of virtual nodes each worker process '
+                    'gets on the tenant hash ring'),
+    cfg.DictOpt('worker_process_weights',
+                default={},
+                help='relative weights for worker processes on the tenant '
+                     'hash ring, keyed on the process name (p00, p01, ...); '
+                     'unlisted processes have a weight of 1 and at least '
+                     'one process needs a weight of 1 or more'),
+    cfg.IntOpt('ipc_batch_size',
+               default=64,
+               help='the maximum number of messages coalesced into a single '
+                    'write to a worker process'),
+    cfg.FloatOpt('ipc_batch_interval',
+                 default=0.01,
+                 help='seconds to wait for more messages before flushing '
+                      'a partial batch to the worker processes'),
+    cfg.IntOpt('worker_check_interval',
+               default=5,
+               help='seconds between checks for worker processes that have '
+                    'died and need to be restarted, 0 to disable'),
+    cfg.StrOpt('worker_placement',
+               default='hash',
+               choices=['hash', 'load'],
+               help='how tenants are assigned to worker processes: "hash" '
+                    'places them on a consistent hash ring, "load" assigns '
+                    'new tenants to the least loaded worker and moves hot '
+                    'tenants off overloaded workers'),
+    cfg.IntOpt('placement_rebalance_interval',
+               default=300,
+               help='seconds between attempts to move a hot tenant off the '
+                    'busiest worker when worker_placement is "load"'),
+    cfg.FloatOpt('placement_imbalance_ratio',
+                 default=1.5,
+                 help='only move tenants when the busiest worker is this '
+                      'many times more loaded than the average'),
+    cfg.FloatOpt('placement_quiet_rate',
+                 default=10.0,
+                 help='only move tenants while the overall event rate, in '
+                      'events per second, is below this value'),
+    cfg.IntOpt('placement_handoff_timeout',
+               default=60,
+               help='seconds to wait for a worker to hand off a tenant '
+                    'before giving up and leaving it in place'),
 ]
 CONF.register_opts(SCHEDULER_OPTS)
 
 
-def _worker(inq, worker_factory):
+def _worker(inq, worker_factory, outq=None):
     """Scheduler's worker process main function.
+
+    Messages arrive in batches, a list of (target, message) tuples
+    per read, and None is the signal to stop. Anything returned by
+    the worker's handle_message() is sent back to the scheduler on
+    outq.
     """
     daemon.ignore_signals()
     LOG.debug('starting worker process')
     worker = worker_factory()
     while True:
         try:
-            data = inq.get()
+            batch = inq.get()
         except IOError:
             # NOTE(dhellmann): Likely caused by a signal arriving
             # during processing, especially SIGCHLD.
-            data = None
-        if data is None:
-            target, message = None, None
-        else:
-            target, message = data
+            batch = None
+        if batch is None:
+            batch = [(None, None)]
+        for target, message in batch:
+            try:
+                result = worker.handle_message(target, message)
+                if result is not None and outq is not None:
+                    outq.put(result)
+            except Exception:
+                LOG.exception(_LE('Error processing data %s'),
+                              unicode((target, message)))
+            if target is None:
+                LOG.debug('exiting')
+                return
+
+
+class BatchWriter(object):
+    """Coalesces the messages for one worker into batched writes.
+
+    Each batch is a list of (target, message) tuples put on the
+    worker's queue as a single item, so it is pickled and written
+    to the pipe once instead of once per message.
+    """
+
+    def __init__(self, queue, batch_size, pending_event=None):
+        """
+        :param queue: The worker's inbound queue.
+        :type queue: multiprocessing.JoinableQueue
+        :param batch_size: Flush as soon as this many messages are pending.
+        :type batch_size: int
+        :param pending_event: Set when a message is added to an empty batch.
+        :type pending_event: threading.Event
+        """
+        self.queue = queue
+        self.batch_size = max(batch_size, 1)
+        self._pending_event = pending_event
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, target, message):
+        with self._lock:
+            self._pending.append((target, message))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self._pending_event is not None:
+                self._pending_event.set()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def reset(self, queue):
+        """Switch to a new queue, discarding anything not yet written.
+        """
+        with self._lock:
+            self.queue = queue
+            self._pending = []
+
+    def _flush(self):
+        if self._pending:
+            batch, self._pending = self._pending, []
+            self.queue.put(batch)
+
+
+def _batch_flusher(scheduler):
+    """Flushes partial batches after a short delay.
+
+    Runs in a thread of the main process.
+    """
+    interval = cfg.CONF.ipc_batch_interval
+    while True:
+        scheduler._pending.wait()
+        scheduler._pending.clear()
+        # Give a burst of messages a chance to accumulate before
+        # writing them out.
+        time.sleep(interval)
+        scheduler.flush()
+
+
+def _worker_supervisor(scheduler):
+    """Restarts worker processes that have died.
+
+    Runs in a thread of the main process.
+    """
+    interval = cfg.CONF.worker_check_interval
+    while True:
+        time.sleep(interval)
         try:
-            worker.handle_message(target, message)
+            scheduler.check_workers()
         except Exception:
-            LOG.exception(_LE('Error processing data %s'), unicode(data))
-        if data is None:
+            LOG.exception(_LE('Error checking worker processes'))
+
+
+def _placement_rebalancer(scheduler):
+    """Periodically moves hot tenants off the busiest worker.
+
+    Runs in a thread of the main process.
+    """
+    interval = cfg.CONF.placement_rebalance_interval
+    while True:
+        time.sleep(interval)
+        try:
+            scheduler.rebalance()
+        except Exception:
+            LOG.exception(_LE('Error rebalancing tenants'))
+
+
+def _result_listener(scheduler):
+    """Handles the results sent back by the worker processes.
+
+    Runs in a thread of the main process.
+    """
+    while True:
+        try:
+            result = scheduler._results.get()
+        except IOError:
+            continue
+        if result is None:
             break
-    LOG.debug('exiting')
+        try:
+            scheduler.handle_result(result)
+        except Exception:
+            LOG.exception(_LE('Error processing worker result %s'), result)
+
+
+def _backlog(w):
+    """Returns roughly how many messages are waiting for worker w.
+    """
+    try:
+        queued = w['queue'].qsize()
+    except NotImplementedError:
+        queued = 0
+    return queued + len(w['writer'])
+
+
+def _worker_name(idx):
+    return 'p%02d' % idx
 
 
 class Dispatcher(object):
     """Choose one of the workers to receive a message.
 
-    The current implementation uses the least significant bits of the
-    UUID as an integer to shard across the worker pool.
+    Targets are placed on a consistent hash ring of the worker pool,
+    so changing the number of workers only moves the targets owned by
+    the workers being added or removed.
     """
 
-    def __init__(self, workers):
+    def __init__(self, workers, replicas=hash_ring.DEFAULT_REPLICAS,
+                 weights=None, placement=None):
+        """
+        :param workers: The workers to dispatch to.
+        :type workers: list
+        :param replicas: Number of virtual nodes per worker on the ring.
+        :type replicas: int
+        :param weights: Optional relative weights, keyed on worker name.
+        :type weights: dict
+        :param placement: Optional table of tenant placements to use
+                          instead of the hash ring.
+        :type placement: akanda.rug.placement.PlacementTable
+        """
         self.workers = workers
+        self.placement = placement
+        self._ring = hash_ring.HashRing(
+            nodes=[_worker_name(i) for i in range(len(workers))],
+            replicas=replicas,
+            weights=weights,
+        )
+        self._worker_idx = dict(
+            (_worker_name(i), i) for i in range(len(workers))
+        )
 
     def pick_workers(self, target):
         """Returns the workers that match the target.
@@ -83,59 +291,188 @@ class Dispatcher(object):
         # the workers.
         if target in commands.WILDCARDS:
             return self.workers[:]
+        key = self.target_key(target)
+        if key is None:
+            return []
+        idx = self.pick_index(key)
+        LOG.debug('target %s maps to worker %s', target, idx)
+        return [self.workers[idx]]
+
+    def target_key(self, target):
+        """Returns the normalized form of a target UUID, or None.
+        """
         try:
-            idx = uuid.UUID(target).int % len(self.workers)
-        except (TypeError, ValueError) as e:
+            return str(uuid.UUID(target.strip()))
+        except (AttributeError, TypeError, ValueError) as e:
             LOG.warning(_LW(
                 'Could not determine UUID from %r: %s, ignoring message'),
                 target, e,
             )
-            return []
-        else:
-            LOG.debug('target %s maps to worker %s', target, idx)
-        return [self.workers[idx]]
+            return None
+
+    def pick_index(self, key):
+        """Returns the index of the worker owning a normalized target.
+        """
+        if self.placement is not None:
+            return self.placement.owner(key, self.backlogs)
+        return self._worker_idx[self._ring.get_node(key)]
+
+    def backlogs(self):
+        return [_backlog(w) for w in self.workers]
 
 
 class Scheduler(object):
     """Manages a worker pool and redistributes messages.
     """
 
-    def __init__(self, worker_factory):
+    def __init__(self, worker_factory, coordinator=None):
         """
         :param num_workers: The number of worker processes to create.
         :type num_workers: int
         :param worker_func: Callable for the worker processes to use
                             when a notification is received.
         :type worker_factory: Callable to create Worker instances.
+        :param coordinator: Optional cluster coordinator deciding which
+                            tenants this node manages.
+        :type coordinator: akanda.rug.coordination.Coordinator
         """
         self.num_workers = cfg.CONF.num_worker_processes
         if self.num_workers < 1:
             raise ValueError(_('Need at least one worker process'))
+        self.worker_factory = worker_factory
         self.workers = []
+        self._pending = threading.Event()
+        self._stopping = False
+        self._results = None
+        # Tenants that have moved to another node but have not been
+        # released by our workers yet.
+        self._releasing = set()
+        self._release_lock = threading.Lock()
+        self.coordinator = coordinator
+        if coordinator is not None:
+            coordinator.on_change = self.cluster_changed
+        table = None
+        if cfg.CONF.worker_placement == 'load':
+            table = placement.PlacementTable(self.num_workers)
+        if table is not None or coordinator is not None:
+            # Workers report back when they hand off a tenant.
+            self._results = multiprocessing.Queue()
+        # The dispatcher is set up first, so a bad configuration is
+        # rejected before any worker process is started.
+        self.workers = [{} for i in range(self.num_workers)]
+        self.dispatcher = Dispatcher(
+            self.workers,
+            replicas=cfg.CONF.worker_hash_replicas,
+            weights=cfg.CONF.worker_process_weights,
+            placement=table,
+        )
         # Create several worker processes, each with its own queue for
         # sending it instructions based on the notifications we get
         # when someone calls our handle_message() method.
-        for i in range(self.num_workers):
-            wq = multiprocessing.JoinableQueue()
-            worker = multiprocessing.Process(
-                target=_worker,
-                kwargs={
-                    'inq': wq,
-                    'worker_factory': worker_factory,
-                },
-                name='p%02d' % i,
+        for i, w in enumerate(self.workers):
+            self._start_worker(i, w)
+        self._flusher = threading.Thread(
+            target=_batch_flusher,
+            args=(self,),
+            name='BatchFlusher',
+        )
+        self._flusher.setDaemon(True)
+        self._flusher.start()
+        if cfg.CONF.worker_check_interval > 0:
+            self._supervisor = threading.Thread(
+                target=_worker_supervisor,
+                args=(self,),
+                name='WorkerSupervisor',
             )
-            worker.start()
-            self.workers.append({
-                'queue': wq,
-                'worker': worker,
-            })
-        self.dispatcher = Dispatcher(self.workers)
+            self._supervisor.setDaemon(True)
+            self._supervisor.start()
+        threads = []
+        if table is not None:
+            threads.append(('PlacementRebalancer', _placement_rebalancer))
+        if self._results is not None:
+            threads.append(('WorkerResultListener', _result_listener))
+        for name, target in threads:
+            t = threading.Thread(target=target, args=(self,), name=name)
+            t.setDaemon(True)
+            t.start()
+
+    def _start_worker(self, idx, w):
+        """Start worker process idx, storing its details in the dict w.
+
+        The dict is updated in place so a restarted worker keeps its
+        place in the dispatcher and therefore its share of tenants.
+        """
+        wq = multiprocessing.JoinableQueue()
+        worker = multiprocessing.Process(
+            target=_worker,
+            kwargs={
+                'inq': wq,
+                'worker_factory': self.worker_factory,
+                'outq': self._results,
+            },
+            name=_worker_name(idx),
+        )
+        worker.start()
+        if 'writer' in w:
+            w['writer'].reset(wq)
+        else:
+            w['writer'] = BatchWriter(wq, cfg.CONF.ipc_batch_size,
+                                      self._pending)
+        w.update({
+            'queue': wq,
+            'worker': worker,
+        })
+
+    def check_workers(self):
+        """Restart any worker processes that have died.
+
+        The tenants owned by a restarted worker are re-populated so
+        its new process picks up managing them again.
+
+        :returns: The list of restarted workers.
+        """
+        if self._stopping:
+            return []
+        restarted = []
+        journals = []
+        snapshots = []
+        for idx, w in enumerate(self.workers):
+            if w['worker'].is_alive():
+                continue
+            LOG.error(_LE('worker process %s died with exit code %s, '
+                          'restarting it'),
+                      w['worker'].name, w['worker'].exitcode)
+            if cfg.CONF.journal_dir:
+                journals.extend(journal.find(
+                    cfg.CONF.journal_dir, w['worker'].name, w['worker'].pid))
+            if cfg.CONF.snapshot_dir:
+                snapshots.extend(snapshot.find(
+                    cfg.CONF.snapshot_dir, w['worker'].name, w['worker'].pid))
+            old_queue = w['queue']
+            self._start_worker(idx, w)
+            # Nothing will read the old queue again, so don't let
+            # its feeder thread block us when it is closed.
+            old_queue.cancel_join_thread()
+            old_queue.close()
+            restarted.append(w)
+        if restarted:
+            populate.repopulate_workers(self, restarted, journals,
+                                        snapshots)
+        return restarted
+
+    def flush(self):
+        """Write out any partial batches.
+        """
+        for w in self.workers:
+            w['writer'].flush()
 
     def stop(self):
         """Shutdown all workers cleanly.
         """
         LOG.info('shutting down scheduler')
+        self._stopping = True
+        # Deliver anything still waiting in a batch.
+        self.flush()
         # Send a poison pill to all of the workers
         for w in self.workers:
             LOG.debug('sending stop message to %s', w['worker'].name)
@@ -146,6 +483,8 @@ class Scheduler(object):
             w['queue'].close()
             LOG.debug('waiting for worker %s', w['worker'].name)
             w['worker'].join()
+        if self._results is not None:
+            self._results.put(None)
         LOG.info(_LI('scheduler shutdown'))
 
     def handle_message(self, target, message):
@@ -157,5 +496,147 @@ class Scheduler(object):
         :param message: Dictionary full of data to send to the target.
         :type message: dict
         """
-        for w in self.dispatcher.pick_workers(target):
-            w['queue'].put((target, message))
+        wildcard = target and target.strip() in commands.WILDCARDS
+        if (not wildcard and self.coordinator is not None and
+                not self.coordinator.owns(target)):
+            LOG.debug('ignoring message for %s, owned by another node',
+                      target)
+            return
+        table = self.dispatcher.placement
+        if table is None or wildcard:
+            for w in self.dispatcher.pick_workers(target):
+                w['writer'].put(target, message)
+            return
+        key = self.dispatcher.target_key(target)
+        if key is None:
+            return
+        # Hold the table lock so a handoff cannot start between
+        # choosing the worker and queuing the message for it.
+        with table.lock:
+            if table.hold(key, (target, message)):
+                LOG.debug('holding message for %s during handoff', key)
+                return
+            table.record(key)
+            w = self.workers[self.dispatcher.pick_index(key)]
+            w['writer'].put(target, message)
+
+    def rebalance(self):
+        """Start moving a hot tenant off the busiest worker, if needed.
+
+        The old worker is asked to hand off the tenant and, while it
+        does, new messages for the tenant are held here. Nothing is
+        moved unless the overall event rate is low.
+
+        :returns: (tenant_id, src, dst) for a started handoff, or None.
+        """
+        table = self.dispatcher.placement
+        if table is None:
+            return None
+        for tenant_id in table.expired_migrations(
+                cfg.CONF.placement_handoff_timeout):
+            LOG.warning(_LW('handoff of tenant %s timed out, leaving it '
+                            'in place'), tenant_id)
+            self._finish_handoff(tenant_id, False, [])
+        if not table.is_quiet(cfg.CONF.placement_quiet_rate):
+            return None
+        move = table.pick_migration(self.dispatcher.backlogs(),
+                                    cfg.CONF.placement_imbalance_ratio)
+        if move is None:
+            return None
+        tenant_id, src, dst = move
+        LOG.info(_LI('moving tenant %s from worker %s to %s'),
+                 tenant_id, src, dst)
+        with table.lock:
+            table.start_migration(tenant_id, dst)
+            msg = event.Event(
+                resource=event.Resource(driver='*', id='*',
+                                        tenant_id=tenant_id),
+                crud=event.COMMAND,
+                body={'command': commands.TENANT_HANDOFF,
+                      'tenant_id': tenant_id},
+            )
+            writer = self.workers[src]['writer']
+            writer.put(tenant_id, msg)
+            writer.flush()
+        return move
+
+    def handle_result(self, result):
+        """Called with the results sent back by the worker processes.
+        """
+        if result.get('command') != commands.TENANT_HANDOFF:
+            LOG.warning(_LW('Unrecognized worker result: %s'), result)
+            return
+        tenant_id = result['tenant_id']
+        with self._release_lock:
+            if tenant_id in self._releasing:
+                if result['released']:
+                    LOG.info(_LI('released tenant %s to another node'),
+                             tenant_id)
+                    self._releasing.discard(tenant_id)
+                return
+        if self.dispatcher.placement is not None:
+            self._finish_handoff(tenant_id,
+                                 result['released'],
+                                 result['resources'])
+
+    def cluster_changed(self, old_ring, new_ring):
+        """Called by the coordinator when nodes join or leave the cluster.
+
+        Resources of the tenants this node gained are polled so they
+        get state machines here, and the tenants it lost are released
+        by the workers.
+        """
+        with self._release_lock:
+            self._releasing = set(
+                t for t in self._releasing
+                if not self.coordinator.owns(t, new_ring)
+            )
+        populate.rebalance_cluster(self, old_ring, new_ring)
+
+    def release_tenant(self, tenant_id):
+        """Ask the workers to stop managing a tenant owned by another node.
+
+        Workers only let go of idle tenants, so the request is repeated
+        by retry_releases() until it succeeds.
+        """
+        with self._release_lock:
+            self._releasing.add(tenant_id)
+        msg = event.Event(
+            resource=event.Resource(driver='*', id='*', tenant_id=tenant_id),
+            crud=event.COMMAND,
+            body={'command': commands.TENANT_HANDOFF,
+                  'tenant_id': tenant_id},
+        )
+        for w in self.dispatcher.pick_workers(tenant_id):
+            w['writer'].put(tenant_id, msg)
+
+    def retry_releases(self):
+        """Repeat the release of tenants the workers still hold.
+
+        :returns: The number of tenants still waiting to be released.
+        """
+        with self._release_lock:
+            pending = list(self._releasing)
+        for tenant_id in pending:
+            self.release_tenant(tenant_id)
+        return len(pending)
+
+    def _finish_handoff(self, tenant_id, released, resources):
+        table = self.dispatcher.placement
+        with table.lock:
+            held = table.finish_migration(tenant_id, released)
+            if released:
+                LOG.info(_LI('tenant %s handed off with %d resources'),
+                         tenant_id, len(resources))
+            else:
+                LOG.info(_LI('tenant %s was busy and was not moved'),
+                         tenant_id)
+            # Have the tenant's current owner pick its resources back
+            # up, then deliver everything that arrived in the meantime.
+            for resource in resources:
+                self.handle_message(
+                    tenant_id,
+                    event.Event(resource=resource, crud=event.POLL, body={}),
+                )
+            for target, message in held:
+                self.handle_message(target, message)
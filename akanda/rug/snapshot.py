@@ -0,0 +1,132 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Local snapshots of what a worker's state machines know.
+"""
+
+import glob
+import json
+import os
+import time
+import uuid
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from akanda.rug.common.i18n import _LW
+
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOT_OPTS = [
+    cfg.StrOpt(
+        'snapshot_dir',
+        default='',
+        help='directory where worker processes save what their state '
+             'machines know about the resources, so after a restart '
+             'they are not all looked up again. Restored resources are '
+             'not polled at startup. Leave empty to disable snapshots, '
+             'e.g. /var/lib/akanda-rug/snapshots to enable them.'),
+    cfg.IntOpt(
+        'snapshot_interval',
+        default=300,
+        help='seconds between the snapshots taken by each worker '
+             'process'),
+    cfg.IntOpt(
+        'snapshot_max_age',
+        default=3600,
+        help='snapshots older than this many seconds are ignored at '
+             'startup, and their resources are looked up again'),
+]
+cfg.CONF.register_opts(SNAPSHOT_OPTS)
+
+SUFFIX = '.snapshot'
+
+
+def snapshot_path(directory, name, pid):
+    """Returns a new snapshot file for a worker process.
+
+    The name is unique, since a restarted worker often gets the same
+    pid as the one before it, whose snapshot is still to be restored.
+    """
+    return os.path.join(
+        directory, '%s-%d-%s%s' % (name, pid, uuid.uuid4().hex, SUFFIX))
+
+
+def write(path, records):
+    """Replace the snapshot at path with records.
+
+    The new snapshot is written next to the old one and renamed over
+    it, so a process stopping part way through leaves the old one.
+
+    :param records: JSON serializable dicts, one per resource.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def load(paths, max_age=None):
+    """Read the snapshots left by earlier processes.
+
+    :param max_age: Snapshots written more than this many seconds ago
+                    are skipped.
+    :returns: A list of records, the one from the newest snapshot for
+              each resource.
+    """
+    now = time.time()
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            LOG.debug('no snapshot at %s', path)
+    records = {}
+    # Oldest first, so newer records replace older ones.
+    for path in sorted(mtimes, key=mtimes.get):
+        if max_age and now - mtimes[path] > max_age:
+            LOG.info('Ignoring stale snapshot %s', path)
+            continue
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        LOG.warning(_LW('Skipping bad record in %s'), path)
+                        continue
+                    records[record['resource_id']] = record
+        except IOError as err:
+            LOG.warning(_LW('Could not read snapshot %s: %s'), path, err)
+    return list(records.values())
+
+
+def find(directory, name=None, pid=None):
+    """Returns the snapshot files in directory.
+
+    :param name: Only return the snapshots of the worker process with
+                 this name and pid.
+    """
+    if name is None:
+        pattern = '*' + SUFFIX
+    else:
+        pattern = '%s-%d-*%s' % (name, pid, SUFFIX)
+    return glob.glob(os.path.join(directory, pattern))
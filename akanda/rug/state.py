@@ -23,7 +23,8 @@
 # http://akanda.readthedocs.org/en/latest/rug.html#state-machine-workers-and-router-lifecycle
 
 import collections
-import itertools
+from logging import DEBUG, INFO, WARNING
+import time
 
 from akanda.rug.common.i18n import _LE, _LI, _LW
 from akanda.rug.event import POLL, CREATE, READ, UPDATE, DELETE, REBUILD
@@ -31,6 +32,74 @@ from akanda.rug import instance_manager
 from akanda.rug.drivers import states
 
 
+class Inbox(object):
+    """The actions waiting for a state machine.
+
+    The rules CalcAction uses to collapse actions are applied as each
+    action arrives, so the inbox holds at most one of each action no
+    matter how many messages come in:
+
+    - a POLL is only kept when nothing else is waiting, because any
+      other action checks on the resource as well;
+    - a CREATE replaces an UPDATE just before it, and an UPDATE just
+      after a CREATE is dropped, because creating implies updating;
+    - a REBUILD replaces a CREATE or UPDATE just before it;
+    - an action that is already waiting is dropped, because it has
+      not started yet and sees the latest state when it runs.
+    """
+
+    def __init__(self, actions=()):
+        self._actions = self._collapse(actions)
+
+    @staticmethod
+    def _collapse(actions):
+        result = []
+        for action in actions:
+            if action == POLL:
+                continue
+            while result and (
+                    (result[-1] == UPDATE and action == CREATE) or
+                    (result[-1] in (CREATE, UPDATE) and action == REBUILD)):
+                result.pop()
+            if result and result[-1] == CREATE and action == UPDATE:
+                continue
+            if action not in result:
+                result.append(action)
+        if not result and actions:
+            # Only polls were waiting.
+            result.append(POLL)
+        return result
+
+    def __len__(self):
+        return len(self._actions)
+
+    def __iter__(self):
+        return iter(self._actions)
+
+    def __contains__(self, action):
+        return action in self._actions
+
+    def __getitem__(self, index):
+        return self._actions[index]
+
+    def __repr__(self):
+        return 'Inbox(%r)' % self._actions
+
+    def append(self, action):
+        self._actions = self._collapse(self._actions + [action])
+
+    def appendleft(self, action):
+        self._actions = self._collapse([action] + self._actions)
+
+    def popleft(self):
+        if not self._actions:
+            raise IndexError('pop from an empty inbox')
+        return self._actions.pop(0)
+
+    def clear(self):
+        self._actions = []
+
+
 class StateParams(object):
     def __init__(self, driver, instance, queue, bandwidth_callback,
                  reboot_error_threshold):
@@ -41,6 +110,32 @@ class StateParams(object):
         self.bandwidth_callback = bandwidth_callback
         self.reboot_error_threshold = reboot_error_threshold
         self.image_uuid = driver.image_uuid
+        self._states = {}
+
+    def state(self, state_cls):
+        """Returns the state machine's one instance of a State class.
+
+        States keep nothing between visits, so each state machine
+        creates them once instead of on every transition.
+        """
+        try:
+            return self._states[state_cls]
+        except KeyError:
+            st = self._states[state_cls] = state_cls(self)
+            return st
+
+
+def _shared_state(params, state_cls):
+    """Returns the state machine's instance of state_cls.
+
+    Params that do not keep their states, such as a stand-in for
+    StateParams, get a new one, so a state machine always moves to a
+    real State.
+    """
+    st = params.state(state_cls)
+    if not isinstance(st, State):
+        st = state_cls(params)
+    return st
 
 
 class State(object):
@@ -75,43 +170,67 @@ class State(object):
         return action
 
     def transition(self, action, worker_context):
-        return self
+        """Returns the next state, as given by TRANSITIONS.
+        """
+        cls = type(self)
+        params = self.params
+        instance_state = params.instance.state
+        try:
+            next_cls, then_cls = TRANSITIONS[cls, action, instance_state]
+        except (KeyError, TypeError):
+            # An action or instance state the table was not compiled
+            # for, so apply the rules to it directly.
+            next_cls, then_cls = _match(cls, action, instance_state)
+        if then_cls is not None:
+            next_state = _shared_state(params, next_cls)
+            next_state._next_state = _shared_state(params, then_cls)
+            return next_state
+        if next_cls is None or next_cls is cls:
+            return self
+        return _shared_state(params, next_cls)
 
 
 class CalcAction(State):
     def execute(self, action, worker_context):
         queue = self.queue
+        log = self.log
         if DELETE in queue:
-            self.params.driver.log.debug('shortcutting to delete')
+            log.debug('shortcutting to delete')
             return DELETE
 
+        # Checked once, since this runs at every step of every
+        # traversal and the lines below are rarely wanted.
+        debug = log.isEnabledFor(DEBUG)
         while queue:
-            self.params.driver.log.debug(
-                'action = %s, len(queue) = %s, queue = %s',
-                action,
-                len(queue),
-                list(itertools.islice(queue, 0, 60))
-            )
+            if debug:
+                log.debug(
+                    'action = %s, len(queue) = %s, queue = %s',
+                    action,
+                    len(queue),
+                    list(queue)
+                )
 
             if action == UPDATE and queue[0] == CREATE:
                 # upgrade to CREATE from UPDATE by taking the next
                 # item from the queue
-                self.params.driver.log.debug('upgrading from update to create')
+                if debug:
+                    log.debug('upgrading from update to create')
                 action = queue.popleft()
                 continue
 
             elif action in (CREATE, UPDATE) and queue[0] == REBUILD:
                 # upgrade to REBUILD from CREATE/UPDATE by taking the next
                 # item from the queue
-                self.params.driver.log.debug('upgrading from %s to rebuild',
-                                             action)
+                if debug:
+                    log.debug('upgrading from %s to rebuild', action)
                 action = queue.popleft()
                 continue
 
             elif action == CREATE and queue[0] == UPDATE:
                 # CREATE implies an UPDATE so eat the update event
                 # without changing the action
-                self.params.driver.log.debug('merging create and update')
+                if debug:
+                    log.debug('merging create and update')
                 queue.popleft()
                 continue
 
@@ -119,9 +238,9 @@ class CalcAction(State):
                 # Throw away a poll following any other valid action,
                 # because a create or update will automatically handle
                 # the poll and repeated polls are not needed.
-                self.params.driver.log.debug('discarding poll event following '
-                                             'action %s',
-                                             action)
+                if debug:
+                    log.debug('discarding poll event following action %s',
+                              action)
                 queue.popleft()
                 continue
 
@@ -129,46 +248,27 @@ class CalcAction(State):
                 # We are not polling and the next action is something
                 # different from what we are doing, so just do the
                 # current action.
-                self.params.driver.log.debug('done collapsing events')
+                if debug:
+                    log.debug('done collapsing events')
                 break
 
-            self.params.driver.log.debug('popping action from queue')
+            if debug:
+                log.debug('popping action from queue')
             action = queue.popleft()
 
         return action
 
     def transition(self, action, worker_context):
-        if self.instance.state == states.GONE:
-            next_action = StopInstance(self.params)
-        elif action == DELETE:
-            next_action = StopInstance(self.params)
-        elif action == REBUILD:
-            next_action = RebuildInstance(self.params)
-        elif self.instance.state == states.BOOTING:
-            next_action = CheckBoot(self.params)
-        elif self.instance.state == states.DOWN:
-            next_action = CreateInstance(self.params)
-        else:
-            next_action = Alive(self.params)
-        if self.instance.state == states.ERROR:
-            if action == POLL:
-                # If the selected action is to poll, and we are in an
-                # error state, then an event slipped through the
-                # filter in send_message() and we should ignore it
-                # here.
-                next_action = self
-            elif self.instance.error_cooldown:
-                    self.params.driver.log.debug(
-                        'Resource is in ERROR cooldown, '
-                        'ignoring event.'
-                    )
-                    next_action = self
-            else:
-                # If this isn't a POLL, and the configured `error_cooldown`
-                # has passed, clear the error status before doing what we
-                # really want to do.
-                next_action = ClearError(self.params, next_action)
-        return next_action
+        next_state = super(CalcAction, self).transition(action,
+                                                        worker_context)
+        if (isinstance(next_state, ClearError) and
+                self.instance.error_cooldown):
+            self.params.driver.log.debug(
+                'Resource is in ERROR cooldown, '
+                'ignoring event.'
+            )
+            return self
+        return next_state
 
 
 class PushUpdate(State):
@@ -179,9 +279,6 @@ class PushUpdate(State):
         self.queue.appendleft(UPDATE)
         return action
 
-    def transition(self, action, worker_context):
-        return CalcAction(self.params)
-
 
 class ClearError(State):
     """Remove the error state from the instance.
@@ -200,7 +297,7 @@ class ClearError(State):
     def transition(self, action, worker_context):
         if self._next_state:
             return self._next_state
-        return CalcAction(self.params)
+        return super(ClearError, self).transition(action, worker_context)
 
 
 class Alive(State):
@@ -208,20 +305,6 @@ class Alive(State):
         self.instance.update_state(worker_context)
         return action
 
-    def transition(self, action, worker_context):
-        if self.instance.state == states.GONE:
-            return StopInstance(self.params)
-        elif self.instance.state == states.DOWN:
-            return CreateInstance(self.params)
-        elif action == POLL and \
-                self.instance.state == states.CONFIGURED:
-            return CalcAction(self.params)
-        elif action == READ and \
-                self.instance.state == states.CONFIGURED:
-            return ReadStats(self.params)
-        else:
-            return ConfigureInstance(self.params)
-
 
 class CreateInstance(State):
     def execute(self, action, worker_context):
@@ -239,15 +322,6 @@ class CreateInstance(State):
                                      self.params.reboot_error_threshold)
         return action
 
-    def transition(self, action, worker_context):
-        if self.instance.state == states.GONE:
-            return StopInstance(self.params)
-        elif self.instance.state == states.ERROR:
-            return CalcAction(self.params)
-        elif self.instance.state == states.DOWN:
-            return CreateInstance(self.params)
-        return CheckBoot(self.params)
-
 
 class CheckBoot(State):
     def execute(self, action, worker_context):
@@ -260,27 +334,12 @@ class CheckBoot(State):
             self.queue.appendleft(action)
         return action
 
-    def transition(self, action, worker_context):
-        if self.instance.state == states.REPLUG:
-            return ReplugInstance(self.params)
-        if self.instance.state in (states.DOWN,
-                                   states.GONE):
-            return StopInstance(self.params)
-        if self.instance.state == states.UP:
-            return ConfigureInstance(self.params)
-        return CalcAction(self.params)
-
 
 class ReplugInstance(State):
     def execute(self, action, worker_context):
         self.instance.replug(worker_context)
         return action
 
-    def transition(self, action, worker_context):
-        if self.instance.state == states.RESTART:
-            return StopInstance(self.params)
-        return ConfigureInstance(self.params)
-
 
 class StopInstance(State):
     def execute(self, action, worker_context):
@@ -291,16 +350,6 @@ class StopInstance(State):
             return DELETE
         return action
 
-    def transition(self, action, worker_context):
-        if self.instance.state not in (states.DOWN,
-                                       states.GONE):
-            return self
-        if self.instance.state == states.GONE:
-            return Exit(self.params)
-        if action == DELETE:
-            return Exit(self.params)
-        return CreateInstance(self.params)
-
 
 class RebuildInstance(State):
     def execute(self, action, worker_context):
@@ -313,14 +362,6 @@ class RebuildInstance(State):
         self.instance.reset_boot_counter()
         return CREATE
 
-    def transition(self, action, worker_context):
-        if self.instance.state not in (states.DOWN,
-                                       states.GONE):
-            return self
-        if self.instance.state == states.GONE:
-            return Exit(self.params)
-        return CreateInstance(self.params)
-
 
 class Exit(State):
     pass
@@ -337,20 +378,6 @@ class ConfigureInstance(State):
         else:
             return action
 
-    def transition(self, action, worker_context):
-        if self.instance.state == states.REPLUG:
-            return ReplugInstance(self.params)
-        if self.instance.state in (states.RESTART,
-                                   states.DOWN,
-                                   states.GONE):
-            return StopInstance(self.params)
-        if self.instance.state == states.UP:
-            return PushUpdate(self.params)
-        # Below here, assume instance.state == states.CONFIGURED
-        if action == READ:
-            return ReadStats(self.params)
-        return CalcAction(self.params)
-
 
 class ReadStats(State):
     def execute(self, action, worker_context):
@@ -358,17 +385,141 @@ class ReadStats(State):
         self.params.bandwidth_callback(stats)
         return POLL
 
-    def transition(self, action, worker_context):
-        return CalcAction(self.params)
+
+# Any action or instance state.
+ANY = None
+
+# The transitions out of each state, tried in order until one matches
+# the action and instance state. Each rule is (state, actions,
+# instance states, next state, and for ClearError the state to go to
+# once the error is cleared).
+RULES = [
+    # If the selected action is to poll, and we are in an error
+    # state, then an event slipped through the filter in
+    # Automaton.send_message() and we should ignore it here. Other
+    # actions clear the error status, unless the error cooldown has
+    # not passed yet, before doing what we really want to do.
+    (CalcAction, (POLL,), (states.ERROR,), CalcAction, None),
+    (CalcAction, (DELETE,), (states.ERROR,), ClearError, StopInstance),
+    (CalcAction, (REBUILD,), (states.ERROR,), ClearError, RebuildInstance),
+    (CalcAction, ANY, (states.ERROR,), ClearError, Alive),
+    (CalcAction, ANY, (states.GONE,), StopInstance, None),
+    (CalcAction, (DELETE,), ANY, StopInstance, None),
+    (CalcAction, (REBUILD,), ANY, RebuildInstance, None),
+    (CalcAction, ANY, (states.BOOTING,), CheckBoot, None),
+    (CalcAction, ANY, (states.DOWN,), CreateInstance, None),
+    (CalcAction, ANY, ANY, Alive, None),
+
+    (PushUpdate, ANY, ANY, CalcAction, None),
+
+    (ClearError, ANY, ANY, CalcAction, None),
+
+    (Alive, ANY, (states.GONE,), StopInstance, None),
+    (Alive, ANY, (states.DOWN,), CreateInstance, None),
+    (Alive, (POLL,), (states.CONFIGURED,), CalcAction, None),
+    (Alive, (READ,), (states.CONFIGURED,), ReadStats, None),
+    (Alive, ANY, ANY, ConfigureInstance, None),
+
+    (CreateInstance, ANY, (states.GONE,), StopInstance, None),
+    (CreateInstance, ANY, (states.ERROR,), CalcAction, None),
+    (CreateInstance, ANY, (states.DOWN,), CreateInstance, None),
+    (CreateInstance, ANY, ANY, CheckBoot, None),
+
+    (CheckBoot, ANY, (states.REPLUG,), ReplugInstance, None),
+    (CheckBoot, ANY, (states.DOWN, states.GONE), StopInstance, None),
+    (CheckBoot, ANY, (states.UP,), ConfigureInstance, None),
+    (CheckBoot, ANY, ANY, CalcAction, None),
+
+    (ReplugInstance, ANY, (states.RESTART,), StopInstance, None),
+    (ReplugInstance, ANY, ANY, ConfigureInstance, None),
+
+    (StopInstance, ANY, (states.GONE,), Exit, None),
+    (StopInstance, (DELETE,), (states.DOWN,), Exit, None),
+    (StopInstance, ANY, (states.DOWN,), CreateInstance, None),
+    (StopInstance, ANY, ANY, StopInstance, None),
+
+    (RebuildInstance, ANY, (states.GONE,), Exit, None),
+    (RebuildInstance, ANY, (states.DOWN,), CreateInstance, None),
+    (RebuildInstance, ANY, ANY, RebuildInstance, None),
+
+    (ConfigureInstance, ANY, (states.REPLUG,), ReplugInstance, None),
+    (ConfigureInstance, ANY, (states.RESTART, states.DOWN, states.GONE),
+     StopInstance, None),
+    (ConfigureInstance, ANY, (states.UP,), PushUpdate, None),
+    (ConfigureInstance, (READ,), ANY, ReadStats, None),
+    (ConfigureInstance, ANY, ANY, CalcAction, None),
+
+    (ReadStats, ANY, ANY, CalcAction, None),
+]
+
+ACTIONS = (POLL, CREATE, READ, UPDATE, DELETE, REBUILD)
+INSTANCE_STATES = (states.DOWN, states.BOOTING, states.UP, states.CONFIGURED,
+                   states.RESTART, states.REPLUG, states.GONE, states.ERROR)
+
+
+def _match(state_cls, action, instance_state):
+    for cls, actions, instance_states, next_cls, then_cls in RULES:
+        if (cls is state_cls and
+                (actions is ANY or action in actions) and
+                (instance_states is ANY or
+                 instance_state in instance_states)):
+            return next_cls, then_cls
+    return None, None
+
+
+def _compile(rules):
+    table = {}
+    for state_cls in set(rule[0] for rule in rules):
+        for action in ACTIONS:
+            for instance_state in INSTANCE_STATES:
+                table[state_cls, action, instance_state] = _match(
+                    state_cls, action, instance_state)
+    return table
+
+
+# (state, action, instance state) -> (next state, state after ClearError)
+TRANSITIONS = _compile(RULES)
+
+
+def dot_graph():
+    """Returns the transition table as a graphviz digraph.
+
+    Each edge is labelled with the actions and instance states it is
+    taken for, '*' standing for any.
+    """
+    def _label(values):
+        return '*' if values is ANY else ','.join(values)
+
+    lines = ['digraph state_machine {']
+    for cls, actions, instance_states, next_cls, then_cls in RULES:
+        label = '%s / %s' % (_label(actions), _label(instance_states))
+        if then_cls is not None:
+            label += ' (then %s)' % then_cls.__name__
+        lines.append('    %s -> %s [label="%s"];' %
+                     (cls.__name__, next_cls.__name__, label))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+# One step of a state machine traversal, as kept in its trace.
+Transition = collections.namedtuple(
+    'Transition',
+    ['timestamp', 'state', 'action', 'instance_state', 'duration'],
+)
+
+DEFAULT_TRACE_SIZE = 32
 
 
 class Automaton(object):
     def __init__(self, driver, resource_id, tenant_id,
                  delete_callback, bandwidth_callback,
                  worker_context, queue_warning_threshold,
-                 reboot_error_threshold):
+                 reboot_error_threshold, state_callback=None,
+                 trace_size=DEFAULT_TRACE_SIZE, snapshot=None):
         """
-        :param driver: An instantiated driver object for the managed resource
+        :param driver: An instantiated driver object for the managed
+                       resource. If worker_context is None, the driver's
+                       post_init() has not been called yet.
         :param resource_id: UUID of the resource being managed
         :type resource_id: str
         :param tenant_id: UUID of the tenant being managed
@@ -380,7 +531,9 @@ class Automaton(object):
                                    report how much bandwidth a router has used.
         :type bandwidth_callback: callable taking router_id and bandwidth
                                   info dict
-        :param worker_context: a WorkerContext
+        :param worker_context: a WorkerContext, or None to leave looking
+                               up the resource and its instance to the
+                               first update().
         :type worker_context: WorkerContext
         :param queue_warning_threshold: Limit after which adding items
                                         to the queue triggers a warning.
@@ -388,6 +541,17 @@ class Automaton(object):
         :param reboot_error_threshold: Limit after which trying to reboot
                                        the router puts it into an error state.
         :type reboot_error_threshold: int
+        :param state_callback: Invoked with the resource id and the new
+                               instance state when the instance's state
+                               changes.
+        :type state_callback: callable
+        :param trace_size: Number of recent transitions to keep for
+                           diagnostics.
+        :type trace_size: int
+        :param snapshot: What an earlier process knew about the
+                         resource's instance, to start from instead of
+                         looking it up.
+        :type snapshot: dict
         """
         self.driver = driver
         self.resource_id = resource_id
@@ -397,12 +561,37 @@ class Automaton(object):
         self._reboot_error_threshold = reboot_error_threshold
         self.deleted = False
         self.bandwidth_callback = bandwidth_callback
-        self._queue = collections.deque()
+        self._queue = Inbox()
+        # Recent transitions, kept as plain tuples so recording one
+        # costs little more than the append.
+        self._trace = collections.deque(maxlen=trace_size)
+        # When the state machine last received anything but a poll.
+        self.last_active = time.time()
 
         self.action = POLL
-        self.instance = instance_manager.InstanceManager(self.driver,
-                                                         self.resource_id,
-                                                         worker_context)
+        self._state_callback = state_callback
+        self._snapshot = snapshot
+        # An image asked for by a REBUILD before initialization.
+        self._image_uuid = None
+        self.instance = None
+        self._state_params = None
+        self.state = None
+        if worker_context is not None:
+            self._initialize(worker_context)
+
+    @property
+    def initialized(self):
+        return self.instance is not None
+
+    def _initialize(self, worker_context):
+        self.instance = instance_manager.InstanceManager(
+            self.driver,
+            self.resource_id,
+            worker_context,
+            state_callback=self._state_callback,
+            snapshot=self._snapshot,
+        )
+        self._snapshot = None
         self._state_params = StateParams(
             self.driver,
             self.instance,
@@ -410,7 +599,44 @@ class Automaton(object):
             self.bandwidth_callback,
             self._reboot_error_threshold,
         )
-        self.state = CalcAction(self._state_params)
+        if self._image_uuid is not None:
+            self._state_params.image_uuid = self._image_uuid
+            self._image_uuid = None
+        self.state = self._state_params.state(CalcAction)
+
+    def _lazy_initialize(self, worker_context):
+        """Look up the resource and its instance for a state machine
+        created without a worker context.
+
+        This makes the calls to neutron and nova that used to be made
+        while the message was dispatched, so it happens on a worker
+        thread instead. If it fails, the queued work is dropped and it
+        is tried again with the next message.
+
+        :returns: True if the state machine is ready to run.
+        """
+        try:
+            self.driver.post_init(worker_context)
+            self._initialize(worker_context)
+        except Exception:
+            self.driver.log.exception(
+                _LE('could not initialize state machine for %s, '
+                    'dropping %s'),
+                self.resource_id,
+                sorted(self._queue),
+            )
+            self.instance = None
+            self._queue.clear()
+            return False
+        return True
+
+    def snapshot(self):
+        """Returns what the state machine knows about its instance, for
+        InstanceManager to start from in a later process.
+        """
+        if self.instance is None:
+            return self._snapshot
+        return self.instance.snapshot()
 
     def service_shutdown(self):
         "Called when the parent process is being stopped"
@@ -426,6 +652,9 @@ class Automaton(object):
 
     def update(self, worker_context):
         "Called when the router config should be changed"
+        if self.instance is None and not self.deleted:
+            if not self._lazy_initialize(worker_context):
+                return
         while self._queue:
             while True:
                 if self.deleted:
@@ -434,19 +663,12 @@ class Automaton(object):
                     )
                     return
 
+                started = time.time()
                 try:
-                    self.driver.log.debug('%s.execute(%s) instance.state=%s',
-                                          self.state,
-                                          self.action,
-                                          self.instance.state)
                     self.action = self.state.execute(
                         self.action,
                         worker_context,
                     )
-                    self.driver.log.debug('%s.execute -> %s instance.state=%s',
-                                          self.state,
-                                          self.action,
-                                          self.instance.state)
                 except:
                     self.driver.log.exception(
                         _LE('%s.execute() failed for action: %s'),
@@ -459,13 +681,9 @@ class Automaton(object):
                     self.action,
                     worker_context,
                 )
-                self.driver.log.debug(
-                    '%s.transition(%s) -> %s instance.state=%s',
-                    old_state,
-                    self.action,
-                    self.state,
-                    self.instance.state
-                )
+                self._trace.append((started, old_state, self.action,
+                                    self.instance.state,
+                                    time.time() - started))
 
                 # Yield control each time we stop to figure out what
                 # to do next.
@@ -493,14 +711,21 @@ class Automaton(object):
         # down on the number of times a worker thread wakes up to
         # process something on a router that isn't going to actually
         # do any work.
-        if message.crud == POLL and \
-                self.instance.state == states.ERROR:
-            self.driver.log.info(_LI(
-                'Resource status is ERROR, ignoring POLL message: %s'),
+        if message.crud == POLL and self.has_error():
+            self.driver.log.log_limited(
+                INFO, 'error_poll',
+                _LI('Resource status is ERROR, ignoring POLL message: %s'),
                 message,
             )
             return False
 
+        if message.crud == POLL and self._queue:
+            # Any work already waiting checks on the resource as well,
+            # so the poll would be discarded by CalcAction anyway.
+            self.driver.log.debug(
+                'work already queued, ignoring POLL message: %s', message)
+            return False
+
         if message.crud == REBUILD:
             if message.body.get('image_uuid'):
                 self.driver.log.info(_LI(
@@ -511,26 +736,51 @@ class Automaton(object):
             else:
                 self.image_uuid = self.driver.image_uuid
 
+        if message.crud != POLL:
+            self.last_active = time.time()
         self._queue.append(message.crud)
         queue_len = len(self._queue)
         if queue_len > self._queue_warning_threshold:
-            logger = self.driver.log.warning
+            self.driver.log.log_limited(
+                WARNING, 'queue_length',
+                _LW('incoming message brings queue length to %s'),
+                queue_len,
+            )
         else:
-            logger = self.driver.log.debug
-        logger(_LW('incoming message brings queue length to %s'), queue_len)
+            self.driver.log.debug(
+                'incoming message brings queue length to %s', queue_len)
         return True
 
     @property
     def image_uuid(self):
+        if self._state_params is None:
+            return self._image_uuid or self.driver.image_uuid
         return self.state.params.image_uuid
 
     @image_uuid.setter
     def image_uuid(self, value):
-        self.state.params.image_uuid = value
+        if self._state_params is None:
+            self._image_uuid = value
+        else:
+            self.state.params.image_uuid = value
+
+    def trace(self):
+        """Returns the recent transitions, oldest first, as Transitions.
+        """
+        return [
+            Transition(started, str(st), action, instance_state, duration)
+            for started, st, action, instance_state, duration
+            in list(self._trace)
+        ]
+
+    def pending_actions(self):
+        "Returns the distinct actions waiting in the state machine queue"
+        return set(self._queue)
 
     def has_more_work(self):
         "Called to check if there are more messages in the state machine queue"
         return (not self.deleted) and bool(self._queue)
 
     def has_error(self):
-        return self.instance.state == states.ERROR
+        return (self.instance is not None and
+                self.instance.state == states.ERROR)
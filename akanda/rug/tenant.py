@@ -20,12 +20,18 @@
 
 import collections
 import threading
+import time
 
 from oslo_log import log as logging
 
 from akanda.rug.common.i18n import _LE
+from akanda.rug import event
+from akanda.rug import health
+from akanda.rug import resource_index
 from akanda.rug import state
+from akanda.rug import tombstones
 from akanda.rug import drivers
+from akanda.rug.drivers import states
 from akanda.rug.openstack.common import timeutils
 
 
@@ -36,17 +42,66 @@ class InvalidIncomingMessage(Exception):
     pass
 
 
+# What is kept of an idle state machine once it has been set aside to
+# save memory, until a message for its resource brings it back. The
+# resources restored from a snapshot taken by an earlier process also
+# keep what that process knew about their instance, so their state
+# machines start from it.
+DormantResource = collections.namedtuple(
+    'DormantResource',
+    ['resource_id', 'tenant_id', 'driver', 'state', 'config_digest',
+     'last_active', 'snapshot'],
+)
+
+
 class ResourceContainer(object):
 
-    def __init__(self):
+    def __init__(self, index=None, deleted=None):
+        """
+        :param index: The index that state machines added to or deleted
+                      from this container are also added to or removed
+                      from. It may be shared with other containers.
+        :type index: akanda.rug.resource_index.ResourceIndex
+        :param deleted: Where the resources deleted from this container
+                        are remembered. It may be shared with other
+                        containers.
+        :type deleted: akanda.rug.tombstones.Tombstones
+        """
         self.state_machines = {}
-        self.deleted = collections.deque(maxlen=50)
+        self.dormant = {}
+        self.deleted = deleted if deleted is not None else \
+            tombstones.Tombstones()
         self.lock = threading.Lock()
+        self.index = index if index is not None else \
+            resource_index.ResourceIndex()
+        # The resource ids polled in each slice of the health check
+        # period, for the number of slices the last poll used, so a
+        # poll does not have to work out the slice of every resource.
+        self._poll_slots = None
+        self._slot_members = {}
+
+    def _add_to_slot(self, resource_id):
+        if self._poll_slots is not None:
+            slot = health.poll_slot(resource_id, self._poll_slots)
+            self._slot_members.setdefault(slot, set()).add(resource_id)
+
+    def _remove_from_slot(self, resource_id):
+        if self._poll_slots is not None:
+            slot = health.poll_slot(resource_id, self._poll_slots)
+            members = self._slot_members.get(slot)
+            if members is not None:
+                members.discard(resource_id)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.state_machines) + len(self.dormant)
 
     def __delitem__(self, item):
         with self.lock:
             del self.state_machines[item]
-            self.deleted.append(item)
+            self._remove_from_slot(item)
+            self.deleted.add(item)
+            self.index.remove(item)
 
     def items(self):
         """Get all state machines.
@@ -65,8 +120,7 @@ class ResourceContainer(object):
         :param resource_id: The resource's id to check against the deleted list
         :returns: Returns True if the resource_id has been deleted.
         """
-        with self.lock:
-            return resource_id in self.deleted
+        return resource_id in self.deleted
 
     def __getitem__(self, item):
         with self.lock:
@@ -74,7 +128,49 @@ class ResourceContainer(object):
 
     def __setitem__(self, key, value):
         with self.lock:
+            if self.dormant.pop(key, None) is None:
+                self._add_to_slot(key)
             self.state_machines[key] = value
+            self.index.add(value)
+
+    def make_dormant(self, record):
+        """Replace a state machine with its compact record.
+        """
+        with self.lock:
+            if self.state_machines.pop(record.resource_id, None) is None:
+                self._add_to_slot(record.resource_id)
+            self.dormant[record.resource_id] = record
+            self.index.add_dormant(record)
+
+    def get_dormant(self, resource_id):
+        with self.lock:
+            return self.dormant.get(resource_id)
+
+    def dormant_records(self):
+        with self.lock:
+            return list(self.dormant.values())
+
+    def in_poll_slot(self, slot, slots):
+        """Returns the state machines and the dormant records of the
+        resources polled in a slice of the health check period.
+
+        :param slot: The slice being polled.
+        :param slots: The number of slices in the period.
+        """
+        with self.lock:
+            if slots != self._poll_slots:
+                self._poll_slots = slots
+                self._slot_members = {}
+                for resource_id in self.state_machines:
+                    self._add_to_slot(resource_id)
+                for resource_id in self.dormant:
+                    self._add_to_slot(resource_id)
+            members = self._slot_members.get(slot, ())
+            return (
+                [self.state_machines[r] for r in members
+                 if r in self.state_machines],
+                [self.dormant[r] for r in members if r in self.dormant],
+            )
 
     def __contains__(self, item):
         with self.lock:
@@ -88,22 +184,131 @@ class TenantResourceManager(object):
 
     def __init__(self, tenant_id, notify_callback,
                  queue_warning_threshold,
-                 reboot_error_threshold):
+                 reboot_error_threshold,
+                 resource_index=None,
+                 trace_size=state.DEFAULT_TRACE_SIZE,
+                 tombstones=None):
         self.tenant_id = tenant_id
         self.notify = notify_callback
         self._queue_warning_threshold = queue_warning_threshold
         self._reboot_error_threshold = reboot_error_threshold
-        self.state_machines = ResourceContainer()
+        self._trace_size = trace_size
+        self.state_machines = ResourceContainer(resource_index, tombstones)
         self._default_resource_id = None
+        # When the tenant last received anything but a poll.
+        self.last_active = time.time()
+        # The last activity of the dormant resources rebuilt only to
+        # be health polled, by resource id.
+        self._woken_by_poll = {}
 
     def _delete_resource(self, resource_id):
         "Called when the Automaton decides the resource can be deleted"
+        self._woken_by_poll.pop(resource_id, None)
         if resource_id in self.state_machines:
             LOG.debug('deleting state machine for %s', resource_id)
             del self.state_machines[resource_id]
         if self._default_resource_id == resource_id:
             self._default_resource_id = None
 
+    def make_dormant(self, resource_id):
+        """Set aside the state machine for an idle resource to save memory.
+
+        Only a DormantResource is kept, and the state machine is built
+        again when the next message for the resource arrives.
+
+        :returns: The DormantResource, or None if the resource has no
+                  state machine.
+        """
+        try:
+            sm = self.state_machines[resource_id]
+        except KeyError:
+            return None
+        self._woken_by_poll.pop(resource_id, None)
+        record = self._dormant_record(sm)
+        self.state_machines.make_dormant(record)
+        LOG.debug('state machine for %s is dormant', resource_id)
+        return record
+
+    def woken_by_poll(self, resource_id):
+        """Returns whether a dormant resource was rebuilt only to be
+        health polled.
+        """
+        return resource_id in self._woken_by_poll
+
+    def return_to_dormant(self, resource_id):
+        """Set aside again a dormant resource rebuilt only to be polled.
+
+        It is set aside if the poll found it CONFIGURED and nothing but
+        polls has arrived for it since it was rebuilt. Otherwise it keeps
+        its state machine until it is evicted again.
+
+        :returns: The DormantResource, or None if the resource was not
+                  set aside.
+        """
+        last_active = self._woken_by_poll.pop(resource_id, None)
+        try:
+            sm = self.state_machines[resource_id]
+        except KeyError:
+            return None
+        if (last_active is None or sm.last_active != last_active or
+                not sm.initialized or
+                sm.instance.state != states.CONFIGURED):
+            return None
+        return self.make_dormant(resource_id)
+
+    def _dormant_record(self, sm, snapshot=None):
+        if not sm.initialized:
+            # Nothing has been looked up yet, so keep whatever the
+            # state machine was to start from.
+            return DormantResource(
+                resource_id=sm.resource_id,
+                tenant_id=self.tenant_id,
+                driver=sm.driver.RESOURCE_NAME,
+                state=None,
+                config_digest=None,
+                last_active=sm.last_active,
+                snapshot=sm.snapshot(),
+            )
+        return DormantResource(
+            resource_id=sm.resource_id,
+            tenant_id=self.tenant_id,
+            driver=sm.driver.RESOURCE_NAME,
+            state=sm.instance.state,
+            config_digest=sm.instance.config_digest,
+            last_active=sm.last_active,
+            snapshot=snapshot,
+        )
+
+    def snapshot(self):
+        """Returns a DormantResource for each resource, to be saved and
+        restored by a later process.
+
+        The records of the resources with state machines hold what the
+        state machines know about their instances.
+        """
+        records = self.state_machines.dormant_records()
+        for resource_id, sm in self.state_machines.items():
+            if not sm.deleted:
+                records.append(self._dormant_record(sm, sm.snapshot()))
+        return records
+
+    def restore(self, record):
+        """Take on a resource saved by snapshot() in an earlier process.
+
+        The resource is dormant until a message for it arrives, and
+        then its state machine starts from the snapshot.
+
+        :returns: True if the resource was restored, False if it is
+                  already managed or has been deleted.
+        """
+        resource_id = record.resource_id
+        if (resource_id in self.state_machines or
+                self.state_machines.get_dormant(resource_id) or
+                self.state_machines.has_been_deleted(resource_id)):
+            return False
+        self.state_machines.make_dormant(record)
+        return True
+
     def shutdown(self):
         LOG.info('shutting down')
         for resource_id, sm in self.state_machines.items():
@@ -125,9 +330,74 @@ class TenantResourceManager(object):
         }
         self.notify(msg)
 
-    def get_state_machines(self, message, worker_context):
+    def _create_state_machine(self, resource_id, driver, snapshot=None):
+        """Create and store the state machine for a resource.
+
+        Nothing is looked up here, so the caller is not held up by
+        neutron or nova. The driver and the instance are looked up by
+        the state machine's first update(), on a worker thread.
+
+        :param snapshot: What an earlier process knew about the
+                         resource's instance, or None to look it up.
+
+        :returns: The new state machine, or None if the driver could
+                  not be loaded.
+        """
+        LOG.debug('creating state machine for %s', resource_id)
+
+        # load the driver
+        if not driver:
+            LOG.error(_LE('cannot create state machine without specifying'
+                          'a driver.'))
+            return None
+
+        driver_obj = drivers.get(driver)(None, resource_id)
+
+        if not driver_obj:
+            # this means the driver didn't load for some reason..
+            # this might not be needed at all.
+            LOG.debug('for some reason loading the driver failed')
+            return None
+
+        def deleter():
+            self._delete_resource(resource_id)
+
+        new_state_machine = state.Automaton(
+            driver=driver_obj,
+            resource_id=resource_id,
+            tenant_id=self.tenant_id,
+            delete_callback=deleter,
+            bandwidth_callback=self._report_bandwidth,
+            worker_context=None,
+            queue_warning_threshold=self._queue_warning_threshold,
+            reboot_error_threshold=self._reboot_error_threshold,
+            state_callback=self.state_machines.index.set_state,
+            trace_size=self._trace_size,
+            snapshot=snapshot,
+        )
+        self.state_machines[resource_id] = new_state_machine
+        return new_state_machine
+
+    def _rebuild_state_machine(self, record):
+        """Build the state machine for a dormant resource again.
+
+        It keeps the time of the resource's last activity, so it is set
+        aside again once it has done what it was rebuilt for.
+        """
+        sm = self._create_state_machine(
+            record.resource_id, record.driver, record.snapshot)
+        if sm:
+            sm.last_active = record.last_active
+        return sm
+
+    def get_state_machines(self, message, worker_context,
+                           rebuild_dormant=True):
         """Return the state machines and the queue for sending it messages for
         the logical resource being addressed by the message.
+
+        :param rebuild_dormant: Whether a message for all resources
+                                rebuilds the state machines of the
+                                dormant ones it has to go to.
         """
         if (not message.resource or
            (message.resource and not message.resource.id)):
@@ -136,12 +406,35 @@ class TenantResourceManager(object):
                     'no message.resource'))
                 raise InvalidIncomingMessage()
 
+        if message.crud != event.POLL:
+            self.last_active = time.time()
         state_machines = []
 
         # Send to all of our resources.
         if message.resource.id == '*':
             LOG.debug('routing to all state machines')
-            state_machines = self.state_machines.values()
+            # Periodic health checks only go to the resources whose
+            # turn it is to be polled.
+            if (message.crud == event.POLL and message.body and
+                    health.POLL_SLOT in message.body):
+                state_machines, dormant = self.state_machines.in_poll_slot(
+                    message.body[health.POLL_SLOT],
+                    message.body[health.POLL_SLOTS],
+                )
+            else:
+                state_machines = self.state_machines.values()
+                dormant = self.state_machines.dormant_records()
+            if not rebuild_dormant:
+                dormant = []
+            for d in dormant:
+                sm = self._rebuild_state_machine(d)
+                if sm:
+                    state_machines.append(sm)
+                    # Dormant resources are still health checked, and
+                    # are set aside again once the poll finds them
+                    # healthy. See return_to_dormant().
+                    if message.crud == event.POLL:
+                        self._woken_by_poll[sm.resource_id] = sm.last_active
 
         # Ignore messages to deleted resources.
         elif self.state_machines.has_been_deleted(message.resource.id):
@@ -151,46 +444,24 @@ class TenantResourceManager(object):
         # Send to resources that have an ERROR status
         elif message.resource.id == 'error':
             state_machines = [
-                sm for sm in self.state_machines.values()
+                sm for sm in self.state_machines.index.find(
+                    tenant_id=self.tenant_id, state=states.ERROR)
                 if sm.has_error()
             ]
             LOG.debug('routing to %d errored state machines',
                       len(state_machines))
 
-        # Create a new state machine for this router.
+        # Create a new state machine for this router, or bring back
+        # the one set aside while it was idle.
         elif message.resource.id not in self.state_machines:
-            LOG.debug('creating state machine for %s', message.resource.id)
-
-            # load the driver
-            if not message.resource.driver:
-                LOG.error(_LE('cannot create state machine without specifying'
-                              'a driver.'))
+            dormant = self.state_machines.get_dormant(message.resource.id)
+            if dormant:
+                new_state_machine = self._rebuild_state_machine(dormant)
+            else:
+                new_state_machine = self._create_state_machine(
+                    message.resource.id, message.resource.driver)
+            if not new_state_machine:
                 return []
-
-            driver_obj = \
-                drivers.get(message.resource.driver)(worker_context,
-                                                     message.resource.id)
-
-            if not driver_obj:
-                # this means the driver didn't load for some reason..
-                # this might not be needed at all.
-                LOG.debug('for some reason loading the driver failed')
-                return []
-
-            def deleter():
-                self._delete_resource(message.resource.id)
-
-            new_state_machine = state.Automaton(
-                driver=driver_obj,
-                resource_id=message.resource.id,
-                tenant_id=self.tenant_id,
-                delete_callback=deleter,
-                bandwidth_callback=self._report_bandwidth,
-                worker_context=worker_context,
-                queue_warning_threshold=self._queue_warning_threshold,
-                reboot_error_threshold=self._reboot_error_threshold,
-            )
-            self.state_machines[message.resource.id] = new_state_machine
             state_machines = [new_state_machine]
 
         # Send directly to an existing router.
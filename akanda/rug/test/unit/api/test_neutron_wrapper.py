@@ -221,6 +221,22 @@ class TestuNeutronModels(base.RugTestBase):
         self.assertEqual(fip.subnet_id, 'sub1')
         self.assertEqual(fip.ip_address, netaddr.IPAddress('192.168.1.1'))
 
+    def test_port_model_to_dict(self):
+        d = {
+            'id': '1',
+            'name': 'name',
+            'device_id': 'device_id',
+            'fixed_ips': [{'ip_address': '192.168.1.1', 'subnet_id': 'sub1'}],
+            'mac_address': 'aa:bb:cc:dd:ee:ff',
+            'network_id': 'net_id',
+            'device_owner': 'test'
+        }
+
+        p = neutron.Port.from_dict(d)
+
+        self.assertEqual(d, p.to_dict())
+        self.assertEqual(p, neutron.Port.from_dict(p.to_dict()))
+
     def test_floating_ip_model(self):
         d = {
             'id': 'a-b-c-d',
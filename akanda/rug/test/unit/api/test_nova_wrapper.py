@@ -19,6 +19,7 @@ import datetime
 import mock
 import unittest2 as unittest
 from six.moves import builtins as __builtins__
+from akanda.rug.api import neutron
 from akanda.rug.api import nova
 
 from novaclient import exceptions as novaclient_exceptions
@@ -343,3 +344,32 @@ class TestNovaWrapper(unittest.TestCase):
         self.assertEqual(res.nova_status, 'BUILD')
         self.assertEqual(res.id_, fake_instance.id)
         self.assertIsInstance(res, nova.InstanceInfo)
+
+
+class TestInstanceInfo(unittest.TestCase):
+
+    def setUp(self):
+        mgt_port = neutron.Port(
+            'mgt', 'fake_instance_id',
+            fixed_ips=[neutron.FixedIp('s1', 'fdca:3ba5:a17a:acda::1')],
+            mac_address='aa:bb:cc:dd:ee:ff', network_id='mgt-net')
+        port = neutron.Port(
+            'int', 'fake_instance_id',
+            fixed_ips=[neutron.FixedIp('s2', '10.0.0.1')],
+            mac_address='bb:cc:cc:dd:ee:ff', network_id='int-net')
+        self.info = nova.InstanceInfo(
+            'fake_instance_id', 'ak-router-fake',
+            management_port=mgt_port, ports=[mgt_port, port],
+            image_uuid='fake_image', booting=True)
+
+    def test_round_trip(self):
+        d = self.info.to_dict()
+        info = nova.InstanceInfo.from_dict(d)
+        self.assertEqual(vars(self.info), vars(info))
+        self.assertEqual('fdca:3ba5:a17a:acda::1', info.management_address)
+
+    def test_from_dict_keeps_boot_time(self):
+        self.info.last_boot = datetime.datetime(2015, 10, 1, 12, 0, 0)
+        info = nova.InstanceInfo.from_dict(self.info.to_dict())
+        self.assertTrue(info.booting)
+        self.assertEqual(self.info.last_boot, info.last_boot)
@@ -0,0 +1,102 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import uuid
+
+import unittest2 as unittest
+
+from akanda.rug.common import hash_ring
+
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHashRing, self).setUp()
+        self.keys = [str(uuid.uuid4()) for i in range(1000)]
+
+    def test_empty(self):
+        ring = hash_ring.HashRing()
+        self.assertIsNone(ring.get_node('foo'))
+        self.assertEqual(0, len(ring))
+
+    def test_invalid_replicas(self):
+        self.assertRaises(ValueError, hash_ring.HashRing, ['a'], replicas=0)
+
+    def test_stable(self):
+        ring = hash_ring.HashRing(['a', 'b', 'c'])
+        other = hash_ring.HashRing(['c', 'b', 'a'])
+        for k in self.keys:
+            self.assertEqual(ring.get_node(k), other.get_node(k))
+
+    def test_unicode_key(self):
+        ring = hash_ring.HashRing(['a', 'b', 'c'])
+        self.assertEqual(ring.get_node('foo'), ring.get_node(u'foo'))
+
+    def test_add_node(self):
+        ring = hash_ring.HashRing(['a', 'b', 'c', 'd'])
+        before = dict((k, ring.get_node(k)) for k in self.keys)
+        ring.add_node('e')
+        self.assertIn('e', ring)
+        moved = [k for k in self.keys if ring.get_node(k) != before[k]]
+        self.assertTrue(all(ring.get_node(k) == 'e' for k in moved))
+        self.assertLess(len(moved), len(self.keys) * 0.3)
+
+    def test_remove_node(self):
+        ring = hash_ring.HashRing(['a', 'b', 'c', 'd'])
+        before = dict((k, ring.get_node(k)) for k in self.keys)
+        ring.remove_node('d')
+        self.assertEqual(['a', 'b', 'c'], ring.nodes)
+        for k in self.keys:
+            if before[k] != 'd':
+                self.assertEqual(before[k], ring.get_node(k))
+            else:
+                self.assertNotEqual('d', ring.get_node(k))
+
+    def test_remove_missing_node(self):
+        ring = hash_ring.HashRing(['a'])
+        self.assertRaises(KeyError, ring.remove_node, 'b')
+
+    def test_zero_weight(self):
+        ring = hash_ring.HashRing(['a', 'b'], weights={'b': 0})
+        self.assertEqual(set(['a']),
+                         set(ring.get_node(k) for k in self.keys))
+
+    def test_all_zero_weights(self):
+        self.assertRaises(ValueError, hash_ring.HashRing, ['a', 'b'],
+                          weights={'a': 0, 'b': 0})
+
+    def test_add_node_zero_weight(self):
+        ring = hash_ring.HashRing()
+        self.assertRaises(ValueError, ring.add_node, 'a', weight=0)
+        self.assertEqual([], ring.nodes)
+        self.assertIsNone(ring.get_node('foo'))
+
+    def test_add_node_drains_one(self):
+        ring = hash_ring.HashRing(['a', 'b'])
+        ring.add_node('b', weight=0)
+        self.assertEqual(set(['a']),
+                         set(ring.get_node(k) for k in self.keys))
+
+    def test_reweight_empties_ring(self):
+        ring = hash_ring.HashRing(['a', 'b'], weights={'b': 0})
+        self.assertRaises(ValueError, ring.add_node, 'a', weight=0)
+        self.assertEqual(set(['a']),
+                         set(ring.get_node(k) for k in self.keys))
+
+    def test_remove_last_weighted_node(self):
+        ring = hash_ring.HashRing(['a', 'b'], weights={'b': 0})
+        self.assertRaises(ValueError, ring.remove_node, 'a')
+        self.assertEqual(['a', 'b'], ring.nodes)
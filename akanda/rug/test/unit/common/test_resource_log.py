@@ -0,0 +1,109 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import logging
+
+import mock
+from oslo_log import log as oslo_logging
+
+from akanda.rug.common import resource_log
+from akanda.rug.test.unit import base
+
+
+class TestResourceLogAdapter(base.RugTestBase):
+
+    def setUp(self):
+        super(TestResourceLogAdapter, self).setUp()
+        self.config(resource_log_burst=2, resource_log_interval=60)
+        self.now = 1000.0
+        time_patch = mock.patch('time.time', side_effect=lambda: self.now)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.logger = mock.Mock()
+        self.logger.isEnabledFor.return_value = True
+        self.log = resource_log.ResourceLogAdapter('ak-router-r1',
+                                                   self.logger)
+
+    def _logged(self):
+        return [c[0][1] for c in self.logger.log.call_args_list]
+
+    def test_shared_logger(self):
+        log = resource_log.ResourceLogAdapter('ak-router-r2')
+        self.assertIs(resource_log.LOG, log.logger)
+
+    def test_name_added(self):
+        self.log.info('hello %s', 'world')
+        self.logger.info.assert_called_once_with(
+            'ak-router-r1: hello %s', 'world',
+            extra={'resource': {'name': 'ak-router-r1'}})
+
+    def test_extra_merged(self):
+        self.log.info('hello', extra={'event': 'poll'})
+        self.logger.info.assert_called_once_with(
+            'ak-router-r1: hello',
+            extra={'resource': {'name': 'ak-router-r1'}, 'event': 'poll'})
+        self.assertEqual({'resource': {'name': 'ak-router-r1'}},
+                         self.log.extra)
+
+    def test_resource_on_record(self):
+        handler = mock.Mock(level=logging.INFO)
+        logger = oslo_logging.getLogger('akanda.rug.test.resource_log')
+        logger.logger.addHandler(handler)
+        self.addCleanup(logger.logger.removeHandler, handler)
+        logger.logger.setLevel(logging.INFO)
+        resource_log.ResourceLogAdapter('ak-router-r1', logger).info(
+            'hi', extra={'event': 'poll'})
+        record = handler.handle.call_args[0][0]
+        self.assertEqual('[ak-router-r1] ', record.resource)
+        self.assertEqual('poll', record.event)
+
+    def test_debug_not_enabled(self):
+        self.logger.isEnabledFor.return_value = False
+        self.log.debug('hello')
+        self.assertFalse(self.logger.debug.called)
+
+    def test_log_limited_burst(self):
+        for i in range(4):
+            self.log.log_limited(logging.WARNING, 'queue', 'long queue')
+        self.assertEqual(['ak-router-r1: long queue'] * 2, self._logged())
+
+    def test_log_limited_refills(self):
+        for i in range(4):
+            self.log.log_limited(logging.WARNING, 'queue', 'long queue')
+        self.now += 60
+        self.log.log_limited(logging.WARNING, 'queue', 'long queue')
+        self.assertEqual(
+            'ak-router-r1: long queue (2 similar messages suppressed)',
+            self._logged()[-1])
+
+    def test_log_limited_by_kind(self):
+        for i in range(3):
+            self.log.log_limited(logging.WARNING, 'queue', 'long queue')
+        self.log.log_limited(logging.DEBUG, 'alive', 'not alive')
+        self.assertEqual('ak-router-r1: not alive', self._logged()[-1])
+
+    def test_log_limited_disabled(self):
+        self.config(resource_log_interval=0)
+        for i in range(4):
+            self.log.log_limited(logging.WARNING, 'queue', 'long queue')
+        self.assertEqual(4, len(self._logged()))
+
+    def test_log_limited_level_not_enabled(self):
+        self.logger.isEnabledFor.return_value = False
+        self.log.log_limited(logging.DEBUG, 'alive', 'not alive')
+        self.assertFalse(self.logger.log.called)
+        self.assertEqual({}, self.log._buckets)
@@ -97,3 +97,15 @@ class TestDBDebugModes(base.DbTestCase):
         for debug_t_id, reason in self.dbapi.tenants_in_debug():
             self.assertIn(debug_t_id, t_ids)
             self.assertEqual(reason, 'tenant %s is broken' % debug_t_id)
+
+    def test_debug_version(self):
+        versions = [self.dbapi.debug_version()]
+        self.dbapi.enable_tenant_debug(tenant_uuid=uuid.uuid4().hex)
+        versions.append(self.dbapi.debug_version())
+        self.dbapi.enable_resource_debug(resource_uuid=uuid.uuid4().hex)
+        versions.append(self.dbapi.debug_version())
+        self.dbapi.enable_global_debug()
+        versions.append(self.dbapi.debug_version())
+        self.dbapi.disable_global_debug()
+        versions.append(self.dbapi.debug_version())
+        self.assertEqual([0, 1, 2, 3, 4], versions)
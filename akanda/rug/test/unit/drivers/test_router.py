@@ -55,6 +55,12 @@ class RouterDriverTest(base.RugTestBase):
             'ak-%s-%s' % (rtr.RESOURCE_NAME, self.router_id))
         mock_post_init.assert_called_with(self.ctx)
 
+    @mock.patch('akanda.rug.drivers.router.Router.post_init')
+    def test_init_without_context(self, mock_post_init):
+        rtr = router.Router(worker_context=None, id=self.router_id)
+        self.assertEqual(self.router_id, rtr.id)
+        self.assertFalse(mock_post_init.called)
+
     @mock.patch('akanda.rug.drivers.router.Router._ensure_cache')
     def test_post_init(self, mock_ensure_cache):
         rtr = self._init_driver()
@@ -0,0 +1,137 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import uuid
+
+import mock
+
+from akanda.rug import coordination
+from akanda.rug.test.unit import base
+
+
+class BackendTestMixin(object):
+
+    def setUp(self):
+        super(BackendTestMixin, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.backend = self.backend_cls(os.path.join(tmpdir, 'members'), 30)
+
+    def test_empty(self):
+        self.assertEqual([], self.backend.get_members())
+
+    def test_heartbeat_joins(self):
+        self.backend.heartbeat('node-b')
+        self.backend.heartbeat('node-a')
+        self.backend.heartbeat('node-a')
+        self.assertEqual(['node-a', 'node-b'], self.backend.get_members())
+
+    def test_leave(self):
+        self.backend.heartbeat('node-a')
+        self.backend.heartbeat('node-b')
+        self.backend.leave('node-a')
+        self.backend.leave('node-c')
+        self.assertEqual(['node-b'], self.backend.get_members())
+
+    def test_silent_members_expire(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.backend.heartbeat('node-a')
+        with mock.patch('time.time', return_value=1020.0):
+            self.backend.heartbeat('node-b')
+            self.assertEqual(['node-a', 'node-b'],
+                             self.backend.get_members())
+        with mock.patch('time.time', return_value=1040.0):
+            self.assertEqual(['node-b'], self.backend.get_members())
+
+
+class TestFileBackend(BackendTestMixin, base.RugTestBase):
+    backend_cls = coordination.FileBackend
+
+
+class TestSqliteBackend(BackendTestMixin, base.RugTestBase):
+    backend_cls = coordination.SqliteBackend
+
+
+class TestGetBackend(base.RugTestBase):
+
+    def test_named(self):
+        self.config(backend='sqlite', path='/tmp/m', member_timeout=12,
+                    group='coordination')
+        backend = coordination.get_backend()
+        self.assertIsInstance(backend, coordination.SqliteBackend)
+        self.assertEqual('/tmp/m', backend.path)
+        self.assertEqual(12, backend.timeout)
+
+    def test_import_path(self):
+        self.config(backend='akanda.rug.coordination.FileBackend',
+                    group='coordination')
+        self.assertIsInstance(coordination.get_backend(),
+                              coordination.FileBackend)
+
+
+class TestCoordinator(base.RugTestBase):
+
+    def setUp(self):
+        super(TestCoordinator, self).setUp()
+        self.backend = mock.Mock()
+        self.backend.get_members.return_value = ['node-a']
+        self.on_change = mock.Mock()
+        self.c = coordination.Coordinator(self.backend, 'node-a',
+                                          on_change=self.on_change)
+
+    def test_alone_owns_everything(self):
+        self.assertFalse(self.c.refresh())
+        self.backend.heartbeat.assert_called_once_with('node-a')
+        self.assertTrue(self.c.owns(str(uuid.uuid4())))
+
+    def test_join(self):
+        old = self.c.ring
+        self.backend.get_members.return_value = ['node-a', 'node-b']
+        self.assertTrue(self.c.refresh())
+        self.on_change.assert_called_once_with(old, self.c.ring)
+        self.assertEqual(['node-a', 'node-b'], self.c.ring.nodes)
+        tenants = [str(uuid.uuid4()) for i in range(100)]
+        owned = [t for t in tenants if self.c.owns(t)]
+        self.assertTrue(0 < len(owned) < len(tenants))
+        # Everything owned now was owned before.
+        self.assertTrue(all(self.c.owns(t, old) for t in owned))
+
+    def test_owns_normalizes_uuid(self):
+        self.backend.get_members.return_value = ['node-a', 'node-b']
+        self.c.refresh()
+        tenant_id = str(uuid.uuid4())
+        self.assertEqual(self.c.owns(tenant_id),
+                         self.c.owns(' %s ' % tenant_id.upper()))
+
+    def test_self_always_member(self):
+        self.backend.get_members.return_value = ['node-b']
+        self.c.refresh()
+        self.assertEqual(['node-a', 'node-b'], self.c.ring.nodes)
+
+    def test_start_does_not_notify(self):
+        self.backend.get_members.return_value = ['node-a', 'node-b']
+        self.c._run = mock.Mock()
+        self.c.start(5)
+        self.assertEqual(['node-a', 'node-b'], self.c.ring.nodes)
+        self.assertFalse(self.on_change.called)
+
+    def test_stop(self):
+        self.c.stop()
+        self.backend.leave.assert_called_once_with('node-a')
@@ -0,0 +1,86 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import debug_registry
+
+
+class TestDebugRegistry(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDebugRegistry, self).setUp()
+        self.db = mock.Mock()
+        self.db.debug_version.return_value = 1
+        self.db.global_debug.return_value = (False, None)
+        self.db.tenants_in_debug.return_value = set([('t1', 'broken')])
+        self.db.resources_in_debug.return_value = set([('r1', None)])
+        self.registry = debug_registry.DebugRegistry(self.db)
+
+    def test_loaded(self):
+        self.assertEqual((False, None), self.registry.global_debug())
+        self.assertEqual((True, 'broken'), self.registry.tenant_in_debug('t1'))
+        self.assertEqual((False, None), self.registry.tenant_in_debug('t2'))
+        self.assertEqual((True, None), self.registry.resource_in_debug('r1'))
+        self.assertEqual(set([('t1', 'broken')]),
+                         self.registry.tenants_in_debug())
+        self.assertEqual(set([('r1', None)]),
+                         self.registry.resources_in_debug())
+
+    def test_lookups_do_not_query(self):
+        self.db.reset_mock()
+        self.registry.global_debug()
+        self.registry.tenant_in_debug('t1')
+        self.registry.resource_in_debug('r1')
+        self.assertEqual([], self.db.mock_calls)
+
+    def test_refresh_unchanged(self):
+        self.db.reset_mock()
+        self.assertFalse(self.registry.refresh())
+        self.assertEqual([mock.call.debug_version()], self.db.mock_calls)
+
+    def test_refresh_changed(self):
+        self.db.debug_version.return_value = 2
+        self.db.global_debug.return_value = (True, 'upgrade')
+        self.db.tenants_in_debug.return_value = set()
+        self.assertTrue(self.registry.refresh())
+        self.assertEqual((True, 'upgrade'), self.registry.global_debug())
+        self.assertEqual((False, None), self.registry.tenant_in_debug('t1'))
+
+    def test_local_changes(self):
+        self.registry.enable_tenant_debug('t2', 'why')
+        self.db.enable_tenant_debug.assert_called_once_with('t2', 'why')
+        self.assertEqual((True, 'why'), self.registry.tenant_in_debug('t2'))
+        self.registry.disable_tenant_debug('t2')
+        self.assertEqual((False, None), self.registry.tenant_in_debug('t2'))
+
+        self.registry.enable_resource_debug('r2')
+        self.assertEqual((True, None), self.registry.resource_in_debug('r2'))
+        self.registry.disable_resource_debug('r2')
+        self.assertEqual((False, None), self.registry.resource_in_debug('r2'))
+
+        self.registry.enable_global_debug('reason')
+        self.assertEqual((True, 'reason'), self.registry.global_debug())
+        self.registry.disable_global_debug()
+        self.assertEqual((False, None), self.registry.global_debug())
+        self.db.disable_global_debug.assert_called_once_with()
+
+    def test_failed_write_not_applied(self):
+        self.db.disable_tenant_debug.side_effect = KeyError('t1')
+        self.assertRaises(KeyError, self.registry.disable_tenant_debug, 't1')
+        self.assertEqual((True, 'broken'), self.registry.tenant_in_debug('t1'))
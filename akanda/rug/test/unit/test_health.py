@@ -12,6 +12,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import uuid
+
 import mock
 
 from akanda.rug import event
@@ -26,6 +28,7 @@ class BreakLoop(Exception):
 class HealthTest(base.RugTestBase):
     @mock.patch('time.sleep')
     def test_health_inspector(self, fake_sleep):
+        self.config(health_check_slots=1)
         fake_scheduler = mock.Mock(
             handle_message=mock.Mock()
         )
@@ -48,3 +51,42 @@ class HealthTest(base.RugTestBase):
             body={},
         )
         fake_scheduler.handle_message.assert_called_with('*', exp_event)
+
+    @mock.patch('time.sleep')
+    def test_health_inspector_slots(self, fake_sleep):
+        self.config(health_check_period=60, health_check_slots=4)
+        fake_scheduler = mock.Mock(
+            handle_message=mock.Mock()
+        )
+        fake_scheduler.handle_message.side_effect = [
+            None, None, None, None, BreakLoop()]
+        try:
+            health._health_inspector(fake_scheduler)
+        except BreakLoop:
+            pass
+
+        fake_sleep.assert_called_with(15.0)
+        bodies = [c[0][1].body
+                  for c in fake_scheduler.handle_message.call_args_list]
+        self.assertEqual(
+            [{'poll_slot': i % 4, 'poll_slots': 4} for i in range(5)],
+            bodies,
+        )
+
+    def test_poll_slot_spread(self):
+        ids = [str(uuid.uuid4()) for i in range(1000)]
+        counts = [0] * 10
+        for i in ids:
+            counts[health.poll_slot(i, 10)] += 1
+        self.assertTrue(all(50 < c < 150 for c in counts), counts)
+
+    def test_in_poll_slot(self):
+        rid = str(uuid.uuid4())
+        slot = health.poll_slot(rid, 5)
+        self.assertTrue(health.in_poll_slot(rid, {}))
+        self.assertTrue(health.in_poll_slot(rid, None))
+        self.assertTrue(
+            health.in_poll_slot(rid, {'poll_slot': slot, 'poll_slots': 5}))
+        self.assertFalse(
+            health.in_poll_slot(rid, {'poll_slot': (slot + 1) % 5,
+                                      'poll_slots': 5}))
@@ -15,6 +15,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import logging
 
 import mock
@@ -22,6 +23,7 @@ import unittest2 as unittest
 from datetime import datetime, timedelta
 
 from akanda.rug import instance_manager
+from akanda.rug.api import neutron
 from akanda.rug.api import nova
 from akanda.rug.drivers import states
 from akanda.rug.test.unit import fakes
@@ -117,6 +119,13 @@ class TestInstanceManager(unittest.TestCase):
             return self.instance_mgr.state
         self.mock_update_state.side_effect = next_state
 
+    def test_state_callback(self):
+        callback = mock.Mock()
+        self.instance_mgr._state_callback = callback
+        self.instance_mgr.state = states.ERROR
+        self.instance_mgr.state = states.ERROR
+        callback.assert_called_once_with('fake_resource_id', states.ERROR)
+
     def test_update_state_is_alive(self):
         self.update_state_p.stop()
         self.fake_driver.is_alive.return_value = True
@@ -466,6 +475,17 @@ class TestInstanceManager(unittest.TestCase):
             )
             self.assertEqual(self.instance_mgr.state,
                              states.CONFIGURED)
+            self.assertEqual(
+                instance_manager.config_digest('fake_config'),
+                self.instance_mgr.config_digest)
+
+    def test_config_digest(self):
+        self.assertEqual(
+            instance_manager.config_digest({'a': 1, 'b': [2, 3]}),
+            instance_manager.config_digest({'b': [2, 3], 'a': 1}))
+        self.assertNotEqual(
+            instance_manager.config_digest({'a': 1}),
+            instance_manager.config_digest({'a': 2}))
 
     def test_configure_mismatched_interfaces(self):
         with mock.patch.object(self.instance_mgr,
@@ -686,6 +706,55 @@ class TestInstanceManager(unittest.TestCase):
         self.instance_mgr.last_error = datetime.utcnow() - timedelta(minutes=5)
         self.assertFalse(self.instance_mgr.error_cooldown)
 
+    def _snapshot(self):
+        mgt_port = neutron.Port(
+            '1', 'fake_instance_id',
+            fixed_ips=[neutron.FixedIp('s2', '9.9.9.9')],
+            mac_address='aa:bb:cc:dd:ee:ff', network_id='mgt-net')
+        self.instance_mgr.instance_info = nova.InstanceInfo(
+            'fake_instance_id', 'ak-FakeDriver-fake_resource_id',
+            management_port=mgt_port, image_uuid='fake_image_uuid')
+        self.instance_mgr.state = states.CONFIGURED
+        self.instance_mgr.config_digest = 'fake_digest'
+        self.fake_driver._last_synced_status = 'ACTIVE'
+        return self.instance_mgr.snapshot()
+
+    def test_snapshot(self):
+        snapshot = self._snapshot()
+        self.assertEqual(states.CONFIGURED, snapshot['state'])
+        self.assertEqual('fake_digest', snapshot['config_digest'])
+        self.assertEqual('ACTIVE', snapshot['synced_status'])
+        self.assertEqual('fake_instance_id', snapshot['instance_info']['id'])
+        # It is saved as JSON.
+        self.assertEqual(snapshot, json.loads(json.dumps(snapshot)))
+
+    def test_snapshot_no_synced_status(self):
+        self.instance_mgr.instance_info = None
+        snapshot = self.instance_mgr.snapshot()
+        self.assertIsNone(snapshot['synced_status'])
+        self.assertIsNone(snapshot['instance_info'])
+
+    def test_init_from_snapshot(self):
+        snapshot = self._snapshot()
+        self.mock_update_state.reset_mock()
+        driver = fakes.fake_driver()
+        im = instance_manager.InstanceManager(
+            driver, 'fake_resource_id', self.ctx, snapshot=snapshot)
+        # Nothing is looked up.
+        self.assertFalse(self.mock_update_state.called)
+        self.assertFalse(self.ctx.nova_client.get_instance_info.called)
+        self.assertEqual(states.CONFIGURED, im.state)
+        self.assertEqual('fake_digest', im.config_digest)
+        self.assertEqual('ACTIVE', driver._last_synced_status)
+        self.assertEqual('9.9.9.9', im.instance_info.management_address)
+
+    def test_init_from_snapshot_without_instance(self):
+        self.mock_update_state.reset_mock()
+        instance_manager.InstanceManager(
+            fakes.fake_driver(), 'fake_resource_id', self.ctx,
+            snapshot={'state': states.DOWN, 'instance_info': None})
+        self.assertTrue(self.mock_update_state.called)
+
 
 class TestBootAttemptCounter(unittest.TestCase):
 
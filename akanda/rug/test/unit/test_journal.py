@@ -0,0 +1,157 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+
+import unittest2 as unittest
+
+from akanda.rug import event
+from akanda.rug import journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = journal.journal_path(self.dir, 'p00', 123)
+        self.journal = journal.Journal(self.path, compact_threshold=4)
+        self.addCleanup(self.journal._file.close)
+        self.r1 = event.Resource('router', 'r1', 't1')
+        self.r2 = event.Resource('router', 'r2', 't2')
+
+    def _lines(self):
+        with open(self.path) as f:
+            return f.readlines()
+
+    def _loaded(self):
+        return sorted((e.resource.id, e.crud)
+                      for e in journal.load([self.path]))
+
+    def test_journal_path(self):
+        self.assertEqual(self.dir, os.path.dirname(self.path))
+        name = os.path.basename(self.path)
+        self.assertTrue(name.startswith('p00-123-'))
+        self.assertTrue(name.endswith('.journal'))
+
+    def test_journal_path_unique(self):
+        self.assertNotEqual(self.path,
+                            journal.journal_path(self.dir, 'p00', 123))
+
+    def test_add_unions_actions(self):
+        self.journal.add(self.r1, [event.UPDATE])
+        self.journal.add(self.r1, [event.REBUILD, event.UPDATE])
+        self.assertEqual(
+            [('r1', event.REBUILD), ('r1', event.UPDATE)],
+            self._loaded(),
+        )
+
+    def test_add_known_actions_not_written(self):
+        self.journal.add(self.r1, [event.UPDATE])
+        self.journal.add(self.r1, [event.UPDATE])
+        self.assertEqual(1, len(self._lines()))
+
+    def test_record_replaces_actions(self):
+        self.journal.add(self.r1, [event.UPDATE, event.REBUILD])
+        self.journal.record(self.r1, [event.REBUILD])
+        self.assertEqual([('r1', event.REBUILD)], self._loaded())
+
+    def test_record_empty_clears(self):
+        self.journal.add(self.r1, [event.UPDATE])
+        self.journal.record(self.r1, [])
+        self.assertEqual(0, len(self.journal))
+        self.assertEqual([], self._loaded())
+
+    def test_record_empty_unknown_not_written(self):
+        self.journal.record(self.r1, [])
+        self.assertEqual([], self._lines())
+
+    def test_compaction(self):
+        self.journal.add(self.r2, [event.UPDATE])
+        for i in range(2):
+            self.journal.add(self.r1, [event.UPDATE])
+            self.journal.record(self.r1, [])
+        # Only r2 still has work, so the file was rewritten with it.
+        self.assertEqual(1, len(self._lines()))
+        self.assertEqual([('r2', event.UPDATE)], self._loaded())
+        self.journal.add(self.r1, [event.DELETE])
+        self.assertEqual(
+            [('r1', event.DELETE), ('r2', event.UPDATE)],
+            self._loaded(),
+        )
+
+    def test_close(self):
+        self.journal.add(self.r1, [event.UPDATE])
+        self.journal.close()
+        self.assertEqual([('r1', event.UPDATE)], self._loaded())
+
+
+class TestLoad(unittest.TestCase):
+
+    def setUp(self):
+        super(TestLoad, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_torn_line_skipped(self):
+        path = self._write(
+            'p00-1.journal',
+            '{"driver": "router", "id": "r1", "tenant_id": "t1", '
+            '"actions": ["%s"]}\n{"driver": "rou' % event.UPDATE,
+        )
+        events = journal.load([path])
+        self.assertEqual(1, len(events))
+        self.assertEqual(event.Resource('router', 'r1', 't1'),
+                         events[0].resource)
+        self.assertEqual(event.UPDATE, events[0].crud)
+
+    def test_later_journal_wins(self):
+        old = self._write(
+            'p00-1.journal',
+            '{"driver": "router", "id": "r1", "tenant_id": "t1", '
+            '"actions": ["%s"]}\n' % event.UPDATE,
+        )
+        new = self._write(
+            'p00-2.journal',
+            '{"driver": "router", "id": "r1", "tenant_id": "t1", '
+            '"actions": []}\n',
+        )
+        self.assertEqual([], journal.load([old, new]))
+
+    def test_missing_journal(self):
+        self.assertEqual(
+            [], journal.load([os.path.join(self.dir, 'gone.journal')]))
+
+    def test_find(self):
+        path = self._write('p00-1.journal', '')
+        self._write('other.txt', '')
+        self.assertEqual([path], journal.find(self.dir))
+
+    def test_find_process(self):
+        path = self._write('p00-1-abc.journal', '')
+        self._write('p00-12-def.journal', '')
+        self._write('p01-1-ghi.journal', '')
+        self.assertEqual([path], journal.find(self.dir, 'p00', 1))
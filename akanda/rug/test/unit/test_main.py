@@ -94,6 +94,29 @@ class TestMainPippo(base.RugTestBase):
         self.assertEqual(len(notifications.Publisher.mock_calls), 2)
         self.assertEqual(len(notifications.NoopPublisher.mock_calls), 0)
 
+    @mock.patch('akanda.rug.main.coordination')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_coordination_enabled(self, shuffle_notifications, coordination,
+                                  health, populate, scheduler, notifications,
+                                  multiprocessing, neutron_api):
+        self.test_config.config(enabled=True, heartbeat_interval=7,
+                                group='coordination')
+        main.main(argv=self.argv)
+        coordinator = coordination.Coordinator.return_value
+        self.assertIs(coordinator,
+                      scheduler.Scheduler.call_args[1]['coordinator'])
+        coordinator.start.assert_called_once_with(7)
+        coordinator.stop.assert_called_once_with()
+
+    @mock.patch('akanda.rug.main.coordination')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_coordination_disabled(self, shuffle_notifications, coordination,
+                                   health, populate, scheduler, notifications,
+                                   multiprocessing, neutron_api):
+        main.main(argv=self.argv)
+        self.assertFalse(coordination.Coordinator.called)
+        self.assertIsNone(scheduler.Scheduler.call_args[1]['coordinator'])
+
 
 @mock.patch('akanda.rug.api.neutron.importutils')
 @mock.patch('akanda.rug.api.neutron.AkandaExtClientWrapper')
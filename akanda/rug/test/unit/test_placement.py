@@ -0,0 +1,112 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import placement
+
+
+class TestPlacementTable(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPlacementTable, self).setUp()
+        self.now = 1000.0
+        time_patch = mock.patch('time.time', side_effect=lambda: self.now)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.table = placement.PlacementTable(3, window=10)
+
+    def _events(self, tenant_id, count):
+        for i in range(count):
+            self.table.record(tenant_id)
+
+    def _next_window(self):
+        self.now += 10
+
+    def test_new_tenants_spread(self):
+        owners = [self.table.owner(t, lambda: [0, 0, 0])
+                  for t in ('a', 'b', 'c')]
+        self.assertEqual([0, 1, 2], sorted(owners))
+
+    def test_owner_is_sticky(self):
+        idx = self.table.owner('a', lambda: [0, 0, 0])
+        self.assertEqual(idx, self.table.owner('a', lambda: [0, 100, 100]))
+
+    def test_new_tenant_avoids_backlog(self):
+        self.assertEqual(2, self.table.owner('a', lambda: [50, 10, 0]))
+
+    def test_rates(self):
+        self._events('a', 100)
+        self._next_window()
+        self.assertEqual(5.0, self.table.rate('a'))
+        self.assertFalse(self.table.is_quiet(5))
+        self._next_window()
+        self.assertEqual(2.5, self.table.rate('a'))
+        self.assertTrue(self.table.is_quiet(5))
+
+    def test_idle_tenants_forgotten(self):
+        self._events('a', 1)
+        for i in range(20):
+            self._next_window()
+            self.table.rate('a')
+        self.assertNotIn('a', self.table._rates)
+
+    def test_pick_migration(self):
+        for t in ('hot', 'warm'):
+            self.table.owner(t, lambda: [0, 5, 5])
+        self._events('hot', 100)
+        self._events('warm', 20)
+        self._next_window()
+        self.assertEqual(('hot', 0, 1),
+                         self.table.pick_migration([0, 0, 0], 1.5))
+
+    def test_pick_migration_balanced(self):
+        for t in ('a', 'b', 'c'):
+            self.table.owner(t, lambda: [0, 0, 0])
+            self._events(t, 10)
+        self._next_window()
+        self.assertIsNone(self.table.pick_migration([0, 0, 0], 1.5))
+
+    def test_pick_migration_single_tenant(self):
+        # Moving the only busy tenant just moves the hot spot.
+        self.table.owner('a', lambda: [0, 0, 0])
+        self._events('a', 100)
+        self._next_window()
+        self.assertIsNone(self.table.pick_migration([0, 0, 0], 1.5))
+
+    def test_migration_holds_messages(self):
+        self.table.owner('a', lambda: [0, 0, 0])
+        self.assertFalse(self.table.hold('a', 'm0'))
+        self.table.start_migration('a', 2)
+        self.assertTrue(self.table.hold('a', 'm1'))
+        self.assertIsNone(self.table.pick_migration([100, 0, 0], 1.5))
+        self.assertEqual(['m1'], self.table.finish_migration('a', True))
+        self.assertEqual(2, self.table.owner('a', lambda: [0, 0, 0]))
+        self.assertFalse(self.table.hold('a', 'm2'))
+
+    def test_migration_not_released(self):
+        self.table.owner('a', lambda: [0, 0, 0])
+        self.table.start_migration('a', 2)
+        self.table.finish_migration('a', False)
+        self.assertEqual(0, self.table.owner('a', lambda: [0, 0, 0]))
+
+    def test_expired_migrations(self):
+        self.table.start_migration('a', 1)
+        self.assertEqual([], self.table.expired_migrations(60))
+        self.now += 61
+        self.assertEqual(['a'], self.table.expired_migrations(60))
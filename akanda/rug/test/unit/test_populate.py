@@ -16,10 +16,12 @@
 
 
 import mock
+from oslo_config import cfg
 
 from akanda.rug.test.unit import base
 from akanda.rug.test.unit import fakes
 
+from akanda.rug import commands
 from akanda.rug import populate
 from akanda.rug import event
 from akanda.rug.event import Resource
@@ -63,16 +65,180 @@ class TestPrePopulateWorkers(base.RugTestBase):
         populate._pre_populate_workers(fake_scheduler)
         self.assertFalse(fake_scheduler.handle_message.called)
 
+    @mock.patch('akanda.rug.drivers.enabled_drivers')
+    def test_pre_populate_only_given_workers(self, enabled_drivers):
+        workers = [{'name': 'p00'}, {'name': 'p01'}]
+        fake_scheduler = mock.Mock()
+        fake_scheduler.dispatcher.pick_workers.side_effect = (
+            lambda t: [workers[int(t[-1]) % 2]])
+        fake_driver = fakes.fake_driver()
+        fake_resources = [
+            Resource(
+                id='fake_resource_%s' % i,
+                tenant_id='fake_tenant_%s' % i,
+                driver=fake_driver.RESOURCE_NAME,
+            ) for i in range(4)
+        ]
+        fake_driver.pre_populate_hook.return_value = fake_resources
+        enabled_drivers.return_value = [fake_driver]
+        populate._pre_populate_workers(fake_scheduler, [workers[1]])
+        self.assertEqual(
+            ['fake_tenant_1', 'fake_tenant_3'],
+            [c[0][0] for c in fake_scheduler.handle_message.call_args_list],
+        )
+
+    @mock.patch('time.sleep')
+    @mock.patch('akanda.rug.drivers.enabled_drivers')
+    def test_rebalance_cluster(self, enabled_drivers, sleep):
+        old_ring, new_ring = object(), object()
+        # tenant 0 stays, 1 is gained, 2 is lost and 3 is not ours.
+        owners = {
+            old_ring: ['fake_tenant_0', 'fake_tenant_2'],
+            new_ring: ['fake_tenant_0', 'fake_tenant_1'],
+        }
+        sched = mock.Mock()
+        sched.coordinator.ring = new_ring
+        sched.coordinator.owns.side_effect = lambda t, r: t in owners[r]
+        sched.retry_releases.side_effect = [1, 0]
+        fake_driver = fakes.fake_driver()
+        fake_resources = [
+            Resource(
+                id='fake_resource_%s' % i,
+                tenant_id='fake_tenant_%s' % i,
+                driver=fake_driver.RESOURCE_NAME,
+            ) for i in range(4)
+        ]
+        fake_driver.pre_populate_hook.return_value = fake_resources
+        enabled_drivers.return_value = [fake_driver]
+        populate._rebalance_cluster(sched, old_ring, new_ring)
+        e = event.Event(resource=fake_resources[1], crud=event.POLL, body={})
+        sched.handle_message.assert_called_once_with('fake_tenant_1', e)
+        sched.release_tenant.assert_called_once_with('fake_tenant_2')
+        self.assertEqual(2, sched.retry_releases.call_count)
+
+    @mock.patch('threading.Thread')
+    def test_repopulate_workers(self, thread):
+        sched = mock.Mock()
+        workers = [mock.Mock()]
+        t = populate.repopulate_workers(sched, workers)
+        thread.assert_called_once_with(
+            target=populate._repopulate_workers,
+            args=(sched, workers, None, None),
+            name='RepopulateWorkers'
+        )
+        self.assertEqual(
+            t.mock_calls,
+            [mock.call.setDaemon(True), mock.call.start()]
+        )
+
     @mock.patch('threading.Thread')
     def test_pre_populate_workers(self, thread):
         sched = mock.Mock()
         t = populate.pre_populate_workers(sched)
         thread.assert_called_once_with(
             target=populate._pre_populate_workers,
-            args=(sched,),
+            args=(sched, None, ()),
             name='PrePopulateWorkers'
         )
         self.assertEqual(
             t.mock_calls,
             [mock.call.setDaemon(True), mock.call.start()]
         )
+
+    @mock.patch('akanda.rug.populate._pre_populate_workers')
+    @mock.patch('akanda.rug.populate.replay_journals')
+    def test_repopulate_replays_journals_first(self, replay, pre_populate):
+        sched = mock.Mock()
+        workers = [mock.Mock()]
+        calls = mock.Mock()
+        calls.attach_mock(replay, 'replay')
+        calls.attach_mock(pre_populate, 'pre_populate')
+        populate._repopulate_workers(sched, workers, ['/j/p01-1.journal'],
+                                     None)
+        self.assertEqual(
+            [mock.call.replay(sched, ['/j/p01-1.journal']),
+             mock.call.pre_populate(sched, workers, ())],
+            calls.mock_calls,
+        )
+
+    @mock.patch('akanda.rug.populate._pre_populate_workers')
+    @mock.patch('akanda.rug.populate.replay_journals')
+    @mock.patch('akanda.rug.populate.restore_snapshots')
+    def test_repopulate_restores_snapshots_first(self, restore, replay,
+                                                 pre_populate):
+        sched = mock.Mock()
+        workers = [mock.Mock()]
+        restore.return_value = set(['r1'])
+        calls = mock.Mock()
+        calls.attach_mock(restore, 'restore')
+        calls.attach_mock(replay, 'replay')
+        calls.attach_mock(pre_populate, 'pre_populate')
+        populate._repopulate_workers(sched, workers, ['/j/p01-1.journal'],
+                                     ['/s/p01-1.snapshot'])
+        self.assertEqual(
+            [mock.call.restore(sched, ['/s/p01-1.snapshot']),
+             mock.call.replay(sched, ['/j/p01-1.journal']),
+             mock.call.pre_populate(sched, workers, set(['r1']))],
+            calls.mock_calls,
+        )
+
+    @mock.patch('akanda.rug.drivers.enabled_drivers')
+    def test_pre_populate_skips_restored(self, enabled_drivers):
+        fake_scheduler = mock.Mock()
+        fake_driver = fakes.fake_driver()
+        fake_resources = [
+            Resource(
+                id='fake_resource_%s' % i,
+                tenant_id='fake_tenant_%s' % i,
+                driver=fake_driver.RESOURCE_NAME,
+            ) for i in range(2)
+        ]
+        fake_driver.pre_populate_hook.return_value = fake_resources
+        enabled_drivers.return_value = [fake_driver]
+        populate._pre_populate_workers(fake_scheduler,
+                                       restored=set(['fake_resource_0']))
+        e = event.Event(resource=fake_resources[1], crud=event.POLL, body={})
+        fake_scheduler.handle_message.assert_called_once_with(
+            'fake_tenant_1', e)
+
+    @mock.patch('os.unlink')
+    @mock.patch('akanda.rug.snapshot.load')
+    def test_restore_snapshots(self, load, unlink):
+        sched = mock.Mock()
+        records = [
+            {'resource_id': 'r1', 'tenant_id': 't1'},
+            {'resource_id': 'r2', 'tenant_id': 't1'},
+            {'resource_id': 'r3', 'tenant_id': 't2'},
+        ]
+        load.return_value = records
+        unlink.side_effect = [OSError()]
+        restored = populate.restore_snapshots(sched, ['/s/a.snapshot'])
+        self.assertEqual(set(['r1', 'r2', 'r3']), restored)
+        load.assert_called_once_with(['/s/a.snapshot'],
+                                     cfg.CONF.snapshot_max_age)
+        unlink.assert_called_once_with('/s/a.snapshot')
+        # One message per tenant, sent to the tenant's worker.
+        sent = dict((c[0][0], c[0][1])
+                    for c in sched.handle_message.call_args_list)
+        self.assertEqual(['t1', 't2'], sorted(sent))
+        self.assertEqual(event.COMMAND, sent['t1'].crud)
+        self.assertEqual(commands.RESOURCE_RESTORE,
+                         sent['t1'].body['command'])
+        self.assertEqual(records[:2], sent['t1'].body['resources'])
+        self.assertEqual(records[2:], sent['t2'].body['resources'])
+
+    @mock.patch('os.unlink')
+    @mock.patch('akanda.rug.journal.load')
+    def test_replay_journals(self, load, unlink):
+        sched = mock.Mock()
+        resource = Resource(driver='router', id='r1', tenant_id='t1')
+        e = event.Event(resource=resource, crud=event.UPDATE, body={})
+        load.return_value = [e]
+        unlink.side_effect = [OSError(), None]
+        populate.replay_journals(sched, ['/j/a.journal', '/j/b.journal'])
+        load.assert_called_once_with(['/j/a.journal', '/j/b.journal'])
+        sched.handle_message.assert_called_once_with('t1', e)
+        self.assertEqual(
+            [mock.call('/j/a.journal'), mock.call('/j/b.journal')],
+            unlink.call_args_list,
+        )
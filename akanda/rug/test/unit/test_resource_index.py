@@ -0,0 +1,97 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug.drivers import states
+from akanda.rug import resource_index
+
+
+def fake_sm(resource_id, tenant_id='tenant-a', driver='router',
+            state=states.UP):
+    sm = mock.Mock(resource_id=resource_id, tenant_id=tenant_id)
+    sm.driver.RESOURCE_NAME = driver
+    sm.instance.state = state
+    return sm
+
+
+class TestResourceIndex(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResourceIndex, self).setUp()
+        self.index = resource_index.ResourceIndex()
+        self.sms = [
+            fake_sm('r1'),
+            fake_sm('r2', state=states.ERROR),
+            fake_sm('r3', tenant_id='tenant-b', state=states.ERROR),
+            fake_sm('r4', tenant_id='tenant-b', driver='loadbalancer'),
+        ]
+        for sm in self.sms:
+            self.index.add(sm)
+
+    def _ids(self, sms):
+        return sorted(sm.resource_id for sm in sms)
+
+    def test_get(self):
+        self.assertEqual(4, len(self.index))
+        self.assertIn('r2', self.index)
+        self.assertIs(self.sms[1], self.index.get('r2'))
+        self.assertIsNone(self.index.get('missing'))
+
+    def test_find(self):
+        self.assertEqual(['r2', 'r3'],
+                         self._ids(self.index.find(state=states.ERROR)))
+        self.assertEqual(['r3', 'r4'],
+                         self._ids(self.index.find(tenant_id='tenant-b')))
+        self.assertEqual(['r4'],
+                         self._ids(self.index.find(driver='loadbalancer')))
+        self.assertEqual(['r3'], self._ids(self.index.find(
+            tenant_id='tenant-b', state=states.ERROR)))
+        self.assertEqual([], self.index.find(tenant_id='tenant-c'))
+        self.assertEqual(['r1', 'r2', 'r3', 'r4'],
+                         self._ids(self.index.find()))
+
+    def test_set_state(self):
+        self.index.set_state('r1', states.ERROR)
+        self.index.set_state('r2', states.CONFIGURED)
+        self.assertEqual(['r1', 'r3'],
+                         self._ids(self.index.find(state=states.ERROR)))
+        self.assertEqual({states.ERROR: 2, states.UP: 1,
+                          states.CONFIGURED: 1},
+                         self.index.state_counts())
+
+    def test_set_state_not_indexed(self):
+        self.index.set_state('missing', states.ERROR)
+        self.assertNotIn('missing', self.index)
+        self.assertEqual(2, len(self.index.find(state=states.ERROR)))
+
+    def test_remove(self):
+        self.assertIs(self.sms[2], self.index.remove('r3'))
+        self.assertIsNone(self.index.remove('r3'))
+        self.assertEqual(['r2'],
+                         self._ids(self.index.find(state=states.ERROR)))
+        self.assertEqual(['r4'],
+                         self._ids(self.index.find(tenant_id='tenant-b')))
+
+    def test_add_replaces(self):
+        self.index.add(fake_sm('r2', tenant_id='tenant-c'))
+        self.assertEqual(4, len(self.index))
+        self.assertEqual(['r1'],
+                         self._ids(self.index.find(tenant_id='tenant-a')))
+        self.assertEqual(['r2'],
+                         self._ids(self.index.find(tenant_id='tenant-c')))
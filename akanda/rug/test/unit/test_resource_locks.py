@@ -0,0 +1,59 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest2 as unittest
+
+from akanda.rug import resource_locks
+
+
+class TestResourceLocks(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResourceLocks, self).setUp()
+        self.locks = resource_locks.ResourceLocks(stripes=4)
+
+    def test_mark_busy(self):
+        self.assertTrue(self.locks.mark_busy('r1'))
+        self.assertFalse(self.locks.mark_busy('r1'))
+        self.assertIn('r1', self.locks)
+        self.assertTrue(self.locks.is_busy('r1'))
+        self.assertEqual(1, len(self.locks))
+
+    def test_clear_busy(self):
+        self.locks.mark_busy('r1')
+        self.assertTrue(self.locks.clear_busy('r1'))
+        self.assertFalse(self.locks.clear_busy('r1'))
+        self.assertNotIn('r1', self.locks)
+        self.assertEqual(0, len(self.locks))
+
+    def test_lock_per_resource(self):
+        self.assertIs(self.locks.lock('r1'), self.locks.lock('r1'))
+        locks = set(self.locks.lock('r%d' % i) for i in range(100))
+        self.assertEqual(4, len(locks))
+
+    def test_stripes_independent(self):
+        ids = ['r%d' % i for i in range(100)]
+        other = [i for i in ids
+                 if self.locks.lock(i) is not self.locks.lock(ids[0])][0]
+        with self.locks.lock(ids[0]):
+            self.assertTrue(self.locks.lock(other).acquire(False))
+            self.locks.lock(other).release()
+
+    def test_at_least_one_stripe(self):
+        locks = resource_locks.ResourceLocks(stripes=0)
+        self.assertTrue(locks.mark_busy('r1'))
+        self.assertIs(locks.lock('r1'), locks.lock('r2'))
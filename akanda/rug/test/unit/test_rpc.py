@@ -149,6 +149,16 @@ class TestConnection(testtools.TestCase):
         self.connection._add_server_thread.assert_called_with(
             'fake_listener_server')
 
+    @mock.patch.object(oslo_messaging, 'get_notification_listener')
+    def test_create_notification_listener_clustered(self, fake_get_listener):
+        self.config(enabled=True, group='coordination')
+        self.connection._add_server_thread = mock.MagicMock()
+        self.connection.create_notification_listener(
+            endpoints=[], exchange='foo_exchange', topic='foo_topic')
+        fake_get_listener.assert_called_with(
+            'fake_transport', ['fake_target'], [],
+            pool='akanda.foo_topic.test_host')
+
     @mock.patch('threading.Thread')
     def test__add_server_thread(self, fake_thread):
         fake_thread.return_value = 'fake_server_thread'
@@ -16,12 +16,15 @@
 
 
 import mock
+import multiprocessing
 import uuid
 
 import unittest2 as unittest
 
 from oslo_config import cfg
 
+from akanda.rug import commands
+from akanda.rug import event
 from akanda.rug import scheduler
 
 
@@ -33,6 +36,17 @@ class TestScheduler(unittest.TestCase):
             ValueError,
             scheduler.Scheduler, mock.Mock)
 
+    @mock.patch('multiprocessing.Process')
+    def test_all_zero_weights(self, process):
+        cfg.CONF.num_worker_processes = 2
+        p = mock.patch.object(cfg.CONF, 'worker_process_weights',
+                              {'p00': '0', 'p01': '0'})
+        p.start()
+        self.addCleanup(p.stop)
+        self.assertRaises(ValueError, scheduler.Scheduler, mock.Mock)
+        # Rejected before any worker process was started.
+        self.assertFalse(process.called)
+
     @mock.patch('multiprocessing.Process')
     def test_creating_workers(self, process):
         cfg.CONF.num_worker_processes = 2
@@ -53,6 +67,341 @@ class TestScheduler(unittest.TestCase):
             self.assertEqual(w['queue'].close.call_count, 2)
             self.assertEqual(w['worker'].join.call_count, 2)
 
+    @mock.patch('multiprocessing.Process')
+    @mock.patch('multiprocessing.JoinableQueue')
+    def test_handle_message_batches(self, queue, process):
+        cfg.CONF.num_worker_processes = 1
+        cfg.CONF.ipc_batch_size = 3
+        s = scheduler.Scheduler(mock.Mock)
+        q = s.workers[0]['queue']
+        target = str(uuid.uuid4())
+        s.handle_message(target, 'm1')
+        s.handle_message(target, 'm2')
+        self.assertEqual(0, q.put.call_count)
+        s.handle_message(target, 'm3')
+        q.put.assert_called_once_with(
+            [(target, 'm1'), (target, 'm2'), (target, 'm3')])
+
+    @mock.patch('multiprocessing.Process')
+    @mock.patch('multiprocessing.JoinableQueue')
+    def test_stop_flushes_partial_batch(self, queue, process):
+        cfg.CONF.num_worker_processes = 1
+        cfg.CONF.ipc_batch_size = 64
+        s = scheduler.Scheduler(mock.Mock)
+        q = s.workers[0]['queue']
+        target = str(uuid.uuid4())
+        s.handle_message(target, 'm1')
+        s.stop()
+        self.assertEqual(
+            [mock.call([(target, 'm1')]), mock.call(None)],
+            q.put.call_args_list,
+        )
+
+    @mock.patch('akanda.rug.snapshot.find')
+    @mock.patch('akanda.rug.journal.find')
+    @mock.patch('akanda.rug.populate.repopulate_workers')
+    @mock.patch('multiprocessing.Process')
+    @mock.patch('multiprocessing.JoinableQueue')
+    def test_check_workers_restarts_dead(self, queue, process, repopulate,
+                                         find, find_snapshots):
+        find.return_value = ['/j/p01-42-abc.journal']
+        find_snapshots.return_value = ['/s/p01-42-def.snapshot']
+        cfg.CONF.num_worker_processes = 2
+        for name, value in [('journal_dir', '/j'), ('snapshot_dir', '/s')]:
+            p = mock.patch.object(cfg.CONF, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        old_queue, new_queue = mock.Mock(), mock.Mock()
+        queue.side_effect = [mock.Mock(), old_queue, new_queue]
+        s = scheduler.Scheduler(mock.Mock)
+        alive, dead = mock.Mock(), mock.Mock()
+        alive.is_alive.return_value = True
+        dead.is_alive.return_value = False
+        dead.name = 'p01'
+        dead.pid = 42
+        s.workers[0]['worker'] = alive
+        s.workers[1]['worker'] = dead
+        writer = s.workers[1]['writer']
+
+        restarted = s.check_workers()
+
+        self.assertEqual([s.workers[1]], restarted)
+        self.assertIs(alive, s.workers[0]['worker'])
+        self.assertIsNot(dead, s.workers[1]['worker'])
+        self.assertEqual('p01', process.call_args[1]['name'])
+        self.assertIs(new_queue, s.workers[1]['queue'])
+        # The same writer is kept, pointing at the new queue.
+        self.assertIs(writer, s.workers[1]['writer'])
+        self.assertIs(new_queue, writer.queue)
+        old_queue.cancel_join_thread.assert_called_once_with()
+        old_queue.close.assert_called_once_with()
+        find.assert_called_once_with('/j', 'p01', 42)
+        find_snapshots.assert_called_once_with('/s', 'p01', 42)
+        repopulate.assert_called_once_with(
+            s, [s.workers[1]],
+            ['/j/p01-42-abc.journal'],
+            ['/s/p01-42-def.snapshot'],
+        )
+
+    @mock.patch('akanda.rug.populate.repopulate_workers')
+    @mock.patch('multiprocessing.Process')
+    @mock.patch('multiprocessing.JoinableQueue')
+    def test_check_workers_all_alive(self, queue, process, repopulate):
+        cfg.CONF.num_worker_processes = 2
+        s = scheduler.Scheduler(mock.Mock)
+        process.return_value.is_alive.return_value = True
+        self.assertEqual([], s.check_workers())
+        self.assertFalse(repopulate.called)
+
+    @mock.patch('akanda.rug.populate.repopulate_workers')
+    @mock.patch('multiprocessing.Process')
+    @mock.patch('multiprocessing.JoinableQueue')
+    def test_check_workers_stopping(self, queue, process, repopulate):
+        cfg.CONF.num_worker_processes = 1
+        s = scheduler.Scheduler(mock.Mock)
+        process.return_value.is_alive.return_value = False
+        s.stop()
+        self.assertEqual([], s.check_workers())
+        self.assertFalse(repopulate.called)
+
+
+class TestLoadPlacement(unittest.TestCase):
+
+    def setUp(self):
+        super(TestLoadPlacement, self).setUp()
+        cfg.CONF.set_override('worker_placement', 'load')
+        self.addCleanup(cfg.CONF.clear_override, 'worker_placement')
+        cfg.CONF.num_worker_processes = 2
+        cfg.CONF.ipc_batch_size = 64
+        for name in ('Process', 'JoinableQueue', 'Queue'):
+            p = mock.patch('multiprocessing.%s' % name)
+            p.start()
+            self.addCleanup(p.stop)
+        p = mock.patch('threading.Thread')
+        p.start()
+        self.addCleanup(p.stop)
+        self.s = scheduler.Scheduler(mock.Mock)
+        for w in self.s.workers:
+            w['queue'].qsize.return_value = 0
+        self.table = self.s.dispatcher.placement
+        self.tenant_id = str(uuid.uuid4())
+
+    def _sent(self, idx):
+        return list(self.s.workers[idx]['writer']._pending)
+
+    def test_new_tenant_to_least_loaded(self):
+        self.s.workers[0]['writer'].put('x', 'backlog')
+        self.s.handle_message(self.tenant_id, 'm1')
+        self.assertEqual([(self.tenant_id, 'm1')], self._sent(1))
+        self.assertEqual(1, self.table.owner(self.tenant_id, None))
+
+    def test_workers_report_results(self):
+        self.assertIsNotNone(self.s._results)
+        for call in multiprocessing.Process.call_args_list:
+            self.assertIs(self.s._results, call[1]['kwargs']['outq'])
+
+    def test_rebalance_starts_handoff(self):
+        self.table.pick_migration = mock.Mock(
+            return_value=(self.tenant_id, 0, 1))
+        self.assertEqual((self.tenant_id, 0, 1), self.s.rebalance())
+        q = self.s.workers[0]['queue']
+        batch = q.put.call_args[0][0]
+        self.assertEqual(1, len(batch))
+        target, msg = batch[0]
+        self.assertEqual(self.tenant_id, target)
+        self.assertEqual(commands.TENANT_HANDOFF, msg.body['command'])
+        # Messages for the tenant are held until the handoff is done.
+        self.s.handle_message(self.tenant_id, 'm1')
+        self.assertEqual([], self._sent(0) + self._sent(1))
+
+    def test_rebalance_busy(self):
+        self.table.is_quiet = mock.Mock(return_value=False)
+        self.table.pick_migration = mock.Mock()
+        self.assertIsNone(self.s.rebalance())
+        self.assertFalse(self.table.pick_migration.called)
+
+    def test_handoff_released(self):
+        self.table.owner(self.tenant_id, lambda: [0, 0])
+        self.table.start_migration(self.tenant_id, 1)
+        self.s.handle_message(self.tenant_id, 'm1')
+        resource = event.Resource('router', 'r1', self.tenant_id)
+        self.s.handle_result({
+            'command': commands.TENANT_HANDOFF,
+            'tenant_id': self.tenant_id,
+            'released': True,
+            'resources': [resource],
+        })
+        sent = self._sent(1)
+        self.assertEqual([], self._sent(0))
+        self.assertEqual(2, len(sent))
+        self.assertEqual(event.POLL, sent[0][1].crud)
+        self.assertIs(resource, sent[0][1].resource)
+        self.assertEqual((self.tenant_id, 'm1'), sent[1])
+
+    def test_handoff_not_released(self):
+        self.table.owner(self.tenant_id, lambda: [0, 0])
+        self.table.start_migration(self.tenant_id, 1)
+        self.s.handle_message(self.tenant_id, 'm1')
+        self.s.handle_result({
+            'command': commands.TENANT_HANDOFF,
+            'tenant_id': self.tenant_id,
+            'released': False,
+            'resources': [],
+        })
+        self.assertEqual([(self.tenant_id, 'm1')], self._sent(0))
+
+    def test_handoff_timeout(self):
+        self.table.owner(self.tenant_id, lambda: [0, 0])
+        self.table.start_migration(self.tenant_id, 1)
+        self.s.handle_message(self.tenant_id, 'm1')
+        self.table.expired_migrations = mock.Mock(
+            return_value=[self.tenant_id])
+        self.table.pick_migration = mock.Mock(return_value=None)
+        self.s.rebalance()
+        self.assertEqual([(self.tenant_id, 'm1')], self._sent(0))
+
+    def test_wildcard_to_all(self):
+        self.s.handle_message('*', 'm1')
+        self.assertEqual([('*', 'm1')], self._sent(0))
+        self.assertEqual([('*', 'm1')], self._sent(1))
+
+
+class TestClusteredScheduler(unittest.TestCase):
+
+    def setUp(self):
+        super(TestClusteredScheduler, self).setUp()
+        cfg.CONF.num_worker_processes = 1
+        cfg.CONF.ipc_batch_size = 64
+        for name in ('Process', 'JoinableQueue', 'Queue'):
+            p = mock.patch('multiprocessing.%s' % name)
+            p.start()
+            self.addCleanup(p.stop)
+        p = mock.patch('threading.Thread')
+        p.start()
+        self.addCleanup(p.stop)
+        self.coordinator = mock.Mock()
+        self.s = scheduler.Scheduler(mock.Mock, coordinator=self.coordinator)
+        self.tenant_id = str(uuid.uuid4())
+
+    def _sent(self):
+        return list(self.s.workers[0]['writer']._pending)
+
+    def _result(self, released):
+        self.s.handle_result({
+            'command': commands.TENANT_HANDOFF,
+            'tenant_id': self.tenant_id,
+            'released': released,
+            'resources': [],
+        })
+
+    def test_on_change_registered(self):
+        self.assertEqual(self.s.cluster_changed, self.coordinator.on_change)
+        self.assertIsNotNone(self.s._results)
+
+    def test_owned_tenant(self):
+        self.coordinator.owns.return_value = True
+        self.s.handle_message(self.tenant_id, 'm1')
+        self.assertEqual([(self.tenant_id, 'm1')], self._sent())
+
+    def test_tenant_owned_elsewhere(self):
+        self.coordinator.owns.return_value = False
+        self.s.handle_message(self.tenant_id, 'm1')
+        self.assertEqual([], self._sent())
+
+    def test_wildcard(self):
+        self.coordinator.owns.return_value = False
+        self.s.handle_message('*', 'm1')
+        self.assertEqual([('*', 'm1')], self._sent())
+
+    def test_release_tenant(self):
+        self.s.release_tenant(self.tenant_id)
+        sent = self._sent()
+        self.assertEqual(1, len(sent))
+        self.assertEqual(commands.TENANT_HANDOFF, sent[0][1].body['command'])
+        self._result(False)
+        self.assertEqual(1, self.s.retry_releases())
+        self._result(True)
+        self.assertEqual(0, self.s.retry_releases())
+        self.assertEqual(2, len(self._sent()))
+
+    @mock.patch('akanda.rug.populate.rebalance_cluster')
+    def test_cluster_changed(self, rebalance):
+        self.s.release_tenant(self.tenant_id)
+        self.coordinator.owns.return_value = True
+        self.s.cluster_changed('old', 'new')
+        rebalance.assert_called_once_with(self.s, 'old', 'new')
+        # The tenant came back before it was released.
+        self.assertEqual(0, self.s.retry_releases())
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def test_flush_empty(self):
+        q = mock.Mock()
+        w = scheduler.BatchWriter(q, 10)
+        w.flush()
+        self.assertFalse(q.put.called)
+
+    def test_flush_partial(self):
+        q = mock.Mock()
+        pending = mock.Mock()
+        w = scheduler.BatchWriter(q, 10, pending)
+        w.put('t', 'm')
+        self.assertEqual(1, len(w))
+        pending.set.assert_called_once_with()
+        w.flush()
+        q.put.assert_called_once_with([('t', 'm')])
+        self.assertEqual(0, len(w))
+
+    def test_reset(self):
+        q1, q2 = mock.Mock(), mock.Mock()
+        w = scheduler.BatchWriter(q1, 10)
+        w.put('t', 'm')
+        w.reset(q2)
+        w.put('t', 'm2')
+        w.flush()
+        self.assertFalse(q1.put.called)
+        q2.put.assert_called_once_with([('t', 'm2')])
+
+    def test_batch_size_one(self):
+        q = mock.Mock()
+        w = scheduler.BatchWriter(q, 0)
+        w.put('t', 'm')
+        q.put.assert_called_once_with([('t', 'm')])
+
+
+class TestWorkerMain(unittest.TestCase):
+
+    @mock.patch('akanda.rug.daemon.ignore_signals')
+    def test_batches_delivered_in_order(self, ignore):
+        inq = mock.Mock()
+        inq.get.side_effect = [[('a', 1), ('b', 2)], [('c', 3)], None]
+        worker = mock.Mock()
+        scheduler._worker(inq, lambda: worker)
+        self.assertEqual(
+            [mock.call('a', 1), mock.call('b', 2), mock.call('c', 3),
+             mock.call(None, None)],
+            worker.handle_message.call_args_list,
+        )
+
+    @mock.patch('akanda.rug.daemon.ignore_signals')
+    def test_error_does_not_drop_batch(self, ignore):
+        inq = mock.Mock()
+        inq.get.side_effect = [[('a', 1), ('b', 2)], None]
+        worker = mock.Mock()
+        worker.handle_message.side_effect = [Exception('boom'), None, None]
+        scheduler._worker(inq, lambda: worker)
+        self.assertEqual(3, worker.handle_message.call_count)
+
+    @mock.patch('akanda.rug.daemon.ignore_signals')
+    def test_results_returned(self, ignore):
+        inq, outq = mock.Mock(), mock.Mock()
+        inq.get.side_effect = [[('a', 1), ('b', 2)], None]
+        worker = mock.Mock()
+        worker.handle_message.side_effect = [None, {'result': 2}, None]
+        scheduler._worker(inq, lambda: worker, outq)
+        outq.put.assert_called_once_with({'result': 2})
+
 
 class TestDispatcher(unittest.TestCase):
 
@@ -66,13 +415,47 @@ class TestDispatcher(unittest.TestCase):
         return str(uuid.UUID(fields=(1, 2, 3, 4, 5, i)))
 
     def test_pick(self):
-        for i in range(len(self.workers)):
+        for i in range(100):
             router_id = self._mk_uuid(i)
-            self.assertEqual(
-                [i],
-                self.d.pick_workers(router_id),
-                'Incorrect index for %s' % router_id,
-            )
+            picked = self.d.pick_workers(router_id)
+            self.assertEqual(1, len(picked))
+            self.assertIn(picked[0], self.workers)
+            # The same target always goes to the same worker.
+            self.assertEqual(picked, self.d.pick_workers(router_id))
+
+    def test_pick_uses_every_worker(self):
+        picked = set()
+        for i in range(200):
+            picked.update(self.d.pick_workers(self._mk_uuid(i)))
+        self.assertEqual(set(self.workers), picked)
+
+    def test_pick_normalizes_uuid(self):
+        router_id = self._mk_uuid(3)
+        self.assertEqual(
+            self.d.pick_workers(router_id),
+            self.d.pick_workers(router_id.upper().replace('-', '')),
+        )
+
+    def test_resize_moves_few_targets(self):
+        targets = [str(uuid.uuid4()) for i in range(1000)]
+        before = dict((t, self.d.pick_workers(t)) for t in targets)
+        bigger = scheduler.Dispatcher(range(6))
+        moved = [t for t in targets if bigger.pick_workers(t) != before[t]]
+        # Only the targets claimed by the new worker should move.
+        for t in moved:
+            self.assertEqual([5], bigger.pick_workers(t))
+        self.assertLess(len(moved), len(targets) * 0.3)
+
+    def test_all_zero_weights(self):
+        self.assertRaises(ValueError, scheduler.Dispatcher, range(2),
+                          weights={'p00': 0, 'p01': 0})
+
+    def test_weights(self):
+        d = scheduler.Dispatcher(range(2), weights={'p01': 3})
+        counts = {0: 0, 1: 0}
+        for i in range(1000):
+            counts[d.pick_workers(str(uuid.uuid4()))[0]] += 1
+        self.assertGreater(counts[1], counts[0] * 2)
 
     def test_pick_none(self):
         router_id = None
@@ -84,10 +467,10 @@ class TestDispatcher(unittest.TestCase):
 
     def test_pick_with_spaces(self):
         for i in range(len(self.workers)):
-            router_id = ' %s ' % self._mk_uuid(i)
+            router_id = self._mk_uuid(i)
             self.assertEqual(
-                [i],
                 self.d.pick_workers(router_id),
+                self.d.pick_workers(' %s ' % router_id),
                 'Incorrect index for %s' % router_id,
             )
 
@@ -0,0 +1,100 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import time
+
+import unittest2 as unittest
+
+from akanda.rug import snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = snapshot.snapshot_path(self.dir, 'p00', 123)
+
+    def _record(self, resource_id, state='configured'):
+        return {'resource_id': resource_id, 'tenant_id': 't1',
+                'state': state}
+
+    def test_snapshot_path(self):
+        self.assertEqual(self.dir, os.path.dirname(self.path))
+        name = os.path.basename(self.path)
+        self.assertTrue(name.startswith('p00-123-'))
+        self.assertTrue(name.endswith('.snapshot'))
+
+    def test_snapshot_path_unique(self):
+        self.assertNotEqual(self.path,
+                            snapshot.snapshot_path(self.dir, 'p00', 123))
+
+    def test_write_and_load(self):
+        records = [self._record('r1'), self._record('r2')]
+        snapshot.write(self.path, records)
+        self.assertEqual(
+            records,
+            sorted(snapshot.load([self.path]),
+                   key=lambda r: r['resource_id']),
+        )
+
+    def test_write_replaces(self):
+        snapshot.write(self.path, [self._record('r1')])
+        snapshot.write(self.path, [self._record('r2')])
+        self.assertEqual([self._record('r2')], snapshot.load([self.path]))
+        self.assertEqual([self.path], snapshot.find(self.dir))
+
+    def test_load_newest_wins(self):
+        old = snapshot.snapshot_path(self.dir, 'p00', 1)
+        snapshot.write(old, [self._record('r1', 'up')])
+        snapshot.write(self.path, [self._record('r1', 'configured')])
+        os.utime(old, (time.time() - 60, time.time() - 60))
+        self.assertEqual([self._record('r1', 'configured')],
+                         snapshot.load([self.path, old]))
+
+    def test_load_skips_stale(self):
+        snapshot.write(self.path, [self._record('r1')])
+        os.utime(self.path, (time.time() - 600, time.time() - 600))
+        self.assertEqual([], snapshot.load([self.path], max_age=300))
+        self.assertEqual(1, len(snapshot.load([self.path], max_age=900)))
+
+    def test_load_skips_bad_record(self):
+        with open(self.path, 'w') as f:
+            f.write('{"resource_id": "r1", "tenant_id": "t1"}\n')
+            f.write('{"resource_id": "r2", "ten')
+        self.assertEqual(['r1'],
+                         [r['resource_id']
+                          for r in snapshot.load([self.path])])
+
+    def test_load_missing(self):
+        self.assertEqual([], snapshot.load([self.path]))
+
+    def test_find(self):
+        snapshot.write(self.path, [])
+        with open(self.path + '.tmp', 'w'):
+            pass
+        self.assertEqual([self.path], snapshot.find(self.dir))
+
+    def test_find_process(self):
+        snapshot.write(self.path, [])
+        snapshot.write(snapshot.snapshot_path(self.dir, 'p00', 12), [])
+        snapshot.write(snapshot.snapshot_path(self.dir, 'p01', 123), [])
+        self.assertEqual([self.path], snapshot.find(self.dir, 'p00', 123))
@@ -16,6 +16,7 @@
 
 
 from collections import deque
+import logging
 
 import mock
 import unittest2 as unittest
@@ -56,6 +57,73 @@ class BaseTestStateCase(unittest.TestCase):
         return result
 
 
+class TestInbox(unittest.TestCase):
+
+    def _inbox(self, actions):
+        inbox = state.Inbox()
+        for action in actions:
+            inbox.append(action)
+        return list(inbox)
+
+    def test_empty(self):
+        inbox = state.Inbox()
+        self.assertEqual(0, len(inbox))
+        self.assertFalse(inbox)
+        self.assertRaises(IndexError, inbox.popleft)
+
+    def test_repeated_actions_collapse(self):
+        self.assertEqual([event.UPDATE], self._inbox([event.UPDATE] * 1000))
+
+    def test_polls_only(self):
+        self.assertEqual([event.POLL], self._inbox([event.POLL] * 3))
+
+    def test_poll_dropped_with_other_work(self):
+        self.assertEqual(
+            [event.UPDATE, event.READ],
+            self._inbox([event.POLL, event.UPDATE, event.POLL, event.READ]),
+        )
+
+    def test_create_replaces_update(self):
+        self.assertEqual([event.CREATE],
+                         self._inbox([event.UPDATE, event.CREATE]))
+
+    def test_update_after_create_dropped(self):
+        self.assertEqual([event.CREATE],
+                         self._inbox([event.CREATE, event.UPDATE]))
+
+    def test_rebuild_replaces_create_and_update(self):
+        self.assertEqual(
+            [event.REBUILD],
+            self._inbox([event.UPDATE, event.CREATE, event.REBUILD]),
+        )
+
+    def test_order_kept(self):
+        self.assertEqual(
+            [event.REBUILD, event.UPDATE, event.READ],
+            self._inbox([event.REBUILD, event.UPDATE, event.READ,
+                         event.UPDATE, event.READ]),
+        )
+
+    def test_delete_kept(self):
+        self.assertEqual(
+            [event.UPDATE, event.DELETE],
+            self._inbox([event.UPDATE, event.DELETE, event.DELETE]),
+        )
+
+    def test_appendleft(self):
+        inbox = state.Inbox([event.READ])
+        inbox.appendleft(event.UPDATE)
+        inbox.appendleft(event.UPDATE)
+        self.assertEqual([event.UPDATE, event.READ], list(inbox))
+        self.assertEqual(event.UPDATE, inbox.popleft())
+        self.assertEqual([event.READ], list(inbox))
+
+    def test_clear(self):
+        inbox = state.Inbox([event.UPDATE])
+        inbox.clear()
+        self.assertEqual([], list(inbox))
+
+
 class TestBaseState(BaseTestStateCase):
     def test_execute(self):
         self.assertEqual(
@@ -121,6 +189,15 @@ class TestCalcActionState(BaseTestStateCase):
         ]
         self._test_hlpr(event.UPDATE, events, 1)
 
+    def test_execute_collapsed_inbox(self):
+        self.params.queue = state.Inbox(
+            [event.UPDATE, event.POLL, event.UPDATE, event.CREATE])
+        self.assertEqual(
+            event.CREATE,
+            self.state.execute(event.POLL, self.ctx),
+        )
+        self.assertEqual(0, len(self.params.queue))
+
     def test_execute_events_ending_with_poll(self):
         events = [
             event.UPDATE,
@@ -519,6 +596,57 @@ class TestReadStatsState(BaseTestStateCase):
         self._test_transition_hlpr(event.POLL, state.CalcAction)
 
 
+class TestTransitionTable(BaseTestStateCase):
+
+    def test_flyweight_states(self):
+        st = self.params.state(state.CalcAction)
+        self.assertIs(st, self.params.state(state.CalcAction))
+        self.assertIsNot(st, self.params.state(state.Alive))
+
+    def test_transition_reuses_states(self):
+        self.instance.state = states.CONFIGURED
+        st = self.params.state(state.CalcAction)
+        alive = st.transition(event.UPDATE, self.ctx)
+        configure = alive.transition(event.UPDATE, self.ctx)
+        self.assertIsInstance(configure, state.ConfigureInstance)
+        self.assertIs(st, configure.transition(event.POLL, self.ctx))
+        self.assertIs(alive, st.transition(event.UPDATE, self.ctx))
+
+    def test_table_matches_rules(self):
+        for (cls, action, instance_state), result in \
+                state.TRANSITIONS.items():
+            self.assertEqual(
+                state._match(cls, action, instance_state), result)
+
+    def test_every_state_has_transitions(self):
+        for cls in (state.CalcAction, state.PushUpdate, state.ClearError,
+                    state.Alive, state.CreateInstance, state.CheckBoot,
+                    state.ReplugInstance, state.StopInstance,
+                    state.RebuildInstance, state.ConfigureInstance,
+                    state.ReadStats):
+            for action in state.ACTIONS:
+                for instance_state in state.INSTANCE_STATES:
+                    next_cls, _ = state.TRANSITIONS[
+                        cls, action, instance_state]
+                    self.assertIsNotNone(next_cls)
+
+    def test_unknown_action(self):
+        self.instance.state = states.CONFIGURED
+        st = self.params.state(state.Alive)
+        self.assertIsInstance(st.transition('fake', self.ctx),
+                              state.ConfigureInstance)
+
+    def test_dot_graph(self):
+        graph = state.dot_graph()
+        self.assertTrue(graph.startswith('digraph state_machine {'))
+        self.assertIn(
+            'CalcAction -> ClearError [label="delete / error '
+            '(then StopInstance)"];',
+            graph,
+        )
+        self.assertIn('ReadStats -> CalcAction [label="* / *"];', graph)
+
+
 class TestAutomaton(unittest.TestCase):
     def setUp(self):
         super(TestAutomaton, self).setUp()
@@ -544,6 +672,16 @@ class TestAutomaton(unittest.TestCase):
             reboot_error_threshold=5,
         )
 
+    @mock.patch('time.time')
+    def test_send_message_last_active(self, fake_time):
+        fake_time.return_value = self.sm.last_active + 100
+        poll = mock.Mock(crud=event.POLL)
+        self.sm.instance.state = states.CONFIGURED
+        self.sm.send_message(poll)
+        self.assertNotEqual(fake_time.return_value, self.sm.last_active)
+        self.sm.send_message(mock.Mock(crud=event.UPDATE, body={}))
+        self.assertEqual(fake_time.return_value, self.sm.last_active)
+
     def test_send_message(self):
         message = mock.Mock()
         message.crud = 'update'
@@ -557,16 +695,30 @@ class TestAutomaton(unittest.TestCase):
 
     def test_send_message_over_threshold(self):
         message = mock.Mock()
-        message.crud = 'update'
-        for i in range(3):
+        # Repeated actions are collapsed, so only distinct ones make
+        # the queue grow.
+        for crud in ('fake1', 'fake2', 'fake3'):
+            message.crud = crud
             self.sm.send_message(message)
+        message.crud = 'fake4'
         with mock.patch.object(self.sm.driver, 'log') as logger:
             self.sm.send_message(message)
-            logger.warning.assert_called_with(
+            logger.log_limited.assert_called_with(
+                logging.WARNING,
+                'queue_length',
                 'incoming message brings queue length to %s',
                 4,
             )
 
+    def test_send_message_poll_coalesced(self):
+        self.sm.instance.state = states.CONFIGURED
+        self.assertTrue(self.sm.send_message(mock.Mock(crud=event.POLL)))
+        self.assertFalse(self.sm.send_message(mock.Mock(crud=event.POLL)))
+        self.assertTrue(
+            self.sm.send_message(mock.Mock(crud=event.UPDATE, body={})))
+        self.assertFalse(self.sm.send_message(mock.Mock(crud=event.POLL)))
+        self.assertEqual([event.UPDATE], list(self.sm._queue))
+
     def test_send_message_deleting(self):
         message = mock.Mock()
         message.crud = 'update'
@@ -634,6 +786,38 @@ class TestAutomaton(unittest.TestCase):
         self.sm.update(self.ctx)
         self.delete_callback.called_once_with()
 
+    def test_update_traced(self):
+        self.sm.send_message(mock.Mock(crud=event.UPDATE, body={}))
+        self.sm.instance.state = states.CONFIGURED
+        with mock.patch.object(self.sm.state, 'execute') as execute:
+            execute.return_value = event.UPDATE
+            with mock.patch.object(self.sm.state, 'transition') as trans:
+                trans.return_value = state.Exit(mock.Mock())
+                with mock.patch('time.time') as fake_time:
+                    fake_time.side_effect = [10.0, 10.5]
+                    self.sm.update(self.ctx)
+        self.assertEqual(
+            [state.Transition(10.0, 'CalcAction', event.UPDATE,
+                              states.CONFIGURED, 0.5)],
+            self.sm.trace(),
+        )
+
+    def test_trace_bounded(self):
+        sm = state.Automaton(
+            driver=self.fake_driver,
+            resource_id=self.fake_driver.id,
+            tenant_id='tenant-id',
+            delete_callback=self.delete_callback,
+            bandwidth_callback=self.bandwidth_callback,
+            worker_context=self.ctx,
+            queue_warning_threshold=3,
+            reboot_error_threshold=5,
+            trace_size=2,
+        )
+        for i in range(3):
+            sm._trace.append((i, sm.state, event.POLL, states.UP, 0))
+        self.assertEqual([1, 2], [t.timestamp for t in sm.trace()])
+
     def test_update_exception_during_excute(self):
         message = mock.Mock()
         message.crud = 'fake'
@@ -703,3 +887,75 @@ class TestAutomaton(unittest.TestCase):
         with mock.patch.object(self.sm, 'instance') as instance:
             instance.state = states.UP
             self.assertFalse(self.sm.has_error())
+
+
+class TestLazyAutomaton(unittest.TestCase):
+    def setUp(self):
+        super(TestLazyAutomaton, self).setUp()
+
+        self.ctx = mock.Mock()  # worker context
+        self.fake_driver = fakes.fake_driver()
+
+        self.instance_mgr_cls = \
+            mock.patch('akanda.rug.instance_manager.InstanceManager').start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.sm = state.Automaton(
+            driver=self.fake_driver,
+            resource_id=self.fake_driver.id,
+            tenant_id='tenant-id',
+            delete_callback=mock.Mock(),
+            bandwidth_callback=mock.Mock(),
+            worker_context=None,
+            queue_warning_threshold=3,
+            reboot_error_threshold=5,
+            snapshot={'state': states.UP},
+        )
+
+    def test_nothing_looked_up(self):
+        self.assertFalse(self.sm.initialized)
+        self.assertFalse(self.fake_driver.post_init.called)
+        self.assertFalse(self.instance_mgr_cls.called)
+        self.assertFalse(self.sm.has_error())
+        self.assertEqual({'state': states.UP}, self.sm.snapshot())
+
+    def test_send_message(self):
+        self.assertTrue(
+            self.sm.send_message(mock.Mock(crud=event.POLL, body={})))
+        self.assertEqual([event.POLL], list(self.sm._queue))
+        self.assertFalse(self.instance_mgr_cls.called)
+
+    def test_update_initializes(self):
+        self.sm.update(self.ctx)
+        self.assertTrue(self.sm.initialized)
+        self.fake_driver.post_init.assert_called_once_with(self.ctx)
+        self.assertEqual({'state': states.UP},
+                         self.instance_mgr_cls.call_args[1]['snapshot'])
+        self.assertEqual(self.sm.instance.snapshot.return_value,
+                         self.sm.snapshot())
+
+    def test_update_initialize_fails(self):
+        self.sm.send_message(mock.Mock(crud=event.UPDATE, body={}))
+        self.fake_driver.post_init.side_effect = RuntimeError('neutron')
+        self.sm.update(self.ctx)
+        self.assertFalse(self.sm.initialized)
+        self.assertFalse(self.sm.has_more_work())
+        self.fake_driver.log.exception.assert_called_once_with(
+            'could not initialize state machine for %s, dropping %s',
+            self.fake_driver.id, [event.UPDATE])
+
+    def test_update_initialize_retried(self):
+        self.fake_driver.post_init.side_effect = [RuntimeError('neutron'),
+                                                  None]
+        self.sm.send_message(mock.Mock(crud=event.UPDATE, body={}))
+        self.sm.update(self.ctx)
+        self.sm.send_message(mock.Mock(crud=event.UPDATE, body={}))
+        self.sm.update(self.ctx)
+        self.assertTrue(self.sm.initialized)
+
+    def test_rebuild_image_kept_until_initialized(self):
+        self.sm.send_message(
+            mock.Mock(crud=event.REBUILD, body={'image_uuid': 'custom'}))
+        self.assertEqual('custom', self.sm.image_uuid)
+        self.sm._lazy_initialize(self.ctx)
+        self.assertEqual('custom', self.sm.image_uuid)
@@ -20,9 +20,11 @@ import unittest2 as unittest
 import uuid
 
 from akanda.rug import event
+from akanda.rug import health
 from akanda.rug import tenant
 from akanda.rug.drivers import router
 from akanda.rug import state
+from akanda.rug import tombstones
 from akanda.rug.drivers import states
 from akanda.rug.test.unit import fakes
 
@@ -102,6 +104,41 @@ class TestTenantResourceManager(unittest.TestCase):
         sms = self.trm.get_state_machines(msg, self.ctx)
         self.assertEqual(5, len(sms))
 
+    def test_poll_slot(self):
+        ids = []
+        for i in range(10):
+            rid = str(uuid.uuid4())
+            ids.append(rid)
+            driver = fakes.fake_driver(rid)
+            sm = state.Automaton(
+                driver=driver,
+                worker_context=self.ctx,
+                resource_id=driver.id,
+                tenant_id=self.tenant_id,
+                delete_callback=None,
+                bandwidth_callback=None,
+                queue_warning_threshold=5,
+                reboot_error_threshold=5)
+            self.trm.state_machines[rid] = sm
+        r = event.Resource(
+            tenant_id=self.tenant_id,
+            id='*',
+            driver='*',
+        )
+        seen = []
+        for slot in range(3):
+            msg = event.Event(
+                resource=r,
+                crud=event.POLL,
+                body={'poll_slot': slot, 'poll_slots': 3},
+            )
+            sms = self.trm.get_state_machines(msg, self.ctx)
+            for sm in sms:
+                self.assertEqual(slot, health.poll_slot(sm.resource_id, 3))
+            seen.extend(sm.resource_id for sm in sms)
+        # Every resource is polled exactly once over the period.
+        self.assertEqual(sorted(ids), sorted(seen))
+
     def test_errored_routers(self):
         self.trm.state_machines.state_machines = {}
         for i in range(5):
@@ -142,6 +179,270 @@ class TestTenantResourceManager(unittest.TestCase):
         self.assertEqual(2, sms[0].resource_id)
         self.assertIs(self.trm.state_machines.state_machines['2'], sms[0])
 
+    def _dormant(self, resource_id='5678', state=states.DOWN):
+        sm = self._new(resource_id)
+        sm.instance.state = state
+        return sm, self.trm.make_dormant(resource_id)
+
+    def _wildcard_poll(self):
+        r = event.Resource(tenant_id=self.tenant_id, id='*', driver='*')
+        return event.Event(resource=r, crud=event.POLL, body={})
+
+    def test_make_dormant(self):
+        sm, record = self._dormant()
+        self.assertEqual('5678', record.resource_id)
+        self.assertEqual('1234', record.tenant_id)
+        self.assertEqual(sm.instance.state, record.state)
+        self.assertEqual(sm.instance.config_digest, record.config_digest)
+        self.assertNotIn('5678', self.trm.state_machines)
+        self.assertEqual(1, len(self.trm.state_machines))
+        index = self.trm.state_machines.index
+        self.assertIsNone(index.get('5678'))
+        self.assertIs(record, index.get_dormant('5678'))
+        self.assertIsNone(self.trm.make_dormant('5678'))
+
+    def test_dormant_rebuilt_by_message(self):
+        sm, record = self._dormant()
+        r = event.Resource(tenant_id=self.tenant_id, id='5678', driver=None)
+        msg = event.Event(resource=r, crud=event.UPDATE, body={})
+        sms = self.trm.get_state_machines(msg, self.ctx)
+        self.assertEqual(1, len(sms))
+        self.assertIsNot(sm, sms[0])
+        self.assertIn('5678', self.trm.state_machines)
+        self.assertEqual([], self.trm.state_machines.dormant_records())
+        self.assertIsNone(self.trm.state_machines.index.get_dormant('5678'))
+        self.assertEqual(record.last_active, sms[0].last_active)
+
+    def test_dormant_rebuilt_by_poll_in_slot(self):
+        ids = [str(uuid.uuid4()) for i in range(6)]
+        for rid in ids:
+            self._dormant(rid)
+        r = event.Resource(tenant_id=self.tenant_id, id='*', driver='*')
+        msg = event.Event(
+            resource=r,
+            crud=event.POLL,
+            body={'poll_slot': 0, 'poll_slots': 2},
+        )
+        sms = self.trm.get_state_machines(msg, self.ctx)
+        self.assertEqual(
+            sorted(rid for rid in ids if health.poll_slot(rid, 2) == 0),
+            sorted(sm.resource_id for sm in sms))
+
+    def _slot_poll(self, slot, slots):
+        r = event.Resource(tenant_id=self.tenant_id, id='*', driver='*')
+        return event.Event(resource=r, crud=event.POLL,
+                           body={'poll_slot': slot, 'poll_slots': slots})
+
+    def test_poll_slot_computed_once(self):
+        ids = [str(uuid.uuid4()) for i in range(6)]
+        for rid in ids:
+            self._new(rid)
+        with mock.patch.object(health, 'poll_slot',
+                               wraps=health.poll_slot) as poll_slot:
+            for slot in range(3):
+                self.trm.get_state_machines(self._slot_poll(slot, 3),
+                                            self.ctx)
+            self.assertEqual(6, poll_slot.call_count)
+            self._new('5678')
+            self.assertEqual(7, poll_slot.call_count)
+            sms = self.trm.get_state_machines(
+                self._slot_poll(health.poll_slot('5678', 3), 3), self.ctx)
+        self.assertIn('5678', [sm.resource_id for sm in sms])
+
+    def test_poll_slots_changed(self):
+        ids = [str(uuid.uuid4()) for i in range(6)]
+        for rid in ids:
+            self._new(rid)
+        self.trm.get_state_machines(self._slot_poll(0, 3), self.ctx)
+        sms = self.trm.get_state_machines(self._slot_poll(1, 2), self.ctx)
+        self.assertEqual(
+            sorted(rid for rid in ids if health.poll_slot(rid, 2) == 1),
+            sorted(sm.resource_id for sm in sms))
+
+    def test_deleted_not_polled(self):
+        self._new('5678')
+        slot = health.poll_slot('5678', 3)
+        self.trm.get_state_machines(self._slot_poll(slot, 3), self.ctx)
+        self.trm._delete_resource('5678')
+        self.assertEqual(
+            [], self.trm.get_state_machines(self._slot_poll(slot, 3),
+                                            self.ctx))
+
+    def _woken(self, appliance_state):
+        self._dormant('5678', states.CONFIGURED)
+        sms = self.trm.get_state_machines(self._wildcard_poll(), self.ctx)
+        self.assertEqual(['5678'], [sm.resource_id for sm in sms])
+        self.assertTrue(self.trm.woken_by_poll('5678'))
+        sms[0].instance = mock.Mock(state=appliance_state)
+        return sms[0]
+
+    def test_configured_dormant_rebuilt_by_poll(self):
+        self._woken(states.CONFIGURED)
+        self.assertIn('5678', self.trm.state_machines)
+        self.assertIsNone(self.trm.state_machines.get_dormant('5678'))
+
+    def test_return_to_dormant(self):
+        sm = self._woken(states.CONFIGURED)
+        record = self.trm.return_to_dormant('5678')
+        self.assertEqual(sm.last_active, record.last_active)
+        self.assertNotIn('5678', self.trm.state_machines)
+        self.assertIs(record, self.trm.state_machines.get_dormant('5678'))
+        self.assertFalse(self.trm.woken_by_poll('5678'))
+
+    def test_return_to_dormant_appliance_down(self):
+        self._woken(states.DOWN)
+        self.assertIsNone(self.trm.return_to_dormant('5678'))
+        self.assertIn('5678', self.trm.state_machines)
+        self.assertFalse(self.trm.woken_by_poll('5678'))
+
+    def test_return_to_dormant_after_event(self):
+        sm = self._woken(states.CONFIGURED)
+        sm.last_active += 1
+        self.assertIsNone(self.trm.return_to_dormant('5678'))
+        self.assertIn('5678', self.trm.state_machines)
+
+    def test_not_woken_by_event(self):
+        self._dormant('5678', states.CONFIGURED)
+        r = event.Resource(tenant_id=self.tenant_id, id='5678', driver=None)
+        msg = event.Event(resource=r, crud=event.UPDATE, body={})
+        self.trm.get_state_machines(msg, self.ctx)
+        self.assertFalse(self.trm.woken_by_poll('5678'))
+        self.assertIsNone(self.trm.return_to_dormant('5678'))
+
+    def test_restored_rebuilt_by_poll(self):
+        record = self._record()
+        self.trm.restore(record)
+        sms = self.trm.get_state_machines(self._wildcard_poll(), self.ctx)
+        self.assertEqual(['5678'], [sm.resource_id for sm in sms])
+        self.assertEqual(record.last_active, sms[0].last_active)
+
+    def test_dormant_not_rebuilt(self):
+        self._dormant('5678')
+        sms = self.trm.get_state_machines(self._wildcard_poll(), self.ctx,
+                                          rebuild_dormant=False)
+        self.assertEqual([], sms)
+        self.assertIsNotNone(self.trm.state_machines.get_dormant('5678'))
+
+    def _record(self, resource_id='5678'):
+        return tenant.DormantResource(
+            resource_id=resource_id,
+            tenant_id='1234',
+            driver=router.Router.RESOURCE_NAME,
+            state=states.CONFIGURED,
+            config_digest='fake_digest',
+            last_active=0,
+            snapshot={'state': states.CONFIGURED},
+        )
+
+    def _new(self, resource_id):
+        r = event.Resource(
+            tenant_id=self.tenant_id,
+            id=resource_id,
+            driver=router.Router.RESOURCE_NAME,
+        )
+        msg = event.Event(resource=r, crud=event.CREATE, body={})
+        sm = self.trm.get_state_machines(msg, self.ctx)[0]
+        self.assertTrue(sm._lazy_initialize(self.ctx))
+        return sm
+
+    def test_new_resource_not_looked_up(self):
+        r = event.Resource(
+            tenant_id=self.tenant_id,
+            id='5678',
+            driver=router.Router.RESOURCE_NAME,
+        )
+        msg = event.Event(resource=r, crud=event.CREATE, body={})
+        sm = self.trm.get_state_machines(msg, self.ctx)[0]
+        self.assertFalse(sm.initialized)
+        self.assertFalse(self.instance_mgr.called)
+        self.assertFalse(self.ctx.neutron.get_router_detail.called)
+        self.assertIs(sm, self.trm.state_machines.index.get('5678'))
+
+    def test_snapshot(self):
+        sm, dormant = self._dormant('5678')
+        live = self._new('9012')
+        live.instance.snapshot.return_value = {'state': states.UP}
+        records = dict((r.resource_id, r) for r in self.trm.snapshot())
+        self.assertEqual(['5678', '9012'], sorted(records))
+        self.assertIs(dormant, records['5678'])
+        self.assertEqual({'state': states.UP}, records['9012'].snapshot)
+        self.assertEqual(router.Router.RESOURCE_NAME, records['9012'].driver)
+
+    def test_snapshot_skips_deleted(self):
+        self._new('9012').deleted = True
+        self.assertEqual([], self.trm.snapshot())
+
+    def test_restore(self):
+        record = self._record()
+        self.assertTrue(self.trm.restore(record))
+        self.assertIs(record, self.trm.state_machines.get_dormant('5678'))
+        self.assertIs(record,
+                      self.trm.state_machines.index.get_dormant('5678'))
+        self.assertFalse(self.trm.restore(record))
+
+    def test_restore_managed(self):
+        self._new('5678')
+        self.assertFalse(self.trm.restore(self._record()))
+        self.assertIsNone(self.trm.state_machines.get_dormant('5678'))
+
+    def test_restored_built_from_snapshot(self):
+        record = self._record()
+        self.trm.restore(record)
+        r = event.Resource(tenant_id=self.tenant_id, id='5678', driver=None)
+        msg = event.Event(resource=r, crud=event.POLL, body={})
+        sms = self.trm.get_state_machines(msg, self.ctx)
+        self.assertEqual(['5678'], [sm.resource_id for sm in sms])
+        self.assertFalse(self.instance_mgr.called)
+        sms[0]._lazy_initialize(self.ctx)
+        self.assertEqual(record.snapshot,
+                         self.instance_mgr.call_args[1]['snapshot'])
+
+    def test_uninitialized_dormant_keeps_snapshot(self):
+        record = self._record()
+        self.trm.restore(record)
+        r = event.Resource(tenant_id=self.tenant_id, id='5678', driver=None)
+        msg = event.Event(resource=r, crud=event.POLL, body={})
+        self.trm.get_state_machines(msg, self.ctx)
+        dormant = self.trm.make_dormant('5678')
+        self.assertEqual(record.snapshot, dormant.snapshot)
+        self.assertIsNone(dormant.state)
+
+    def test_error_wildcard(self):
+        for i in range(5):
+            rid = str(uuid.uuid4())
+            sm = mock.Mock(resource_id=rid, tenant_id='1234', deleted=False)
+            status = states.ERROR if i == 2 else states.UP
+            sm.instance.state = status
+            sm.has_error.return_value = status == states.ERROR
+            self.trm.state_machines[rid] = sm
+        r = event.Resource(
+            tenant_id='1234',
+            id='error',
+            driver=router.Router.RESOURCE_NAME,
+        )
+        msg = event.Event(resource=r, crud=event.UPDATE, body={})
+        sms = self.trm.get_state_machines(msg, self.ctx)
+        self.assertEqual(1, len(sms))
+        self.assertTrue(sms[0].has_error())
+
+    def test_new_resource_indexed(self):
+        r = event.Resource(
+            tenant_id=self.tenant_id,
+            id='5678',
+            driver=router.Router.RESOURCE_NAME,
+        )
+        msg = event.Event(resource=r, crud=event.CREATE, body={})
+        sm = self.trm.get_state_machines(msg, self.ctx)[0]
+        sm._lazy_initialize(self.ctx)
+        index = self.trm.state_machines.index
+        self.assertIs(sm, index.get('5678'))
+        # The instance manager reports state changes to the index.
+        self.assertEqual(
+            index.set_state,
+            self.instance_mgr.call_args[1]['state_callback'])
+        self.trm._delete_resource('5678')
+        self.assertIsNone(index.get('5678'))
+
     def test_existing_resource(self):
         r = event.Resource(
             tenant_id=self.tenant_id,
@@ -228,6 +529,35 @@ class TestTenantResourceManager(unittest.TestCase):
         self.assertEqual(sms, [])
         self.assertIn('5678', self.trm.state_machines.deleted)
 
+    def test_deleted_outlives_tenant_manager(self):
+        deleted = tombstones.Tombstones()
+        trm = tenant.TenantResourceManager(
+            '1234',
+            notify_callback=self.notifier,
+            queue_warning_threshold=10,
+            reboot_error_threshold=5,
+            tombstones=deleted,
+        )
+        trm.state_machines['5678'] = mock.Mock()
+        trm._delete_resource('5678')
+        self.assertIn('5678', deleted)
+        # A new manager for the tenant still drops late messages.
+        trm = tenant.TenantResourceManager(
+            '1234',
+            notify_callback=self.notifier,
+            queue_warning_threshold=10,
+            reboot_error_threshold=5,
+            tombstones=deleted,
+        )
+        r = event.Resource(
+            tenant_id='1234',
+            id='5678',
+            driver=router.Router.RESOURCE_NAME,
+        )
+        msg = event.Event(resource=r, crud=event.UPDATE, body={})
+        self.assertEqual([], trm.get_state_machines(msg, self.ctx))
+        self.assertNotIn('5678', trm.state_machines)
+
     def test_deleter_callback(self):
         r = event.Resource(
             tenant_id='1234',
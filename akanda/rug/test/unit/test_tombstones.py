@@ -0,0 +1,72 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import tombstones
+
+
+class TestTombstones(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTombstones, self).setUp()
+        self.now = 1000.0
+        time_patch = mock.patch('time.time', side_effect=lambda: self.now)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.tombstones = tombstones.Tombstones(ttl=60, limit=3)
+
+    def test_add(self):
+        self.assertNotIn('r1', self.tombstones)
+        self.tombstones.add('r1')
+        self.assertIn('r1', self.tombstones)
+        self.assertEqual(1, len(self.tombstones))
+
+    def test_expires(self):
+        self.tombstones.add('r1')
+        self.now += 30
+        self.tombstones.add('r2')
+        self.now += 31
+        self.assertNotIn('r1', self.tombstones)
+        self.assertIn('r2', self.tombstones)
+        self.assertEqual(1, len(self.tombstones))
+
+    def test_add_again_renews(self):
+        self.tombstones.add('r1')
+        self.now += 30
+        self.tombstones.add('r2')
+        self.tombstones.add('r1')
+        self.now += 31
+        self.assertIn('r1', self.tombstones)
+        # r1 moved behind r2, so it is not the first one forgotten.
+        self.tombstones.add('r3')
+        self.tombstones.add('r4')
+        self.assertIn('r1', self.tombstones)
+        self.assertNotIn('r2', self.tombstones)
+
+    def test_limit(self):
+        for resource_id in ('r1', 'r2', 'r3', 'r4'):
+            self.tombstones.add(resource_id)
+        self.assertNotIn('r1', self.tombstones)
+        self.assertEqual(3, len(self.tombstones))
+
+    def test_no_ttl(self):
+        self.tombstones.configure(ttl=0, limit=3)
+        self.tombstones.add('r1')
+        self.now += 10 ** 6
+        self.assertIn('r1', self.tombstones)
@@ -0,0 +1,246 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import Queue
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import event
+from akanda.rug import work_queue
+
+
+class FakeSM(object):
+
+    def __init__(self, name, *actions):
+        self.name = name
+        self.actions = set(actions)
+
+    def pending_actions(self):
+        return self.actions
+
+    def __repr__(self):
+        return self.name
+
+
+class TestPriority(unittest.TestCase):
+
+    def test_most_urgent_action(self):
+        sm = FakeSM('a', event.POLL, event.UPDATE, event.READ)
+        self.assertEqual(work_queue.CHANGE, work_queue.priority(sm))
+
+    def test_levels(self):
+        self.assertEqual(
+            [work_queue.URGENT, work_queue.URGENT, work_queue.CHANGE,
+             work_queue.CHANGE, work_queue.READ, work_queue.ROUTINE],
+            [work_queue.priority(FakeSM('a', a))
+             for a in (event.DELETE, event.REBUILD, event.CREATE,
+                       event.UPDATE, event.READ, event.POLL)],
+        )
+
+    def test_empty_and_stop(self):
+        self.assertEqual(work_queue.ROUTINE,
+                         work_queue.priority(FakeSM('a')))
+        self.assertEqual(work_queue.ROUTINE, work_queue.priority(None))
+
+
+class TestPriorityWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPriorityWorkQueue, self).setUp()
+        self.now = 1000.0
+        time_patch = mock.patch('time.time', side_effect=lambda: self.now)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.q = work_queue.PriorityWorkQueue(aging=10)
+
+    def _drain(self):
+        items = []
+        while not self.q.empty():
+            items.append(self.q.get_nowait())
+        return items
+
+    def test_urgent_first(self):
+        poll = FakeSM('poll', event.POLL)
+        read = FakeSM('read', event.READ)
+        create = FakeSM('create', event.CREATE)
+        delete = FakeSM('delete', event.POLL, event.DELETE)
+        for sm in (poll, read, create, delete):
+            self.q.put(sm)
+        self.assertEqual(4, self.q.qsize())
+        self.assertEqual([delete, create, read, poll], self._drain())
+
+    def test_fifo_within_level(self):
+        sms = [FakeSM('p%d' % i, event.POLL) for i in range(5)]
+        for sm in sms:
+            self.q.put(sm)
+        self.assertEqual(sms, self._drain())
+
+    def test_aging(self):
+        poll = FakeSM('poll', event.POLL)
+        self.q.put(poll)
+        self.now += 25
+        create = FakeSM('create', event.CREATE)
+        self.q.put(create)
+        self.assertEqual([poll, create], self._drain())
+
+    def test_no_aging(self):
+        self.q = work_queue.PriorityWorkQueue(aging=0)
+        poll = FakeSM('poll', event.POLL)
+        self.q.put(poll)
+        self.now += 1000
+        create = FakeSM('create', event.CREATE)
+        self.q.put(create)
+        self.assertEqual([create, poll], self._drain())
+
+    def test_promote(self):
+        first = FakeSM('first', event.POLL)
+        sm = FakeSM('sm', event.POLL)
+        self.q.put(first)
+        self.q.put(sm)
+        sm.actions.add(event.DELETE)
+        self.assertTrue(self.q.promote(sm))
+        self.assertEqual(2, self.q.qsize())
+        self.assertEqual([sm, first], self._drain())
+        self.assertRaises(Queue.Empty, self.q.get_nowait)
+
+    def test_promote_not_queued(self):
+        sm = FakeSM('sm', event.DELETE)
+        self.assertFalse(self.q.promote(sm))
+        self.q.put(sm)
+        self.q.get()
+        self.assertFalse(self.q.promote(sm))
+
+    def test_stop_messages(self):
+        sm = FakeSM('sm', event.POLL)
+        self.q.put(sm)
+        self.q.put(None)
+        self.q.put(None)
+        self.assertEqual([sm, None, None], self._drain())
+
+    def test_wait_time(self):
+        self.assertEqual(0, self.q.wait_time())
+        self.q.put(FakeSM('a', event.POLL))
+        self.now += 5
+        self.assertEqual(5, self.q.wait_time())
+        self.q.get_nowait()
+        self.assertEqual(5 * self.q.WAIT_WEIGHT, self.q.wait_time())
+
+
+class TestFairWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        super(TestFairWorkQueue, self).setUp()
+        self.q = work_queue.FairWorkQueue(aging=0)
+
+    def _sm(self, tenant_id, name, *actions):
+        sm = FakeSM(name, *(actions or (event.POLL,)))
+        sm.tenant_id = tenant_id
+        return sm
+
+    def _drain(self):
+        items = []
+        while not self.q.empty():
+            items.append(self.q.get_nowait().name)
+        return items
+
+    def test_round_robin(self):
+        for i in range(4):
+            self.q.put(self._sm('big', 'b%d' % i))
+        self.q.put(self._sm('small', 's0'))
+        self.q.put(self._sm('other', 'o0'))
+        self.assertEqual(['b0', 's0', 'o0', 'b1', 'b2', 'b3'], self._drain())
+
+    def test_quantum(self):
+        self.q = work_queue.FairWorkQueue(aging=0, quantum=2)
+        for i in range(4):
+            self.q.put(self._sm('big', 'b%d' % i))
+        for i in range(2):
+            self.q.put(self._sm('small', 's%d' % i))
+        self.assertEqual(['b0', 'b1', 's0', 's1', 'b2', 'b3'], self._drain())
+
+    def test_priority_within_tenant(self):
+        self.q.put(self._sm('a', 'a-poll'))
+        self.q.put(self._sm('b', 'b-poll'))
+        self.q.put(self._sm('a', 'a-delete', event.DELETE))
+        self.assertEqual(['a-delete', 'b-poll', 'a-poll'], self._drain())
+
+    def test_urgent_before_other_tenants_polls(self):
+        for i in range(5):
+            self.q.put(self._sm('a', 'a%d' % i))
+        self.q.put(self._sm('b', 'b-delete', event.DELETE))
+        self.assertEqual(['b-delete', 'a0', 'a1', 'a2', 'a3', 'a4'],
+                         self._drain())
+
+    def test_round_robin_within_level(self):
+        self.q.put(self._sm('a', 'a-poll'))
+        for i in range(2):
+            self.q.put(self._sm('b', 'b-update%d' % i, event.UPDATE))
+            self.q.put(self._sm('c', 'c-update%d' % i, event.UPDATE))
+        self.assertEqual(['b-update0', 'c-update0', 'b-update1',
+                          'c-update1', 'a-poll'], self._drain())
+
+    @mock.patch('time.time')
+    def test_aged_polls_share_level(self, fake_time):
+        self.q = work_queue.FairWorkQueue(aging=10)
+        fake_time.return_value = 1000
+        self.q.put(self._sm('a', 'a-poll'))
+        fake_time.return_value = 1025
+        self.q.put(self._sm('b', 'b-update', event.UPDATE))
+        # a's poll has waited long enough to be as urgent as an update,
+        # and a's turn comes first.
+        self.assertEqual(['a-poll', 'b-update'], self._drain())
+
+    def test_idle_tenant_rejoins_at_back(self):
+        self.q.put(self._sm('a', 'a0'))
+        self.q.put(self._sm('b', 'b0'))
+        self.q.put(self._sm('b', 'b1'))
+        self.assertEqual('a0', self.q.get_nowait().name)
+        self.q.put(self._sm('a', 'a1'))
+        self.assertEqual(['b0', 'a1', 'b1'], self._drain())
+
+    def test_backlog(self):
+        for i in range(3):
+            self.q.put(self._sm('a', 'a%d' % i))
+        self.q.put(self._sm('b', 'b0'))
+        self.assertEqual({'a': 3, 'b': 1}, self.q.backlog())
+        self._drain()
+        self.assertEqual({}, self.q.backlog())
+
+    def test_promote(self):
+        self.q.put(self._sm('a', 'a0'))
+        sm = self._sm('a', 'a1')
+        self.q.put(sm)
+        sm.actions.add(event.REBUILD)
+        self.assertTrue(self.q.promote(sm))
+        self.assertEqual({'a': 2}, self.q.backlog())
+        self.assertEqual(['a1', 'a0'], self._drain())
+
+    def test_stop_messages(self):
+        self.q.put(self._sm('a', 'a0'))
+        self.q.put(None)
+        self.assertEqual('a0', self.q.get_nowait().name)
+        self.assertIsNone(self.q.get_nowait())
+
+    @mock.patch('time.time')
+    def test_wait_time_oldest_tenant(self, fake_time):
+        fake_time.return_value = 1000
+        self.q.put(self._sm('a', 'a0'))
+        fake_time.return_value = 1003
+        self.q.put(self._sm('b', 'b0'))
+        fake_time.return_value = 1010
+        self.assertEqual(10, self.q.wait_time())
@@ -15,7 +15,10 @@
 # under the License.
 
 
+import shutil
+import tempfile
 import threading
+import time
 
 import mock
 
@@ -25,8 +28,12 @@ from oslo_config import cfg
 
 from akanda.rug import commands
 from akanda.rug import event
+from akanda.rug import journal
 from akanda.rug import notifications
+from akanda.rug import populate
+from akanda.rug import snapshot
 from akanda.rug.drivers import router
+from akanda.rug.drivers import states
 from akanda.rug import worker
 
 from akanda.rug.api import neutron
@@ -49,6 +56,10 @@ class WorkerTestBase(base.DbTestCase):
         cfg.CONF.max_retries = 3
         cfg.CONF.management_prefix = 'fdca:3ba5:a17a:acda::/64'
         cfg.CONF.num_worker_threads = 0
+        cfg.CONF.max_worker_threads = 0
+        cfg.CONF.debug_mode_check_interval = 0
+        cfg.CONF.journal_dir = ''
+        cfg.CONF.snapshot_dir = ''
 
         self.fake_nova = mock.patch('akanda.rug.worker.nova').start()
         fake_neutron_obj = mock.patch.object(
@@ -87,6 +98,8 @@ class WorkerTestBase(base.DbTestCase):
             self.dbapi.enable_tenant_debug(tenant_uuid=tenant_id)
             is_debug, _ = self.dbapi.tenant_in_debug(tenant_id)
         self.assertTrue(is_debug)
+        # Pick up the change made behind the worker's back.
+        self.w.debug_registry.refresh()
 
     def assert_not_in_debug(self, resource_id=None, tenant_id=None):
         if resource_id:
@@ -128,13 +141,20 @@ class TestWorker(WorkerTestBase):
             self.msg,
             self.w._should_process(self.msg))
 
+    def test__should_process_does_not_query_db(self):
+        with mock.patch.object(self.w.debug_registry, 'db_api') as db:
+            self.assertEqual(self.msg, self.w._should_process(self.msg))
+        self.assertEqual([], db.mock_calls)
+
     def test__should_process_global_debug(self):
         self.dbapi.enable_global_debug()
+        self.w.debug_registry.refresh()
         self.assertFalse(
             self.w._should_process(self.msg))
 
     def test__should_process_tenant_debug(self):
         self.dbapi.enable_tenant_debug(tenant_uuid=self.tenant_id)
+        self.w.debug_registry.refresh()
         self.assertFalse(
             self.w._should_process(self.msg))
 
@@ -212,11 +232,9 @@ class TestResourceCache(WorkerTestBase):
         self.worker_context = worker.WorkerContext()
 
     def test_resource_cache_hit(self):
-        self.resource_cache._tenant_resources = {
-            router.Router.RESOURCE_NAME: {
-                'fake_tenant_id': 'fake_cached_resource_id',
-            }
-        }
+        self.resource_cache._store(
+            (router.Router.RESOURCE_NAME, 'fake_tenant_id'),
+            'fake_cached_resource_id')
         r = event.Resource(
             tenant_id='fake_tenant_id',
             id='fake_resource_id',
@@ -246,6 +264,74 @@ class TestResourceCache(WorkerTestBase):
         self.assertEqual(res, 'fake_fetched_resource_id')
         self.w._context.neutron.get_router_for_tenant.assert_called_with(
             'fake_tenant_id')
+        self.assertEqual(self.resource_cache.stats()['misses'], 1)
+
+    def _get(self, tenant_id='fake_tenant_id'):
+        r = event.Resource(
+            tenant_id=tenant_id,
+            id=None,
+            driver=router.Router.RESOURCE_NAME,
+        )
+        msg = event.Event(resource=r, crud=event.UPDATE, body={})
+        return self.resource_cache.get_by_tenant(
+            resource=r, worker_context=self.worker_context, message=msg)
+
+    def test_resource_cache_negative_hit(self):
+        get_router = self.w._context.neutron.get_router_for_tenant
+        get_router.return_value = None
+        self.assertIsNone(self._get())
+        self.assertIsNone(self._get())
+        self.assertEqual(get_router.call_count, 1)
+        stats = self.resource_cache.stats()
+        self.assertEqual(stats['negative_hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    @mock.patch('time.time')
+    def test_resource_cache_expires(self, fake_time):
+        fake_time.return_value = 1000
+        get_router = self.w._context.neutron.get_router_for_tenant
+        get_router.return_value = mock.Mock(id='fake_resource_id')
+        self._get()
+        fake_time.return_value = 1000 + self.resource_cache.ttl + 1
+        self._get()
+        self.assertEqual(get_router.call_count, 2)
+
+    def test_resource_cache_evicts_least_recently_used(self):
+        self.resource_cache.size = 2
+        get_router = self.w._context.neutron.get_router_for_tenant
+        get_router.return_value = mock.Mock(id='fake_resource_id')
+        self._get('tenant-a')
+        self._get('tenant-b')
+        self._get('tenant-a')
+        self._get('tenant-c')
+        self.assertEqual(len(self.resource_cache), 2)
+        self.assertEqual(self.resource_cache.stats()['evictions'], 1)
+        get_router.reset_mock()
+        self._get('tenant-a')
+        self.assertFalse(get_router.called)
+        self._get('tenant-b')
+        self.assertTrue(get_router.called)
+
+    def test_resource_cache_invalidate(self):
+        get_router = self.w._context.neutron.get_router_for_tenant
+        get_router.return_value = mock.Mock(id='fake_resource_id')
+        self._get()
+        self.resource_cache.invalidate(event.Resource(
+            router.Router.RESOURCE_NAME, None, 'fake_tenant_id'))
+        self._get()
+        self.assertEqual(get_router.call_count, 2)
+        self.assertEqual(self.resource_cache.stats()['invalidations'], 1)
+
+    def test_handle_message_invalidates_on_delete(self):
+        self.w.resource_cache = self.resource_cache
+        r = event.Resource(
+            router.Router.RESOURCE_NAME, 'fake_resource_id', 'fake_tenant_id')
+        msg = event.Event(resource=r, crud=event.DELETE, body={})
+        with mock.patch.object(self.resource_cache, 'invalidate') as inv:
+            with mock.patch.object(self.w, '_should_process') as sp:
+                sp.return_value = False
+                self.w.handle_message('fake_tenant_id', msg)
+        inv.assert_called_with(r)
 
 
 class TestCreatingResource(WorkerTestBase):
@@ -278,6 +364,21 @@ class TestCreatingResource(WorkerTestBase):
         sm = trm.get_state_machines(self.msg, worker.WorkerContext())[0]
         self.assertEqual(len(sm._queue), 1)
 
+    def test_deleted_resource_dropped(self):
+        self.w.tombstones.add(self.router_id)
+        self.w.handle_message(self.tenant_id, self.msg)
+        self.assertNotIn(self.tenant_id, self.w.tenant_managers)
+        self.assertIsNone(self.w.resource_index.get(self.router_id))
+        self.assertEqual(0, self.w.work_queue.qsize())
+
+    def test_not_looked_up_until_updated(self):
+        self.w.handle_message(self.tenant_id, self.msg)
+        sm = self.w.resource_index.get(self.router_id)
+        self.assertFalse(sm.initialized)
+        self.assertFalse(self.w._context.neutron.get_router_detail.called)
+        self.assertFalse(
+            self.w._context.nova_client.get_instance_info.called)
+
 
 class TestWildcardMessages(WorkerTestBase):
 
@@ -318,6 +419,31 @@ class TestWildcardMessages(WorkerTestBase):
         ids = sorted(trm.tenant_id for trm in trms)
         self.assertEqual(ids, [self.tenant_id_1, self.tenant_id_2])
 
+    def test_error_only_asks_errored_tenants(self):
+        sm = self.w._find_state_machine_by_resource_id('EFGH')
+        self.w.resource_index.set_state('ABCD', states.UP)
+        self.w.resource_index.set_state(sm.resource_id, states.ERROR)
+        msg = event.Event(
+            resource=event.Resource(router.Router.RESOURCE_NAME, 'error',
+                                    '*'),
+            crud=event.UPDATE,
+            body={},
+        )
+        trm_1 = self.w.tenant_managers[self.tenant_id_1]
+        trm_2 = self.w.tenant_managers[self.tenant_id_2]
+        with mock.patch.object(trm_1, 'get_state_machines') as gsm_1:
+            with mock.patch.object(trm_2, 'get_state_machines') as gsm_2:
+                gsm_2.return_value = []
+                self.w._deliver_message('error', msg)
+        self.assertFalse(gsm_1.called)
+        self.assertTrue(gsm_2.called)
+
+    def test_find_state_machine_by_resource_id(self):
+        sm = self.w._find_state_machine_by_resource_id('ABCD')
+        self.assertEqual('ABCD', sm.resource_id)
+        self.assertEqual(self.tenant_id_1, sm.tenant_id)
+        self.assertIsNone(self.w._find_state_machine_by_resource_id('XYZ'))
+
 
 class TestShutdown(WorkerTestBase):
     def test_shutdown_on_null_message(self):
@@ -333,6 +459,20 @@ class TestShutdown(WorkerTestBase):
         new_queue = self.w.work_queue
         self.assertIsNot(original_queue, new_queue)
 
+    def test_stop_running_threads(self):
+        self.w._shutdown()
+        cfg.CONF.num_worker_threads = 2
+        self.addCleanup(setattr, cfg.CONF, 'num_worker_threads', 0)
+        self.w = worker.Worker(mock.Mock())
+        threads = list(self.w.threads)
+        self.assertEqual(2, len(threads))
+        trm = self.w._get_trms(self.tenant_id)[0]
+        with mock.patch.object(trm, 'shutdown') as shutdown:
+            self.w._shutdown()
+        for t in threads:
+            self.assertFalse(t.is_alive())
+        shutdown.assert_called_once_with()
+
     @mock.patch('kombu.connection.BrokerConnection')
     @mock.patch('kombu.entity.Exchange')
     @mock.patch('kombu.Producer')
@@ -355,6 +495,9 @@ class TestUpdateStateMachine(WorkerTestBase):
         trm = self.w._get_trms(self.tenant_id)[0]
         sm = trm.get_state_machines(self.msg, self.worker_context)[0]
         with mock.patch.object(sm, 'update') as meth:
+            # Consume the inbox like a real update would, so the state
+            # machine is not put back into the work queue.
+            meth.side_effect = lambda ctx: sm._queue.clear()
             self.w.handle_message(self.tenant_id, self.msg)
             # Add a null message so the worker loop will exit. We have
             # to do this directly, because if we do it through
@@ -367,6 +510,437 @@ class TestUpdateStateMachine(WorkerTestBase):
             used_context = self.w._thread_target()
             meth.assert_called_once_with(used_context)
 
+    def test_finish_without_worker_lock(self):
+        trm = self.w._get_trms(self.tenant_id)[0]
+        sm = trm.get_state_machines(self.msg, self.worker_context)[0]
+        with mock.patch.object(sm, 'update') as meth:
+            meth.side_effect = lambda ctx: sm._queue.clear()
+            self.w.handle_message(self.tenant_id, self.msg)
+            self.assertIs(sm, self.w.work_queue.get_nowait())
+            # The worker lock is only needed to deliver messages, so a
+            # thread can finish while it is held.
+            with self.w.lock:
+                t = threading.Thread(
+                    target=self.w._update_state_machine,
+                    args=(sm, self.worker_context),
+                )
+                t.start()
+                t.join(5)
+                self.assertFalse(t.is_alive())
+        self.assertNotIn(sm.resource_id, self.w._resource_locks)
+
+
+class TestWorkJournal(WorkerTestBase):
+    def setUp(self):
+        super(TestWorkJournal, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.w._shutdown()
+        cfg.CONF.journal_dir = self.dir
+        self.addCleanup(setattr, cfg.CONF, 'journal_dir', '')
+        self.w = worker.Worker(mock.Mock())
+        self.msg.crud = event.UPDATE
+
+    def _journaled(self):
+        return [(e.resource.id, e.crud)
+                for e in journal.load(journal.find(self.dir))]
+
+    def test_open_journal(self):
+        self.assertIsNotNone(self.w.journal)
+        self.assertEqual([self.w.journal.path], journal.find(self.dir))
+
+    def test_open_journal_same_pid(self):
+        # The journal left by an earlier worker with the same process
+        # name and pid is replayed and removed, without touching the
+        # new worker's journal.
+        self.w.journal.add(self.msg.resource, [event.UPDATE])
+        self.w.journal.close()
+        self.w.journal = None
+        left = journal.find(self.dir)
+        w = worker.Worker(mock.Mock())
+        self.addCleanup(w._shutdown)
+        self.assertNotIn(w.journal.path, left)
+        sched = mock.Mock()
+        populate.replay_journals(sched, left)
+        self.assertEqual(1, sched.handle_message.call_count)
+        self.assertEqual([w.journal.path], journal.find(self.dir))
+
+    def test_open_journal_disabled(self):
+        cfg.CONF.journal_dir = ''
+        self.assertIsNone(self.w._open_journal())
+
+    @mock.patch('akanda.rug.journal.Journal')
+    def test_open_journal_error(self, fake_journal):
+        fake_journal.side_effect = IOError()
+        self.assertIsNone(self.w._open_journal())
+
+    def test_delivered_work_journaled(self):
+        self.w.handle_message(self.tenant_id, self.msg)
+        self.assertEqual([(self.router_id, event.UPDATE)],
+                         self._journaled())
+
+    def test_poll_not_journaled(self):
+        self.msg.crud = event.POLL
+        self.w.handle_message(self.tenant_id, self.msg)
+        self.assertEqual([], self._journaled())
+
+    def test_finished_work_cleared(self):
+        trm = self.w._get_trms(self.tenant_id)[0]
+        sm = trm.get_state_machines(self.msg, worker.WorkerContext())[0]
+        with mock.patch.object(sm, 'update') as meth:
+            meth.side_effect = lambda ctx: sm._queue.clear()
+            self.w.handle_message(self.tenant_id, self.msg)
+            self.w.work_queue.put(None)
+            self.w._thread_target()
+        self.assertEqual([], self._journaled())
+
+    def test_journal_closed_on_shutdown(self):
+        j = self.w.journal
+        with mock.patch.object(j, 'close') as close:
+            self.w._shutdown()
+        close.assert_called_once_with()
+        self.assertIsNone(self.w.journal)
+
+
+class TestGreenWorker(WorkerTestBase):
+    def setUp(self):
+        super(TestGreenWorker, self).setUp()
+        self.w._shutdown()
+        self.w = worker.GreenWorker(mock.Mock())
+
+    def test_no_engine_without_threads(self):
+        self.assertEqual([], self.w.threads)
+
+    def test_update(self):
+        trm = self.w._get_trms(self.tenant_id)[0]
+        sm = trm.get_state_machines(self.msg, worker.WorkerContext())[0]
+        with mock.patch.object(sm, 'update') as meth:
+            meth.side_effect = lambda ctx: sm._queue.clear()
+            self.w.handle_message(self.tenant_id, self.msg)
+            # A second event while the first is queued does not queue
+            # the resource twice.
+            self.w.handle_message(self.tenant_id, self.msg)
+            self.assertEqual(1, self.w.work_queue.qsize())
+            self.w.work_queue.put(None)
+            contexts = self.w._thread_target()
+            meth.assert_called_once_with(contexts[0])
+        self.assertNotIn(sm.resource_id, self.w._resource_locks)
+
+    def test_report_status(self):
+        with mock.patch.object(worker, 'LOG') as log:
+            self.w.report_status(show_config=False)
+        log.info.assert_any_call(
+            'Green traversals running: %d of %d', 0, self.w._pool_size)
+
+    @mock.patch('eventlet.monkey_patch')
+    def test_create_worker(self, monkey_patch):
+        self.config(worker_engine='green')
+        w = worker.create_worker(mock.Mock())
+        self.addCleanup(w._shutdown)
+        self.assertIsInstance(w, worker.GreenWorker)
+        self.assertTrue(monkey_patch.called)
+
+    @mock.patch('eventlet.monkey_patch')
+    def test_create_worker_threads(self, monkey_patch):
+        w = worker.create_worker(mock.Mock())
+        self.addCleanup(w._shutdown)
+        self.assertNotIsInstance(w, worker.GreenWorker)
+        self.assertFalse(monkey_patch.called)
+
+
+class TestWorkQueuePriority(WorkerTestBase):
+
+    def _sm(self, resource_id):
+        msg = event.Event(
+            resource=event.Resource(router.Router.RESOURCE_NAME,
+                                    resource_id, self.tenant_id),
+            crud=event.POLL,
+            body={},
+        )
+        trm = self.w._get_trms(self.tenant_id)[0]
+        sm = trm.get_state_machines(msg, worker.WorkerContext())[0]
+        return sm, msg
+
+    def test_delete_preempts_polls(self):
+        polled, poll = self._sm('5dcb1c5a-5f54-4b2d-aa1e-3ef7b2f4d3a1')
+        deleted, msg = self._sm('0c0a3f8b-4d50-4ba6-9e8e-e2d8d49a2e0c')
+        for sm in (polled, deleted):
+            sm.send_message(poll)
+            self.w._add_resource_to_work_queue(sm)
+        deleted.send_message(event.Event(msg.resource, event.DELETE, {}))
+        self.w._add_resource_to_work_queue(deleted)
+        self.assertEqual(2, self.w.work_queue.qsize())
+        self.assertIs(deleted, self.w.work_queue.get_nowait())
+        self.assertIs(polled, self.w.work_queue.get_nowait())
+
+
+class TestLoadShedding(WorkerTestBase):
+    def setUp(self):
+        super(TestLoadShedding, self).setUp()
+        self.config(load_shed_threshold=4)
+        self.poll = event.Event(self.msg.resource, event.POLL, {})
+        trm = self.w._get_trms(self.tenant_id)[0]
+        self.sm = trm.get_state_machines(self.msg, self.w._context)[0]
+        self.sm._lazy_initialize(self.w._context)
+        self.sm.instance.state = states.CONFIGURED
+
+    def _backlog(self, size):
+        qsize = mock.patch.object(self.w.work_queue, 'qsize').start()
+        qsize.return_value = size
+        return qsize
+
+    def test_not_overloaded(self):
+        self._backlog(3)
+        self.w.handle_message(self.tenant_id, self.poll)
+        self.assertFalse(self.w._overloaded)
+        self.assertTrue(self.sm.has_more_work())
+        self.assertEqual({}, dict(self.w._shed_stats))
+
+    def test_disabled(self):
+        self.config(load_shed_threshold=0)
+        self._backlog(100)
+        self.assertFalse(self.w._check_overload())
+
+    def test_hysteresis(self):
+        qsize = self._backlog(4)
+        self.assertTrue(self.w._check_overload())
+        qsize.return_value = 3
+        self.assertTrue(self.w._check_overload())
+        qsize.return_value = 2
+        self.assertFalse(self.w._check_overload())
+
+    def test_idle_poll_deferred(self):
+        self._backlog(4)
+        self.w.handle_message(self.tenant_id, self.poll)
+        self.assertFalse(self.sm.has_more_work())
+        self.assertEqual([self.sm.resource_id],
+                         list(self.w._deferred_polls))
+        self.assertEqual(1, self.w._shed_stats['deferred'])
+
+    def test_busy_poll_dropped(self):
+        self._backlog(4)
+        self.w._resource_locks.mark_busy(self.sm.resource_id)
+        self.w.handle_message(self.tenant_id, self.poll)
+        self.assertEqual({}, dict(self.w._deferred_polls))
+        self.assertEqual(1, self.w._shed_stats['dropped'])
+
+    def test_repeated_poll_dropped(self):
+        self._backlog(4)
+        self.w.handle_message(self.tenant_id, self.poll)
+        self.w.handle_message(self.tenant_id, self.poll)
+        self.assertEqual(1, self.w._shed_stats['deferred'])
+        self.assertEqual(1, self.w._shed_stats['dropped'])
+
+    def test_other_work_not_shed(self):
+        self._backlog(4)
+        self.msg.crud = event.UPDATE
+        self.w.handle_message(self.tenant_id, self.msg)
+        self.assertTrue(self.sm.has_more_work())
+        self.assertEqual({}, dict(self.w._shed_stats))
+
+    def test_deferred_poll_resumed(self):
+        qsize = self._backlog(4)
+        self.w.handle_message(self.tenant_id, self.poll)
+        qsize.return_value = 0
+        self.w._maybe_resume_deferred_polls()
+        self.assertTrue(self.sm.has_more_work())
+        self.assertEqual(1, self.w._shed_stats['resumed'])
+        self.assertEqual({}, dict(self.w._deferred_polls))
+
+    def test_dormant_not_rebuilt_while_shedding(self):
+        self._backlog(4)
+        self.sm.instance.state = states.DOWN
+        trm = self.w.tenant_managers[self.tenant_id]
+        trm.make_dormant(self.sm.resource_id)
+        poll = event.Event(event.Resource('*', '*', '*'), event.POLL, {})
+        self.w.handle_message('*', poll)
+        self.assertIsNone(self.w.resource_index.get(self.sm.resource_id))
+        self.assertIsNotNone(
+            self.w.resource_index.get_dormant(self.sm.resource_id))
+
+    def test_deferred_poll_resume_bounded(self):
+        qsize = self._backlog(4)
+        self.w.handle_message(self.tenant_id, self.poll)
+        qsize.return_value = 2
+        self.w._overloaded = False
+        self.w._maybe_resume_deferred_polls()
+        # No room under the point where shedding stops.
+        self.assertFalse(self.sm.has_more_work())
+        self.assertEqual([self.sm.resource_id],
+                         list(self.w._deferred_polls))
+
+    def test_deferred_poll_of_removed_resource(self):
+        qsize = self._backlog(4)
+        self.w.handle_message(self.tenant_id, self.poll)
+        self.w.resource_index.remove(self.sm.resource_id)
+        qsize.return_value = 0
+        self.w._maybe_resume_deferred_polls()
+        self.assertFalse(self.sm.has_more_work())
+        self.assertEqual(0, self.w._shed_stats['resumed'])
+
+
+class TestThreadPool(WorkerTestBase):
+    def setUp(self):
+        super(TestThreadPool, self).setUp()
+        self.w._max_threads = 2
+        self.w._wait_threshold = 1.0
+        self.wait_time = mock.patch.object(
+            self.w.work_queue, 'wait_time', return_value=5.0).start()
+        self.start_thread = mock.patch.object(
+            self.w, '_start_thread', side_effect=self._fake_start).start()
+
+    def _fake_start(self):
+        t = mock.Mock()
+        t.name = 't%02d' % len(self.w.threads)
+        self.w.threads.append(t)
+        return t
+
+    def test_grow_when_work_waits(self):
+        self.w._maybe_grow_pool()
+        self.assertEqual(1, self.start_thread.call_count)
+
+    def test_grow_once_per_interval(self):
+        self.w._maybe_grow_pool()
+        self.w._maybe_grow_pool()
+        self.assertEqual(1, self.start_thread.call_count)
+
+    def test_no_grow_below_threshold(self):
+        self.wait_time.return_value = 0.5
+        self.w._maybe_grow_pool()
+        self.assertFalse(self.start_thread.called)
+
+    def test_no_grow_with_idle_thread(self):
+        self._fake_start()
+        self.w._maybe_grow_pool()
+        self.assertFalse(self.start_thread.called)
+
+    def test_no_grow_past_max(self):
+        for i in range(2):
+            self._fake_start()
+        self.w._busy_threads.update(['t00', 't01'])
+        self.w._maybe_grow_pool()
+        self.assertFalse(self.start_thread.called)
+
+    def test_retire_idle_thread(self):
+        for i in range(2):
+            self._fake_start()
+        self.w._min_threads = 1
+        idle_since = worker.time.time() - self.w._idle_timeout - 1
+        self.assertTrue(self.w._retire_idle_thread('t01', idle_since))
+        self.assertEqual(['t00'], [t.name for t in self.w.threads])
+        # The pool does not shrink below its minimum.
+        self.assertFalse(self.w._retire_idle_thread('t00', idle_since))
+
+    def test_keep_recently_busy_thread(self):
+        for i in range(2):
+            self._fake_start()
+        self.assertFalse(
+            self.w._retire_idle_thread('t01', worker.time.time()))
+        self.assertEqual(2, len(self.w.threads))
+
+
+class TestIdleEviction(WorkerTestBase):
+    def setUp(self):
+        super(TestIdleEviction, self).setUp()
+        self.config(state_machine_idle_timeout=600)
+        self.w.handle_message(self.tenant_id, self.msg)
+        self.trm = self.w.tenant_managers[self.tenant_id]
+        self.sm = self.trm.state_machines[self.router_id]
+        # Pretend the queued work was done and the router is healthy.
+        self.sm._queue.clear()
+        self.w._release_resource_lock(self.sm)
+        self.w.resource_index.set_state(self.router_id, states.CONFIGURED)
+        self.w._next_eviction = 0
+
+    def test_evict_idle(self):
+        self.sm.last_active -= 601
+        self.w._maybe_evict_state_machines()
+        self.assertIsNone(self.w.resource_index.get(self.router_id))
+        self.assertIsNotNone(self.w.resource_index.get_dormant(self.router_id))
+        self.assertNotIn(self.router_id, self.w._resource_locks)
+
+    def test_keep_recently_active(self):
+        self.w._maybe_evict_state_machines()
+        self.assertIs(self.sm, self.w.resource_index.get(self.router_id))
+
+    def test_keep_busy(self):
+        self.sm.last_active -= 601
+        self.w._resource_locks.mark_busy(self.router_id)
+        self.w._maybe_evict_state_machines()
+        self.assertIs(self.sm, self.w.resource_index.get(self.router_id))
+
+    def test_keep_unhealthy(self):
+        self.sm.last_active -= 601
+        self.w.resource_index.set_state(self.router_id, states.ERROR)
+        self.w._maybe_evict_state_machines()
+        self.assertIs(self.sm, self.w.resource_index.get(self.router_id))
+
+    def test_budget(self):
+        self.config(state_machine_idle_timeout=0, max_state_machines=1)
+        other = event.Event(
+            resource=event.Resource(router.Router.RESOURCE_NAME,
+                                    'a1b2c3d4-0000-4000-8000-000000000001',
+                                    self.tenant_id),
+            crud=event.CREATE,
+            body={},
+        )
+        self.w.handle_message(self.tenant_id, other)
+        self.sm.last_active -= 10
+        self.w._maybe_evict_state_machines()
+        self.assertEqual(1, len(self.w.resource_index))
+        self.assertIsNotNone(self.w.resource_index.get_dormant(self.router_id))
+
+    def test_drop_empty_tenant_manager(self):
+        self.trm._delete_resource(self.router_id)
+        self.trm.last_active -= 601
+        self.w._maybe_evict_state_machines()
+        self.assertNotIn(self.tenant_id, self.w.tenant_managers)
+
+    def test_command_rebuilds_dormant(self):
+        self.sm.last_active -= 601
+        self.w._maybe_evict_state_machines()
+        self.w.handle_message(
+            self.tenant_id,
+            event.Event('*', event.COMMAND,
+                        {'command': commands.RESOURCE_UPDATE,
+                         'resource_id': self.router_id}),
+        )
+        sm = self.w.resource_index.get(self.router_id)
+        self.assertIsNotNone(sm)
+        self.assertIsNot(self.sm, sm)
+        self.assertTrue(sm.has_more_work())
+
+    def _poll_dormant(self, appliance_state):
+        self.sm.last_active -= 601
+        self.w._maybe_evict_state_machines()
+        poll = event.Event(event.Resource('*', '*', '*'), event.POLL, {})
+        self.w.handle_message('*', poll)
+        sm = self.w.resource_index.get(self.router_id)
+        self.assertIsNotNone(sm)
+        # The old state machine is still queued from setUp().
+        queued = [self.w.work_queue.get_nowait() for i in range(2)]
+        self.assertEqual([self.sm, sm], queued)
+
+        def update(context):
+            sm._queue.clear()
+            sm.instance = mock.Mock(state=appliance_state)
+            self.w.resource_index.set_state(self.router_id, appliance_state)
+
+        with mock.patch.object(sm, 'update', side_effect=update):
+            self.w._update_state_machine(sm, self.w._context)
+        self.w._return_polled_to_dormant()
+        return sm
+
+    def test_dormant_polled(self):
+        self._poll_dormant(states.CONFIGURED)
+        self.assertIsNone(self.w.resource_index.get(self.router_id))
+        self.assertIsNotNone(self.w.resource_index.get_dormant(self.router_id))
+
+    def test_dormant_appliance_down_woken(self):
+        sm = self._poll_dormant(states.DOWN)
+        self.assertIs(sm, self.w.resource_index.get(self.router_id))
+        self.assertIsNone(self.w.resource_index.get_dormant(self.router_id))
+
 
 class TestReportStatus(WorkerTestBase):
     def test_report_status_dispatched(self):
@@ -387,6 +961,158 @@ class TestReportStatus(WorkerTestBase):
             )
             self.assertTrue(conf.log_opt_values.called)
 
+    def test_report_status_backlog(self):
+        self.w.handle_message(self.tenant_id, self.msg)
+        with mock.patch.object(worker, 'LOG') as log:
+            self.w.report_status(show_config=False)
+        log.info.assert_any_call(
+            'Tenant %s has %d resources in work queue', self.tenant_id, 1)
+
+
+class TestResourceTrace(WorkerTestBase):
+    def _trace(self, resource_id):
+        with mock.patch.object(worker, 'LOG') as log:
+            self.w.handle_message(
+                '*',
+                event.Event('*', event.COMMAND,
+                            {'command': commands.RESOURCE_TRACE,
+                             'resource_id': resource_id}),
+            )
+        return log
+
+    def test_trace_logged(self):
+        self.w._shutdown()
+        self.config(transition_trace_size=8)
+        self.w = worker.Worker(mock.Mock())
+        trm = self.w._get_trms(self.tenant_id)[0]
+        sm = trm.get_state_machines(self.msg, worker.WorkerContext())[0]
+        self.assertEqual(8, sm._trace.maxlen)
+        sm._lazy_initialize(self.w._context)
+        sm._trace.append((0, sm.state, event.UPDATE, states.UP, 0.25))
+        log = self._trace(self.router_id)
+        log.info.assert_any_call('Last %d transitions of resource %s',
+                                 1, self.router_id)
+        log.info.assert_any_call('%s %s(%s) -> instance %s in %.3f seconds',
+                                 '1970-01-01T00:00:00', 'CalcAction',
+                                 event.UPDATE, states.UP, 0.25)
+
+    def test_not_looked_up(self):
+        trm = self.w._get_trms(self.tenant_id)[0]
+        trm.get_state_machines(self.msg, worker.WorkerContext())
+        log = self._trace(self.router_id)
+        log.info.assert_called_once_with(
+            'Resource %s has not been looked up yet, it has no transitions',
+            self.router_id)
+
+    def test_unknown_resource(self):
+        log = self._trace('no-such-resource')
+        self.assertFalse(log.info.called)
+
+
+class TestSnapshots(WorkerTestBase):
+    def setUp(self):
+        super(TestSnapshots, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        cfg.CONF.snapshot_dir = self.dir
+        self.addCleanup(setattr, cfg.CONF, 'snapshot_dir', '')
+
+    def _saved(self):
+        return snapshot.load(snapshot.find(self.dir))
+
+    def test_write_snapshot(self):
+        self.w.handle_message(self.tenant_id, self.msg)
+        sm = self.w.resource_index.get(self.router_id)
+        sm._lazy_initialize(self.w._context)
+        saved = {'state': states.UP, 'instance_info': None}
+        sm.instance.snapshot = mock.Mock(return_value=saved)
+        self.w._write_snapshot()
+        records = self._saved()
+        self.assertEqual(1, len(records))
+        self.assertEqual(self.router_id, records[0]['resource_id'])
+        self.assertEqual(self.tenant_id, records[0]['tenant_id'])
+        self.assertEqual(saved, records[0]['snapshot'])
+
+    def test_write_snapshot_same_file(self):
+        self.w._write_snapshot()
+        self.w._write_snapshot()
+        self.assertEqual(1, len(snapshot.find(self.dir)))
+
+    def test_write_snapshot_disabled(self):
+        cfg.CONF.snapshot_dir = ''
+        self.w._write_snapshot()
+        self.assertEqual([], snapshot.find(self.dir))
+
+    @mock.patch('akanda.rug.snapshot.write')
+    def test_write_snapshot_error(self, write):
+        write.side_effect = IOError()
+        # Logged, not raised.
+        self.w._write_snapshot()
+
+    def test_snapshot_interval(self):
+        self.config(snapshot_interval=300)
+        with mock.patch.object(self.w, '_save_snapshot') as save:
+            self.w._next_snapshot = time.time() + 100
+            self.w._maybe_write_snapshot()
+            self.assertIsNone(self.w._snapshot_writer)
+            self.w._next_snapshot = 0
+            self.w._maybe_write_snapshot()
+            self.w._snapshot_writer.join()
+            save.assert_called_once_with([])
+        self.assertGreater(self.w._next_snapshot, time.time() + 200)
+
+    def test_snapshot_written_without_lock(self):
+        self.w.handle_message(self.tenant_id, self.msg)
+        locked = []
+
+        def _save(records):
+            locked.append(self.w.lock.locked())
+
+        self.w._next_snapshot = 0
+        with mock.patch.object(self.w, '_save_snapshot', side_effect=_save):
+            self.w._maybe_write_snapshot()
+            self.w._snapshot_writer.join()
+        self.assertEqual([False], locked)
+
+    def test_snapshot_skipped_while_writing(self):
+        writer = self.w._snapshot_writer = mock.Mock()
+        writer.is_alive.return_value = True
+        self.w._next_snapshot = 0
+        with mock.patch.object(self.w, '_snapshot_records') as records:
+            self.w._maybe_write_snapshot()
+        self.assertFalse(records.called)
+        self.assertIs(writer, self.w._snapshot_writer)
+        self.w._snapshot_writer = None
+
+    def test_snapshot_on_shutdown(self):
+        with mock.patch.object(self.w, '_write_snapshot') as write:
+            self.w._shutdown()
+        write.assert_called_once_with()
+
+    def test_restore_command(self):
+        record = {
+            'resource_id': self.router_id,
+            'tenant_id': self.tenant_id,
+            'driver': router.Router.RESOURCE_NAME,
+            'state': states.CONFIGURED,
+            'config_digest': 'fake_digest',
+            'last_active': 0,
+            'snapshot': {'state': states.CONFIGURED},
+        }
+        self.w.handle_message(
+            self.tenant_id,
+            event.Event(
+                resource=event.Resource('*', '*', self.tenant_id),
+                crud=event.COMMAND,
+                body={'command': commands.RESOURCE_RESTORE,
+                      'tenant_id': self.tenant_id,
+                      'resources': [record]}),
+        )
+        self.assertIsNone(self.w.resource_index.get(self.router_id))
+        dormant = self.w.resource_index.get_dormant(self.router_id)
+        self.assertEqual(record['snapshot'], dormant.snapshot)
+        self.assertEqual(self.tenant_id, dormant.tenant_id)
+
 
 class TestDebugRouters(WorkerTestBase):
     def setUp(self):
@@ -410,8 +1136,7 @@ class TestDebugRouters(WorkerTestBase):
 
     def testManage(self):
         self.enable_debug(resource_id='this-resource-id')
-        lock = mock.Mock()
-        self.w._resource_locks['this-resource-id'] = lock
+        self.w._resource_locks.mark_busy('this-resource-id')
         r = event.Resource(
             tenant_id='*',
             id='*',
@@ -426,7 +1151,7 @@ class TestDebugRouters(WorkerTestBase):
                       'resource_id': 'this-resource-id'}),
         )
         self.assert_not_in_debug(resource_id='this-resource-id')
-        self.assertEqual(lock.release.call_count, 1)
+        self.assertNotIn('this-resource-id', self.w._resource_locks)
 
     def testManageNoLock(self):
         self.enable_debug(resource_id='this-resource-id')
@@ -440,8 +1165,6 @@ class TestDebugRouters(WorkerTestBase):
 
     def testManageUnlocked(self):
         self.enable_debug(resource_id='this-resource-id')
-        lock = threading.Lock()
-        self.w._resource_locks['this-resource-id'] = lock
         self.w.handle_message(
             '*',
             event.Event('*', event.COMMAND,
@@ -528,7 +1251,12 @@ class TestConfigReload(WorkerTestBase):
     @mock.patch.object(worker, 'cfg')
     def test(self, mock_cfg):
         mock_cfg.CONF = mock.MagicMock(
-            log_opt_values=mock.MagicMock())
+            log_opt_values=mock.MagicMock(),
+            num_worker_threads=0,
+            max_worker_threads=8,
+            worker_thread_wait_threshold=1.0,
+            worker_thread_idle_timeout=60,
+        )
         tenant_id = '*'
         resource_id = '*'
         msg = event.Event(
@@ -539,6 +1267,53 @@ class TestConfigReload(WorkerTestBase):
         self.w.handle_message(tenant_id, msg)
         self.assertTrue(mock_cfg.CONF.called)
         self.assertTrue(mock_cfg.CONF.log_opt_values.called)
+        self.assertEqual(8, self.w._max_threads)
+
+
+class TestTenantHandoff(WorkerTestBase):
+
+    def _handoff(self):
+        return self.w.handle_message(
+            self.tenant_id,
+            event.Event(self.msg.resource, event.COMMAND,
+                        {'command': commands.TENANT_HANDOFF,
+                         'tenant_id': self.tenant_id}),
+        )
+
+    def _sm(self):
+        trm = self.w._get_trms(self.tenant_id)[0]
+        return trm.get_state_machines(self.msg, worker.WorkerContext())[0]
+
+    def test_unknown_tenant(self):
+        result = self._handoff()
+        self.assertEqual(commands.TENANT_HANDOFF, result['command'])
+        self.assertTrue(result['released'])
+        self.assertEqual([], result['resources'])
+
+    def test_idle_tenant_released(self):
+        self._sm()
+        result = self._handoff()
+        self.assertTrue(result['released'])
+        self.assertEqual(
+            [(router.Router.RESOURCE_NAME, self.router_id, self.tenant_id)],
+            [(r.driver, r.id, r.tenant_id) for r in result['resources']],
+        )
+        self.assertNotIn(self.tenant_id, self.w.tenant_managers)
+        self.assertNotIn(self.router_id, self.w._resource_locks)
+
+    def test_busy_tenant_kept(self):
+        sm = self._sm()
+        sm.send_message(self.msg)
+        result = self._handoff()
+        self.assertFalse(result['released'])
+        self.assertIn(self.tenant_id, self.w.tenant_managers)
+
+    def test_running_tenant_kept(self):
+        self._sm()
+        self.w._resource_locks.mark_busy(self.router_id)
+        result = self._handoff()
+        self.assertFalse(result['released'])
+        self.assertIn(self.tenant_id, self.w.tenant_managers)
 
 
 class TestNormalizeUUID(unittest.TestCase):
@@ -558,6 +1333,7 @@ class TestNormalizeUUID(unittest.TestCase):
 class TestGlobalDebug(WorkerTestBase):
     def test_global_debug_no_message_sent(self):
         self.dbapi.enable_global_debug()
+        self.w.debug_registry.refresh()
         tenant_id = '98dd9c41-d3ac-4fd6-8927-567afa0b8fc3'
         resource_id = 'ac194fc5-f317-412e-8611-fb290629f624'
         msg = event.Event(
@@ -0,0 +1,93 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Resources deleted recently by a worker process.
+"""
+
+import collections
+import threading
+import time
+
+
+DEFAULT_TTL = 3600
+DEFAULT_LIMIT = 100000
+
+
+class Tombstones(object):
+    """Remembers deleted resources for a while, so late messages for
+    them are dropped instead of bringing back their state machines.
+
+    Each resource is remembered for ttl seconds after it was deleted,
+    and at most limit of them are kept, the oldest being forgotten
+    first. The ids are kept in the order they expire, so expired ones
+    are dropped from the front as others are added or looked up.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, limit=DEFAULT_LIMIT):
+        """
+        :param ttl: Seconds a deleted resource is remembered for, or 0
+                    to keep it until limit is reached.
+        :param limit: The most deleted resources to remember.
+        """
+        self.ttl = ttl
+        self.limit = limit
+        self._lock = threading.Lock()
+        # resource id -> when it expires, soonest first
+        self._expires = collections.OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._expires)
+
+    def __contains__(self, resource_id):
+        now = time.time()
+        with self._lock:
+            expires = self._expires.get(resource_id)
+            if expires is None:
+                return False
+            if expires > now:
+                return True
+            self._expire(now)
+            return False
+
+    def _expire(self, now):
+        while self._expires:
+            resource_id = next(iter(self._expires))
+            if self._expires[resource_id] > now:
+                break
+            del self._expires[resource_id]
+
+    def add(self, resource_id):
+        """Remember that a resource was deleted.
+        """
+        now = time.time()
+        expires = now + self.ttl if self.ttl > 0 else float('inf')
+        with self._lock:
+            # Move it to the back, with the others expiring last.
+            self._expires.pop(resource_id, None)
+            self._expires[resource_id] = expires
+            self._expire(now)
+            while len(self._expires) > max(self.limit, 1):
+                self._expires.popitem(last=False)
+
+    def configure(self, ttl, limit):
+        """Change the ttl and limit of the resources deleted from now on.
+        """
+        with self._lock:
+            self.ttl = ttl
+            self.limit = limit
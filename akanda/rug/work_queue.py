@@ -0,0 +1,294 @@
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Priority queue of state machines waiting for a worker thread.
+"""
+
+import collections
+import Queue
+import time
+
+from akanda.rug import event
+
+
+# Priority levels, most urgent first.
+URGENT, CHANGE, READ, ROUTINE = range(4)
+
+ACTION_PRIORITIES = {
+    event.DELETE: URGENT,
+    event.REBUILD: URGENT,
+    event.CREATE: CHANGE,
+    event.UPDATE: CHANGE,
+    event.READ: READ,
+    event.POLL: ROUTINE,
+}
+
+
+def priority(sm):
+    """Returns the priority level of the most urgent action for sm.
+    """
+    if sm is None:
+        # The stop message for a thread waits behind any real work.
+        return ROUTINE
+    return min([ACTION_PRIORITIES.get(a, ROUTINE)
+                for a in sm.pending_actions()] or [ROUTINE])
+
+
+class _Entry(object):
+    __slots__ = ('enqueued', 'item', 'level', 'valid')
+
+    def __init__(self, enqueued, item, level):
+        self.enqueued = enqueued
+        self.item = item
+        self.level = level
+        self.valid = True
+
+
+class _Levels(object):
+    """Entries waiting at each priority level, oldest first.
+    """
+
+    def __init__(self):
+        self.levels = [collections.deque() for _ in range(ROUTINE + 1)]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, entry):
+        self.levels[entry.level].append(entry)
+        self.size += 1
+
+    def move(self, entry, level):
+        """Queue entry's item again at a new level.
+
+        The old entry is left behind to be skipped, and the original
+        enqueue time is kept so aging still applies.
+        """
+        entry.valid = False
+        new = _Entry(entry.enqueued, entry.item, level)
+        self.levels[level].append(new)
+        return new
+
+    def oldest(self):
+        """Returns the enqueue time of the oldest entry, or None.
+        """
+        times = [e.enqueued for dq in self.levels for e in dq if e.valid]
+        return min(times) if times else None
+
+    def _heads(self):
+        """Yields the oldest valid entry of each level.
+        """
+        for dq in self.levels:
+            while dq and not dq[0].valid:
+                dq.popleft()
+            if dq:
+                yield dq[0]
+
+    def urgency(self, now, aging):
+        """Returns the most urgent level waiting, counting each
+        ``aging`` seconds an entry has waited as one level.
+        """
+        best = ROUTINE
+        for entry in self._heads():
+            level = entry.level
+            if aging:
+                level -= int((now - entry.enqueued) / aging)
+            best = min(best, max(level, URGENT))
+        return best
+
+    def pop(self, now, aging):
+        # Only the oldest entry of each level can be the winner.
+        best = None
+        best_score = None
+        for entry in self._heads():
+            score = entry.level
+            if aging:
+                score -= (now - entry.enqueued) / aging
+            if best is None or score < best_score:
+                best, best_score = entry, score
+        self.levels[best.level].popleft()
+        self.size -= 1
+        return best
+
+
+class PriorityWorkQueue(Queue.Queue):
+    """A work queue that hands out the most urgent state machines first.
+
+    Each state machine is queued at the level of the most urgent
+    action in its inbox, and is first-in first-out within a level.
+    An item moves up one level for every ``aging`` seconds it waits,
+    so a steady stream of urgent work cannot starve routine polls.
+
+    The queue also keeps a running average of how long items wait
+    before being handed out, which tells the worker whether it has
+    enough threads.
+    """
+
+    # Weight of the most recent wait in the running average.
+    WAIT_WEIGHT = 0.2
+
+    def __init__(self, aging=10, maxsize=0):
+        """
+        :param aging: Seconds of waiting worth one priority level,
+                      0 to disable aging.
+        :type aging: float
+        """
+        self.aging = float(aging)
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self._levels = _Levels()
+        self._entries = {}
+        self._size = 0
+        self._wait = 0.0
+
+    def _qsize(self, len=len):
+        return self._size
+
+    def _levels_for(self, item):
+        return self._levels
+
+    def _put(self, item):
+        entry = _Entry(time.time(), item, priority(item))
+        self._levels_for(item).push(entry)
+        self._entries[id(item)] = entry
+        self._size += 1
+
+    def _all_levels(self):
+        return [self._levels]
+
+    def _pop(self, levels):
+        now = time.time()
+        entry = levels.pop(now, self.aging)
+        self._wait += self.WAIT_WEIGHT * ((now - entry.enqueued) - self._wait)
+        if self._entries.get(id(entry.item)) is entry:
+            del self._entries[id(entry.item)]
+        self._size -= 1
+        return entry.item
+
+    def _get(self):
+        return self._pop(self._levels)
+
+    def wait_time(self):
+        """Returns how long items have been waiting to be handed out.
+
+        This is the larger of the running average wait of the items
+        already handed out and the age of the oldest item still
+        waiting, so it keeps rising when nothing is taken off the
+        queue at all.
+        """
+        with self.mutex:
+            oldest = [o for o in (l.oldest() for l in self._all_levels())
+                      if o is not None]
+            if not oldest:
+                return self._wait
+            return max(self._wait, time.time() - min(oldest))
+
+    def promote(self, item):
+        """Raise the priority of a queued item if its inbox got more urgent.
+
+        :returns: True if the item is waiting in the queue.
+        """
+        with self.mutex:
+            entry = self._entries.get(id(item))
+            if entry is None or entry.item is not item:
+                return False
+            level = priority(item)
+            if level < entry.level:
+                self._entries[id(item)] = self._levels_for(item).move(
+                    entry, level)
+            return True
+
+
+class FairWorkQueue(PriorityWorkQueue):
+    """A priority work queue shared fairly between tenants.
+
+    Each tenant has its own prioritized sub-queue and the tenants with
+    work waiting are served by deficit round-robin: on its turn a
+    tenant is credited ``quantum`` and may take one state machine per
+    unit of credit before the next tenant's turn. A tenant with
+    hundreds of busy routers therefore only delays the others by one
+    turn, instead of by its whole backlog.
+
+    The round-robin runs among the tenants with work at the most urgent
+    level waiting, so one tenant's DELETE is not held up behind another
+    tenant's polls. The others keep their place in the turn order.
+    """
+
+    # Every state machine traversal is charged the same.
+    COST = 1
+
+    def __init__(self, aging=10, quantum=1, maxsize=0):
+        """
+        :param aging: Seconds of waiting worth one priority level,
+                      0 to disable aging.
+        :type aging: float
+        :param quantum: Credit given to a tenant on each turn.
+        :type quantum: int
+        """
+        self.quantum = max(quantum, self.COST)
+        PriorityWorkQueue.__init__(self, aging=aging, maxsize=maxsize)
+
+    def _init(self, maxsize):
+        PriorityWorkQueue._init(self, maxsize)
+        self._tenants = {}
+        self._deficits = {}
+        # Tenants with work waiting, in the order of their turns.
+        self._active = collections.deque()
+
+    def _levels_for(self, item):
+        tenant_id = getattr(item, 'tenant_id', None)
+        levels = self._tenants.get(tenant_id)
+        if levels is None:
+            levels = self._tenants[tenant_id] = _Levels()
+            self._deficits[tenant_id] = 0
+            self._active.append(tenant_id)
+        return levels
+
+    def _all_levels(self):
+        return list(self._tenants.values())
+
+    def _get(self):
+        now = time.time()
+        # The first tenant in turn order with the most urgent work.
+        tenant_id = min(
+            self._active,
+            key=lambda t: self._tenants[t].urgency(now, self.aging),
+        )
+        if self._deficits[tenant_id] < self.COST:
+            self._deficits[tenant_id] += self.quantum
+        levels = self._tenants[tenant_id]
+        item = self._pop(levels)
+        self._deficits[tenant_id] -= self.COST
+        if not levels:
+            # A tenant that runs out of work gives up its turn and any
+            # credit left over.
+            self._active.remove(tenant_id)
+            del self._tenants[tenant_id]
+            del self._deficits[tenant_id]
+        elif self._deficits[tenant_id] < self.COST:
+            self._active.remove(tenant_id)
+            self._active.append(tenant_id)
+        return item
+
+    def backlog(self):
+        """Returns the number of state machines waiting for each tenant.
+        """
+        with self.mutex:
+            return dict((t, len(levels))
+                        for t, levels in self._tenants.items())
@@ -19,23 +19,37 @@
 """
 
 import collections
+import datetime
+import multiprocessing
+import os
 import Queue
 import threading
+import time
 import uuid
 
 from logging import INFO
 
+import eventlet
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from akanda.rug import commands
+from akanda.rug import debug_registry
 from akanda.rug import drivers
 from akanda.rug.common.i18n import _LE, _LI, _LW
 from akanda.rug import event
+from akanda.rug import journal
+from akanda.rug import resource_index
+from akanda.rug import resource_locks
+from akanda.rug import snapshot
+from akanda.rug import state
 from akanda.rug import tenant
+from akanda.rug import tombstones
+from akanda.rug import work_queue
 from akanda.rug.api import nova
 from akanda.rug.api import neutron
 from akanda.rug.db import api as db_api
+from akanda.rug.drivers import states
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -60,7 +74,111 @@ WORKER_OPTS = [
     cfg.IntOpt(
         'num_worker_threads',
         default=4,
-        help='the number of worker threads to run per process'),
+        help='the number of worker threads to run per process, and the '
+             'fewest the thread pool shrinks back to'),
+    cfg.IntOpt(
+        'max_worker_threads',
+        default=32,
+        help='the most worker threads a process grows to when state '
+             'machines wait too long for a thread'),
+    cfg.FloatOpt(
+        'worker_thread_wait_threshold',
+        default=1.0,
+        help='seconds state machines may wait in the work queue, on '
+             'average, before another worker thread is started'),
+    cfg.IntOpt(
+        'worker_thread_idle_timeout',
+        default=60,
+        help='seconds a worker thread above num_worker_threads may sit '
+             'idle before it exits'),
+    cfg.IntOpt(
+        'state_machine_idle_timeout',
+        default=0,
+        help='seconds a healthy resource may go without events other than '
+             'polls before its state machine is set aside to save memory. '
+             'It is rebuilt by the next event or command for the resource, '
+             'and for its health polls. 0 disables.'),
+    cfg.IntOpt(
+        'max_state_machines',
+        default=0,
+        help='the most state machines each worker process keeps in '
+             'memory. Idle healthy resources beyond this are set aside, '
+             'least recently active first. 0 for no limit.'),
+    cfg.StrOpt(
+        'worker_engine',
+        default='threads',
+        choices=['threads', 'green'],
+        help='how worker processes run state machine traversals: "threads" '
+             'runs one per worker thread, "green" runs them as eventlet '
+             'green threads so many can wait on the APIs at once. '
+             'Changing this requires a restart.'),
+    cfg.IntOpt(
+        'green_pool_size',
+        default=1000,
+        help='the most state machine traversals each worker process runs '
+             'at once with the green worker_engine'),
+    cfg.IntOpt(
+        'work_queue_aging',
+        default=10,
+        help='seconds a resource waits in the work queue before its '
+             'priority is raised by one level, so polls are not starved '
+             'by deletes and creates. 0 disables aging.'),
+    cfg.IntOpt(
+        'work_queue_quantum',
+        default=1,
+        help='number of resources a tenant may hand to the worker '
+             'threads on each of its turns, before the next tenant with '
+             'work waiting gets a turn'),
+    cfg.IntOpt(
+        'debug_mode_check_interval',
+        default=5,
+        help='seconds between checks for debug mode changes made by '
+             'other processes, 0 to disable'),
+    cfg.IntOpt(
+        'resource_cache_size',
+        default=4096,
+        help='number of tenants whose default resource is cached, 0 to '
+             'disable the cache'),
+    cfg.IntOpt(
+        'resource_cache_ttl',
+        default=300,
+        help='seconds a tenant\'s cached default resource is used for'),
+    cfg.IntOpt(
+        'resource_cache_negative_ttl',
+        default=30,
+        help='seconds to remember that a tenant has no resource before '
+             'asking neutron again'),
+    cfg.IntOpt(
+        'transition_trace_size',
+        default=state.DEFAULT_TRACE_SIZE,
+        help='number of recent state machine transitions kept for each '
+             'resource, shown by "rug-ctl resource trace"'),
+    cfg.IntOpt(
+        'load_shed_threshold',
+        default=1000,
+        help='number of resources waiting in a worker\'s work queue above '
+             'which polls are shed: polls for resources that already have '
+             'work are dropped and the rest are deferred until the backlog '
+             'is back under half of this. 0 disables load shedding.'),
+    cfg.IntOpt(
+        'resource_lock_stripes',
+        default=resource_locks.DEFAULT_STRIPES,
+        help='number of locks the resources of a worker process are '
+             'spread over, so the worker threads finishing with '
+             'different resources rarely wait for each other'),
+    cfg.IntOpt(
+        'deleted_resource_ttl',
+        default=tombstones.DEFAULT_TTL,
+        help='seconds a deleted resource is remembered for, so late '
+             'events for it are dropped instead of bringing back its '
+             'state machine. 0 remembers them until '
+             'deleted_resource_limit is reached.'),
+    cfg.IntOpt(
+        'deleted_resource_limit',
+        default=tombstones.DEFAULT_LIMIT,
+        help='most deleted resources a worker process remembers, the '
+             'oldest are forgotten first. Each takes a couple of hundred '
+             'bytes.'),
 
 ]
 CONF.register_opts(WORKER_OPTS)
@@ -84,29 +202,95 @@ class TenantResourceCache(object):
     """Holds a cache of default resource_ids for tenants. This is constructed
     and consulted when we receieve messages with no associated router_id and
     avoids a Neutron call per-message of this type.
+
+    The cache holds at most ``size`` tenants, dropping the least recently
+    used. Entries expire after ``ttl`` seconds, and tenants found to have
+    no resource are remembered for ``negative_ttl`` seconds so they do not
+    cause a lookup for every message either.
     """
     # NOTE(adam_g): This is a pretty dumb caching layer and can be backed
     # by an external system like memcache to further optimize lookups
     # across mulitple rugs.
-    _tenant_resources = {}
+
+    def __init__(self, size=None, ttl=None, negative_ttl=None):
+        self.size = size if size is not None else cfg.CONF.resource_cache_size
+        self.ttl = ttl if ttl is not None else cfg.CONF.resource_cache_ttl
+        self.negative_ttl = (negative_ttl if negative_ttl is not None
+                             else cfg.CONF.resource_cache_negative_ttl)
+        self._tenant_resources = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._tenant_resources)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._tenant_resources.pop(key, None)
+            if entry is None:
+                return False, None
+            resource_id, expires = entry
+            if expires < time.time():
+                return False, None
+            # Re-insert to mark the entry as the most recently used.
+            self._tenant_resources[key] = entry
+            if resource_id:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return True, resource_id
+
+    def _store(self, key, resource_id):
+        ttl = self.ttl if resource_id else self.negative_ttl
+        with self._lock:
+            self._tenant_resources.pop(key, None)
+            self._tenant_resources[key] = (resource_id, time.time() + ttl)
+            while len(self._tenant_resources) > self.size:
+                self._tenant_resources.popitem(last=False)
+                self.evictions += 1
 
     def get_by_tenant(self, resource, worker_context, message):
         tenant_id = resource.tenant_id
         driver = resource.driver
-        cached_resources = self._tenant_resources.get(driver, {})
-        if tenant_id not in cached_resources:
-            resource_id = drivers.get(driver).get_resource_id_for_tenant(
-                worker_context, tenant_id, message)
-            if not resource_id:
-                LOG.debug('%s not found for tenant %s.',
-                          driver, tenant_id)
-                return None
+        key = (driver, tenant_id)
+        found, resource_id = self._lookup(key)
+        if found:
+            return resource_id
+
+        with self._lock:
+            self.misses += 1
+        resource_id = drivers.get(driver).get_resource_id_for_tenant(
+            worker_context, tenant_id, message)
+        if not resource_id:
+            LOG.debug('%s not found for tenant %s.',
+                      driver, tenant_id)
+            resource_id = None
+        if self.size > 0:
+            self._store(key, resource_id)
+        return resource_id
 
-            if not cached_resources:
-                self._tenant_resources[driver] = {}
-            self._tenant_resources[driver][tenant_id] = resource_id
+    def invalidate(self, resource):
+        """Forget the cached resource_id for the resource's tenant.
+        """
+        with self._lock:
+            if self._tenant_resources.pop(
+                    (resource.driver, resource.tenant_id), None):
+                self.invalidations += 1
 
-        return self._tenant_resources[driver][tenant_id]
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._tenant_resources),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
 
 
 class WorkerContext(object):
@@ -125,14 +309,30 @@ class Worker(object):
     track of a bunch of the state machines, so the callable is a
     method of an instance of this class instead of a simple function.
     """
+
+    # Seconds between checks of whether the thread pool should grow.
+    POOL_CHECK_INTERVAL = 1
+    # Seconds between looks for idle state machines to set aside.
+    EVICTION_INTERVAL = 60
+
     def __init__(self, notifier):
         self._ignore_directory = cfg.CONF.ignored_router_directory
         self._queue_warning_threshold = cfg.CONF.queue_warning_threshold
         self._reboot_error_threshold = cfg.CONF.reboot_error_threshold
-        self.work_queue = Queue.Queue()
+        self._trace_size = cfg.CONF.transition_trace_size
+        self.work_queue = self._make_work_queue()
         self.lock = threading.Lock()
         self._keep_going = True
         self.tenant_managers = {}
+        # Every tenant's state machines, so commands can find them
+        # without asking each tenant manager.
+        self.resource_index = resource_index.ResourceIndex()
+        # Every tenant's deleted resources, so late events for them are
+        # dropped even once their tenant manager is gone.
+        self.tombstones = tombstones.Tombstones(
+            cfg.CONF.deleted_resource_ttl,
+            cfg.CONF.deleted_resource_limit,
+        )
         self.resource_cache = TenantResourceCache()
 
         # This process-global context should not be used in the
@@ -143,27 +343,174 @@ class Worker(object):
         # happens inside the worker process and not the parent.
         self.notifier.start()
 
-        # The DB is used for tracking debug modes
+        # The DB is used for tracking debug modes, but it is only
+        # read when the modes change.
         self.db_api = db_api.get_instance()
+        self.debug_registry = debug_registry.DebugRegistry(self.db_api)
+        if cfg.CONF.debug_mode_check_interval > 0:
+            self.debug_registry.start(cfg.CONF.debug_mode_check_interval)
 
-        # Thread locks for the routers so we only put one copy in the
-        # work queue at a time
-        self._resource_locks = collections.defaultdict(threading.Lock)
+        # Striped locks and busy flags for the resources, so we only
+        # put one copy in the work queue at a time. The worker threads
+        # only need the stripe of the resource they finished with,
+        # not the worker lock.
+        self._resource_locks = resource_locks.ResourceLocks(
+            cfg.CONF.resource_lock_stripes)
         # Messages about what each thread is doing, keyed by thread id
         # and reported by the debug command.
         self._thread_status = {}
+        # Work waiting in the state machines is journaled, so it is not
+        # lost if the process stops before it is done.
+        self.journal = self._open_journal()
+        # Most of a traversal is spent blocked on the API or sleeping
+        # between retries, so the thread pool grows while state
+        # machines wait for a free thread and shrinks again as the
+        # extra threads go idle.
+        self._pool_lock = threading.Lock()
+        self._threads_started = 0
+        self._busy_threads = set()
+        self._next_pool_check = 0
+        self._next_eviction = time.time() + self.EVICTION_INTERVAL
+        # Dormant resources rebuilt for a health poll that has been
+        # handled, to be set aside again by the main thread.
+        self._polled_dormant = collections.deque()
+        # What the state machines know is saved now and then, so a
+        # restarted rug does not have to look every resource up again.
+        self._next_snapshot = time.time() + cfg.CONF.snapshot_interval
+        self._snapshot_writer = None
+        # The directory and file this process saves its snapshots in,
+        # chosen on the first save.
+        self._snapshot_file = None
+        # Polls are shed while the work queue is backed up, and the
+        # resources whose polls were put off are polled once it drains.
+        self._overloaded = False
+        self._deferred_polls = collections.OrderedDict()
+        self._shed_stats = collections.Counter()
+        self.threads = []
         # Start the threads last, so they can use the instance
         # variables created above.
-        self.threads = [
-            threading.Thread(
-                name='t%02d' % i,
-                target=self._thread_target,
-            )
-            for i in xrange(cfg.CONF.num_worker_threads)
-        ]
-        for t in self.threads:
-            t.setDaemon(True)
-            t.start()
+        self._configure_pool()
+
+    def _configure_pool(self):
+        """Apply the thread pool bounds from the configuration.
+
+        Threads are started to bring the pool up to its minimum size.
+        A pool above the new maximum shrinks as its threads go idle.
+        """
+        self._min_threads = cfg.CONF.num_worker_threads
+        self._max_threads = max(cfg.CONF.max_worker_threads,
+                                self._min_threads)
+        self._wait_threshold = cfg.CONF.worker_thread_wait_threshold
+        self._idle_timeout = cfg.CONF.worker_thread_idle_timeout
+        with self._pool_lock:
+            while len(self.threads) < self._min_threads:
+                self._start_thread()
+
+    def _start_thread(self):
+        """Add a thread to the pool.
+
+        The pool lock should be held before calling this method.
+        """
+        t = threading.Thread(
+            name='t%02d' % self._threads_started,
+            target=self._thread_target,
+        )
+        self._threads_started += 1
+        t.setDaemon(True)
+        self.threads.append(t)
+        t.start()
+        return t
+
+    def _maybe_grow_pool(self):
+        """Start another thread if work has been waiting too long for one.
+        """
+        now = time.time()
+        if not self._keep_going or now < self._next_pool_check:
+            return
+        self._next_pool_check = now + self.POOL_CHECK_INTERVAL
+        with self._pool_lock:
+            if (len(self.threads) >= self._max_threads or
+                    len(self._busy_threads) < len(self.threads)):
+                # At the limit, or a thread is free to take the work.
+                return
+        wait = self.work_queue.wait_time()
+        if wait < self._wait_threshold:
+            return
+        with self._pool_lock:
+            if len(self.threads) < self._max_threads:
+                t = self._start_thread()
+                LOG.info(_LI('Work waited %.1f seconds for a thread, '
+                             'started %s (%d threads)'),
+                         wait, t.name, len(self.threads))
+
+    def _retire_idle_thread(self, my_id, idle_since):
+        """Remove an idle thread from a pool that is above its minimum.
+
+        :returns: True if the calling thread should exit.
+        """
+        if time.time() - idle_since < self._idle_timeout:
+            return False
+        with self._pool_lock:
+            if len(self.threads) <= self._min_threads:
+                return False
+            self.threads = [t for t in self.threads if t.name != my_id]
+        LOG.info(_LI('Stopping idle thread %s (%d threads)'),
+                 my_id, len(self.threads))
+        return True
+
+    def _open_journal(self):
+        directory = cfg.CONF.journal_dir
+        if not directory:
+            return None
+        proc = multiprocessing.current_process()
+        path = journal.journal_path(directory, proc.name, os.getpid())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            return journal.Journal(path, cfg.CONF.journal_compact_threshold)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW('Could not open journal %s, pending work will '
+                            'be lost if the process stops: %s'), path, err)
+            return None
+
+    def _journal_work(self, sm, delivered=None):
+        """Journal the actions a state machine has waiting.
+
+        Polls are left out, the health checks send them again anyway.
+
+        :param delivered: Actions just delivered to the state machine,
+                          which are added to those journaled before.
+                          Otherwise the state machine's inbox replaces
+                          them.
+        """
+        if self.journal is None:
+            return
+        resource = event.Resource(
+            driver=sm.driver.RESOURCE_NAME,
+            id=sm.resource_id,
+            tenant_id=sm.tenant_id,
+        )
+        try:
+            if delivered is not None:
+                self.journal.add(resource, [a for a in delivered
+                                            if a != event.POLL])
+            elif sm.deleted:
+                self.journal.record(resource, [])
+            else:
+                self.journal.record(resource, [a for a in sm.pending_actions()
+                                               if a != event.POLL])
+        except (IOError, OSError):
+            LOG.exception(_LE('Could not journal work for %s'),
+                          sm.resource_id)
+
+    def _make_work_queue(self):
+        # Tenants take turns handing resources to the threads and,
+        # within a tenant, deletes and rebuilds go first, then creates
+        # and updates, then reads and finally polls.
+        return work_queue.FairWorkQueue(
+            aging=cfg.CONF.work_queue_aging,
+            quantum=cfg.CONF.work_queue_quantum,
+        )
 
     def _thread_target(self):
         """This method runs in each worker thread.
@@ -175,6 +522,8 @@ class Worker(object):
         # are in a different thread and the clients are not
         # thread-safe.
         context = WorkerContext()
+        idle_since = time.time()
+        retired = False
         while self._keep_going:
             try:
                 # Try to get a state machine from the work queue. If
@@ -182,80 +531,113 @@ class Worker(object):
                 self._thread_status[my_id] = 'waiting for task'
                 sm = self.work_queue.get(timeout=10)
             except Queue.Empty:
+                retired = self._retire_idle_thread(my_id, idle_since)
+                if retired:
+                    break
                 continue
             if sm is None:
                 LOG.info(_LI('received stop message'))
                 break
 
-            # Make sure we didn't already have some updates under way
-            # for a router we've been told to ignore for debug mode.
-            should_ignore, reason = \
-                self.db_api.resource_in_debug(sm.resource_id)
-            if should_ignore:
-                LOG.debug('Skipping update of resource %s in debug mode. '
-                          '(reason: %s)', sm.resource_id, reason)
-                continue
-            # FIXME(dhellmann): Need to look at the router to see if
-            # it belongs to a tenant which is in debug mode, but we
-            # don't have that data in the sm, yet.
-            LOG.debug('performing work on %s for tenant %s',
-                      sm.resource_id, sm.tenant_id)
+            with self._pool_lock:
+                self._busy_threads.add(my_id)
             try:
-                self._thread_status[my_id] = 'updating %s' % sm.resource_id
-                sm.update(context)
-            except:
-                LOG.exception(_LE('could not complete update for %s'),
-                              sm.resource_id)
+                self._update_state_machine(sm, context, my_id)
             finally:
+                with self._pool_lock:
+                    self._busy_threads.discard(my_id)
+                idle_since = time.time()
+        # Return the context object so tests can look at it
+        if retired:
+            self._thread_status.pop(my_id, None)
+        else:
+            self._thread_status[my_id] = 'exiting'
+        return context
+
+    def _update_state_machine(self, sm, context, my_id=None):
+        """Run one traversal of a state machine taken from the work queue.
+
+        :param my_id: Name to report the traversal's progress under in
+                      the thread status, or None.
+        """
+        # Make sure we didn't already have some updates under way
+        # for a router we've been told to ignore for debug mode.
+        should_ignore, reason = \
+            self.debug_registry.resource_in_debug(sm.resource_id)
+        if should_ignore:
+            LOG.debug('Skipping update of resource %s in debug mode. '
+                      '(reason: %s)', sm.resource_id, reason)
+            return
+        # FIXME(dhellmann): Need to look at the router to see if
+        # it belongs to a tenant which is in debug mode, but we
+        # don't have that data in the sm, yet.
+        LOG.debug('performing work on %s for tenant %s',
+                  sm.resource_id, sm.tenant_id)
+        try:
+            if my_id:
+                self._thread_status[my_id] = 'updating %s' % sm.resource_id
+            sm.update(context)
+        except:
+            LOG.exception(_LE('could not complete update for %s'),
+                          sm.resource_id)
+        finally:
+            if my_id:
                 self._thread_status[my_id] = (
                     'finalizing task for %s' % sm.resource_id
                 )
-                self.work_queue.task_done()
-                with self.lock:
-                    # Release the lock that prevents us from adding
-                    # the state machine back into the queue. If we
-                    # find more work, we will re-acquire it. If we do
-                    # not find more work, we hold the primary work
-                    # queue lock so the main thread cannot put the
-                    # state machine back into the queue until we
-                    # release that lock.
-                    self._release_resource_lock(sm)
-                    # The state machine has indicated that it is done
-                    # by returning. If there is more work for it to
-                    # do, reschedule it by placing it at the end of
-                    # the queue.
-                    if sm.has_more_work():
-                        LOG.debug('%s has more work, returning to work queue',
-                                  sm.resource_id)
-                        self._add_resource_to_work_queue(sm)
-                    else:
-                        LOG.debug('%s has no more work', sm.resource_id)
-        # Return the context object so tests can look at it
-        self._thread_status[my_id] = 'exiting'
-        return context
+            self.work_queue.task_done()
+            with self._resource_locks.lock(sm.resource_id):
+                # Clear the flag that prevents us from adding the
+                # state machine back into the queue. If we find more
+                # work, we will set it again. If we do not find more
+                # work, we hold the resource's stripe lock so the
+                # main thread cannot put the state machine back into
+                # the queue until we release that lock.
+                self._release_resource_lock(sm)
+                # The state machine has indicated that it is done
+                # by returning. If there is more work for it to
+                # do, reschedule it at the priority of that work.
+                more_work = sm.has_more_work()
+                if more_work:
+                    LOG.debug('%s has more work, returning to work queue',
+                              sm.resource_id)
+                    self._add_resource_to_work_queue(sm)
+                else:
+                    LOG.debug('%s has no more work', sm.resource_id)
+                self._journal_work(sm)
+            if not more_work:
+                trm = self.tenant_managers.get(sm.tenant_id)
+                if trm is not None and trm.woken_by_poll(sm.resource_id):
+                    self._polled_dormant.append(sm)
 
     def _shutdown(self):
         """Stop the worker.
         """
         self.report_status(show_config=False)
+        self.debug_registry.stop()
         # Tell the notifier to stop
         if self.notifier:
             self.notifier.stop()
         # Stop the worker threads
         self._keep_going = False
-        # Drain the task queue by discarding it
-        # FIXME(dhellmann): This could prevent us from deleting
-        # routers that need to be deleted.
-        self.work_queue = Queue.Queue()
-        for t in self.threads:
+        # Drain the task queue by discarding it. The work still waiting
+        # is in the journal, and is replayed when the rug restarts.
+        old_queue, self.work_queue = self.work_queue, self._make_work_queue()
+        with self._pool_lock:
+            threads = list(self.threads)
+        for t in threads:
             LOG.debug('sending stop message to %s', t.getName())
-            self.work_queue.put((None, None))
+            # Idle threads are still blocked waiting on the old queue.
+            old_queue.put(None)
+            self.work_queue.put(None)
         # Wait for our threads to finish
-        for t in self.threads:
+        for t in threads:
             LOG.debug('waiting for %s to finish', t.getName())
             t.join(timeout=5)
             LOG.debug('%s is %s', t.name,
                       'alive' if t.is_alive() else 'stopped')
+        # Save what the state machines know for the next process.
+        self._write_snapshot()
         # Shutdown all of the tenant router managers. The lock is
         # probably not necessary, since this should be running in the
         # same thread where new messages are being received (and
@@ -264,6 +646,9 @@ class Worker(object):
             for trm in self.tenant_managers.values():
                 LOG.debug('stopping tenant manager for %s', trm.tenant_id)
                 trm.shutdown()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
 
     def _get_trms(self, target):
         if target.lower() in commands.WILDCARDS:
@@ -277,6 +662,9 @@ class Worker(object):
                 notify_callback=self.notifier.publish,
                 queue_warning_threshold=self._queue_warning_threshold,
                 reboot_error_threshold=self._reboot_error_threshold,
+                resource_index=self.resource_index,
+                trace_size=self._trace_size,
+                tombstones=self.tombstones,
             )
         return [self.tenant_managers[tenant_id]]
 
@@ -320,7 +708,7 @@ class Worker(object):
 
     def _should_process(self, message):
         """Determines whether a message should be processed or not."""
-        global_debug, reason = self.db_api.global_debug()
+        global_debug, reason = self.debug_registry.global_debug()
         if global_debug:
             LOG.info('Skipping incoming event, cluster in global debug '
                      'mode. (reason: %s)', reason)
@@ -333,7 +721,7 @@ class Worker(object):
                 return False
 
             should_ignore, reason = \
-                self.db_api.tenant_in_debug(message.resource.tenant_id)
+                self.debug_registry.tenant_in_debug(message.resource.tenant_id)
             if should_ignore:
                 LOG.info(
                     'Ignoring message intended for tenant %s in debug mode '
@@ -342,7 +730,7 @@ class Worker(object):
                 )
                 return False
 
-            should_ignore, reason = self.db_api.resource_in_debug(
+            should_ignore, reason = self.debug_registry.resource_in_debug(
                 message.resource.id)
             if should_ignore:
                 LOG.info(
@@ -356,6 +744,8 @@ class Worker(object):
 
     def handle_message(self, target, message):
         """Callback to be used in main
+
+        :returns: A result to report back to the scheduler, or None.
         """
         LOG.debug('got: %s %r', target, message)
         if target is None:
@@ -363,8 +753,11 @@ class Worker(object):
             self._shutdown()
             return
         if message.crud == event.COMMAND:
-            self._dispatch_command(target, message)
+            return self._dispatch_command(target, message)
         else:
+            if message.crud in (event.CREATE, event.DELETE):
+                # The tenant's default resource may be changing.
+                self.resource_cache.invalidate(message.resource)
             message = self._should_process(message)
             if not message:
                 return
@@ -373,12 +766,240 @@ class Worker(object):
             # to the state machine.
             with self.lock:
                 self._deliver_message(target, message)
+            self._maybe_resume_deferred_polls()
+            self._return_polled_to_dormant()
+            self._maybe_evict_state_machines()
+            self._maybe_write_snapshot()
+
+    def _check_overload(self):
+        """Returns whether polls should be shed.
+
+        Shedding starts when the work queue backlog reaches
+        load_shed_threshold and stops when it is back under half of
+        that, so it does not flap around the threshold.
+        """
+        threshold = cfg.CONF.load_shed_threshold
+        if threshold <= 0:
+            self._overloaded = False
+            return False
+        backlog = self.work_queue.qsize()
+        if self._overloaded:
+            if backlog <= threshold // 2:
+                self._overloaded = False
+                LOG.info(_LI('Work queue backlog down to %d, no longer '
+                             'shedding polls (%d deferred)'),
+                         backlog, len(self._deferred_polls))
+        elif backlog >= threshold:
+            self._overloaded = True
+            LOG.warning(_LW('Work queue backlog of %d reached the '
+                            'load_shed_threshold, shedding polls'),
+                        backlog)
+        return self._overloaded
+
+    def _shed_poll(self, sm):
+        """Drop or defer a poll while the worker is overloaded.
+
+        The caller should hold the worker lock and the resource's
+        stripe lock.
+        """
+        if (sm.has_more_work() or
+                self._resource_locks.is_busy(sm.resource_id) or
+                sm.resource_id in self._deferred_polls):
+            # The resource is already waiting for a thread, or its
+            # poll already is, so this one would do nothing new.
+            self._shed_stats['dropped'] += 1
+        else:
+            self._deferred_polls[sm.resource_id] = sm
+            self._shed_stats['deferred'] += 1
+
+    def _maybe_resume_deferred_polls(self):
+        """Poll the resources whose polls were deferred.
+
+        Only as many are polled as fit under the point where shedding
+        stops, so the backlog does not spike back up to the threshold.
+        """
+        if not self._deferred_polls or self._check_overload():
+            return
+        with self.lock:
+            room = (cfg.CONF.load_shed_threshold // 2 -
+                    self.work_queue.qsize())
+            while self._deferred_polls and room > 0:
+                resource_id, sm = self._deferred_polls.popitem(last=False)
+                if self.resource_index.get(resource_id) is not sm:
+                    # Deleted or set aside since its poll was deferred.
+                    continue
+                message = event.Event(
+                    resource=event.Resource(
+                        driver=sm.driver.RESOURCE_NAME,
+                        id=resource_id,
+                        tenant_id=sm.tenant_id,
+                    ),
+                    crud=event.POLL,
+                    body={},
+                )
+                with self._resource_locks.lock(resource_id):
+                    if sm.send_message(message):
+                        self._add_resource_to_work_queue(sm)
+                        room -= 1
+                self._shed_stats['resumed'] += 1
+
+    def _is_idle(self, sm):
+        with self._resource_locks.lock(sm.resource_id):
+            return (not sm.deleted and not sm.has_more_work() and
+                    not self._resource_locks.is_busy(sm.resource_id))
+
+    def _return_polled_to_dormant(self):
+        """Set aside again the dormant resources rebuilt for a health
+        poll, once the poll has found them healthy.
+        """
+        if not self._polled_dormant:
+            return
+        with self.lock:
+            while self._polled_dormant:
+                sm = self._polled_dormant.popleft()
+                trm = self.tenant_managers.get(sm.tenant_id)
+                if (trm is not None and
+                        self.resource_index.get(sm.resource_id) is sm and
+                        self._is_idle(sm)):
+                    trm.return_to_dormant(sm.resource_id)
+
+    def _maybe_evict_state_machines(self):
+        """Set aside idle state machines to keep memory use bounded.
+
+        Healthy state machines with no work that have been idle for
+        state_machine_idle_timeout, or the least recently active ones
+        while there are more than max_state_machines, are replaced by
+        compact records. Tenant managers left with nothing to manage
+        are dropped as well.
+        """
+        now = time.time()
+        if now < self._next_eviction:
+            return
+        self._next_eviction = now + self.EVICTION_INTERVAL
+        timeout = cfg.CONF.state_machine_idle_timeout
+        budget = cfg.CONF.max_state_machines
+        if not timeout and not budget:
+            return
+        with self.lock:
+            idle = sorted(
+                (sm for sm in self.resource_index.find(state=states.CONFIGURED)
+                 if self._is_idle(sm)),
+                key=lambda sm: sm.last_active,
+            )
+            excess = len(self.resource_index) - budget if budget else 0
+            evicted = 0
+            for sm in idle:
+                if excess <= 0 and not (timeout and
+                                        now - sm.last_active >= timeout):
+                    # The rest are more recently active.
+                    break
+                trm = self.tenant_managers.get(sm.tenant_id)
+                if trm is None or trm.make_dormant(sm.resource_id) is None:
+                    continue
+                excess -= 1
+                evicted += 1
+            empty_for = timeout or self.EVICTION_INTERVAL
+            for tenant_id, trm in list(self.tenant_managers.items()):
+                if (not len(trm.state_machines) and
+                        now - trm.last_active >= empty_for):
+                    LOG.debug('dropping empty tenant manager for %s',
+                              tenant_id)
+                    del self.tenant_managers[tenant_id]
+        if evicted:
+            LOG.info(_LI('Set aside %d idle state machines, %d remain'),
+                     evicted, len(self.resource_index))
+
+    def _maybe_write_snapshot(self):
+        interval = cfg.CONF.snapshot_interval
+        now = time.time()
+        if interval <= 0 or now < self._next_snapshot:
+            return
+        self._next_snapshot = now + interval
+        if (self._snapshot_writer is not None and
+                self._snapshot_writer.is_alive()):
+            LOG.debug('the last snapshot is still being written')
+            return
+        records = self._snapshot_records()
+        if records is None:
+            return
+        # Serializing and syncing every resource takes a while, so it
+        # is done on a thread of its own instead of holding up the
+        # messages.
+        self._snapshot_writer = threading.Thread(
+            name='snapshot',
+            target=self._save_snapshot,
+            args=(records,),
+        )
+        self._snapshot_writer.setDaemon(True)
+        self._snapshot_writer.start()
+
+    def _write_snapshot(self):
+        """Save the resources of every tenant, with what their state
+        machines know, for the next process to restore.
+
+        This waits for the snapshot to be written.
+        """
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.join()
+            self._snapshot_writer = None
+        records = self._snapshot_records()
+        if records is not None:
+            self._save_snapshot(records)
+
+    def _snapshot_records(self):
+        """Returns the records to save in a snapshot, or None if
+        snapshots are disabled.
+        """
+        if not cfg.CONF.snapshot_dir:
+            return None
+        with self.lock:
+            return [
+                r._asdict()
+                for trm in self.tenant_managers.values()
+                for r in trm.snapshot()
+            ]
+
+    def _save_snapshot(self, records):
+        directory = cfg.CONF.snapshot_dir
+        if not directory:
+            return
+        if (self._snapshot_file is None or
+                self._snapshot_file[0] != directory):
+            proc = multiprocessing.current_process()
+            self._snapshot_file = (
+                directory,
+                snapshot.snapshot_path(directory, proc.name, os.getpid()),
+            )
+        path = self._snapshot_file[1]
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            snapshot.write(path, records)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW('Could not write snapshot %s: %s'), path, err)
+            return
+        LOG.debug('saved %d resources in %s', len(records), path)
+
+    def _restore_resources(self, records):
+        """Take on the resources saved in the snapshots of earlier
+        processes.
+
+        They are dormant, so nothing is looked up until a message for
+        one of them arrives.
+        """
+        restored = 0
+        with self.lock:
+            for r in records:
+                record = tenant.DormantResource(
+                    *[r.get(f) for f in tenant.DormantResource._fields])
+                trm = self._get_trms(record.tenant_id)[0]
+                if trm.restore(record):
+                    restored += 1
+        LOG.info(_LI('Restored %d of %d resources from snapshots'),
+                 restored, len(records))
 
     def _find_state_machine_by_resource_id(self, resource_id):
-        for trm in self.tenant_managers.values():
-            sm = trm.get_state_machine_by_resource_id(resource_id)
-            if sm:
-                return sm
+        return self.resource_index.get(resource_id)
 
     def _dispatch_command(self, target, message):
         instructions = message.body
@@ -403,7 +1024,7 @@ class Worker(object):
             else:
                 LOG.info(_LI('Placing router %s in debug mode (reason: %s)'),
                          resource_id, reason)
-                self.db_api.enable_resource_debug(resource_id, reason)
+                self.debug_registry.enable_resource_debug(resource_id, reason)
 
         elif (instructions['command'] == commands.RESOURCE_MANAGE or
               instructions['command'] == commands.ROUTER_MANAGE):
@@ -414,32 +1035,39 @@ class Worker(object):
                     'Ignoring instruction to manage resource with no id'))
                 return
             try:
-                self.db_api.disable_resource_debug(resource_id)
+                self.debug_registry.disable_resource_debug(resource_id)
                 LOG.info(_LI('Resuming management of resource %s'),
                          resource_id)
             except KeyError:
                 pass
-            try:
-                self._resource_locks[resource_id].release()
-                LOG.info(_LI('Unlocked resource %s'), resource_id)
-            except KeyError:
-                pass
-            except threading.ThreadError:
-                # Already unlocked, that's OK.
-                pass
+            with self._resource_locks.lock(resource_id):
+                if self._resource_locks.clear_busy(resource_id):
+                    LOG.info(_LI('Unlocked resource %s'), resource_id)
+
+        elif instructions['command'] == commands.RESOURCE_TRACE:
+            self._report_trace(instructions.get('resource_id'))
+
+        elif instructions['command'] == commands.RESOURCE_RESTORE:
+            self._restore_resources(instructions.get('resources', []))
 
         elif instructions['command'] in EVENT_COMMANDS:
             resource_id = instructions.get('resource_id')
             sm = self._find_state_machine_by_resource_id(resource_id)
-            if not sm:
-                LOG.debug(
-                    'Will not process command, no managed state machine '
-                    'found for resource %s', resource_id)
-                return
+            if sm:
+                driver, tenant_id = sm.driver.RESOURCE_NAME, sm.tenant_id
+            else:
+                # Delivering the command brings back a dormant one.
+                dormant = self.resource_index.get_dormant(resource_id)
+                if not dormant:
+                    LOG.debug(
+                        'Will not process command, no managed state machine '
+                        'found for resource %s', resource_id)
+                    return
+                driver, tenant_id = dormant.driver, dormant.tenant_id
             new_res = event.Resource(
                 id=resource_id,
-                driver=sm.driver.RESOURCE_NAME,
-                tenant_id=sm.tenant_id)
+                driver=driver,
+                tenant_id=tenant_id)
             new_msg = event.Event(
                 resource=new_res,
                 crud=EVENT_COMMANDS[instructions['command']],
@@ -484,12 +1112,12 @@ class Worker(object):
             else:
                 LOG.info(_LI('Placing tenant %s in debug mode (reason: %s)'),
                          tenant_id, reason)
-                self.db_api.enable_tenant_debug(tenant_id, reason)
+                self.debug_registry.enable_tenant_debug(tenant_id, reason)
 
         elif instructions['command'] == commands.TENANT_MANAGE:
             tenant_id = instructions['tenant_id']
             try:
-                self.db_api.disable_tenant_debug(tenant_id)
+                self.debug_registry.disable_tenant_debug(tenant_id)
                 LOG.info(_LI('Resuming management of tenant %s'), tenant_id)
             except KeyError:
                 pass
@@ -499,13 +1127,16 @@ class Worker(object):
             reason = instructions.get('reason')
             if enable == 1:
                 LOG.info('Enabling global debug mode (reason: %s)', reason)
-                self.db_api.enable_global_debug(reason)
+                self.debug_registry.enable_global_debug(reason)
             elif enable == 0:
                 LOG.info('Disabling global debug mode')
-                self.db_api.disable_global_debug()
+                self.debug_registry.disable_global_debug()
             else:
                 LOG.warning('Unrecognized global debug command: %s',
                             instructions)
+        elif instructions['command'] == commands.TENANT_HANDOFF:
+            return self._release_tenant(instructions['tenant_id'])
+
         elif instructions['command'] == commands.CONFIG_RELOAD:
             try:
                 cfg.CONF()
@@ -513,42 +1144,146 @@ class Worker(object):
                 LOG.exception(_LE('Could not reload configuration'))
             else:
                 cfg.CONF.log_opt_values(LOG, INFO)
+                self._configure_pool()
+                self.tombstones.configure(
+                    cfg.CONF.deleted_resource_ttl,
+                    cfg.CONF.deleted_resource_limit,
+                )
 
         else:
             LOG.warning(_LW('Unrecognized command: %s'), instructions)
 
+    def _report_trace(self, resource_id):
+        """Log the recent transitions of a resource's state machine.
+
+        Every worker gets the command, so only the one managing the
+        resource says anything.
+        """
+        sm = self._find_state_machine_by_resource_id(resource_id)
+        if not sm:
+            LOG.debug('no state machine to trace for resource %s',
+                      resource_id)
+            return
+        if not sm.initialized:
+            LOG.info(_LI('Resource %s has not been looked up yet, it has '
+                         'no transitions'), resource_id)
+            return
+        transitions = sm.trace()
+        LOG.info(_LI('Last %d transitions of resource %s'),
+                 len(transitions), resource_id)
+        for t in transitions:
+            LOG.info(_LI('%s %s(%s) -> instance %s in %.3f seconds'),
+                     datetime.datetime.utcfromtimestamp(t.timestamp)
+                     .isoformat(),
+                     t.state, t.action, t.instance_state, t.duration)
+
+    def _release_tenant(self, tenant_id):
+        """Stop managing a tenant so another worker can take it over.
+
+        The tenant is only released if none of its state machines are
+        running or have work waiting, so nothing is lost in the move.
+
+        :returns: A TENANT_HANDOFF result for the scheduler.
+        """
+        result = {
+            'command': commands.TENANT_HANDOFF,
+            'tenant_id': tenant_id,
+            'released': False,
+            'resources': [],
+        }
+        with self.lock:
+            trm = self.tenant_managers.get(tenant_id)
+            if trm is None:
+                result['released'] = True
+                return result
+            sms = trm.state_machines.values()
+            for sm in sms:
+                with self._resource_locks.lock(sm.resource_id):
+                    busy = (sm.has_more_work() or
+                            self._resource_locks.is_busy(sm.resource_id))
+                if busy:
+                    LOG.info(_LI('Not handing off busy tenant %s'), tenant_id)
+                    return result
+            del self.tenant_managers[tenant_id]
+            for sm in sms:
+                self.resource_index.remove(sm.resource_id)
+                result['resources'].append(event.Resource(
+                    driver=sm.driver.RESOURCE_NAME,
+                    id=sm.resource_id,
+                    tenant_id=tenant_id,
+                ))
+            for d in trm.state_machines.dormant_records():
+                self.resource_index.remove_dormant(d.resource_id)
+                result['resources'].append(event.Resource(
+                    driver=d.driver,
+                    id=d.resource_id,
+                    tenant_id=tenant_id,
+                ))
+        LOG.info(_LI('Handed off tenant %s with %d resources'),
+                 tenant_id, len(result['resources']))
+        result['released'] = True
+        return result
+
     def _deliver_message(self, target, message):
         LOG.debug('preparing to deliver %r to %r', message, target)
-        trms = self._get_trms(target)
+        if message.resource.id in self.tombstones:
+            # Checked before a tenant manager, driver or state machine
+            # is built for it.
+            LOG.debug('dropping message for deleted resource %s',
+                      message.resource.id)
+            return
+        if (message.resource.id == 'error' and
+                target.lower() in commands.WILDCARDS):
+            # Only the tenants with errored resources need to be asked.
+            tenant_ids = set(
+                sm.tenant_id
+                for sm in self.resource_index.find(state=states.ERROR)
+            )
+            trms = [self.tenant_managers[t] for t in tenant_ids
+                    if t in self.tenant_managers]
+        else:
+            trms = self._get_trms(target)
 
+        shedding = message.crud == event.POLL and self._check_overload()
         for trm in trms:
-            sms = trm.get_state_machines(message, self._context)
+            # Dormant resources are not rebuilt for polls that would
+            # only be shed.
+            sms = trm.get_state_machines(message, self._context,
+                                         rebuild_dormant=not shedding)
             for sm in sms:
-                # Add the message to the state machine's inbox. If
-                # there is already a thread working on the router,
-                # that thread will pick up the new work when it is
-                # done with the current job. The work queue lock is
-                # acquired before asking the state machine if it has
-                # more work, so this block of code won't be executed
-                # at the same time as the thread trying to decide if
-                # the router is done.
-                if sm.send_message(message):
-                    self._add_resource_to_work_queue(sm)
+                with self._resource_locks.lock(sm.resource_id):
+                    if shedding:
+                        self._shed_poll(sm)
+                        continue
+                    # Add the message to the state machine's inbox. If
+                    # there is already a thread working on the router,
+                    # that thread will pick up the new work when it is
+                    # done with the current job. The thread acquires
+                    # the resource's stripe lock before asking the
+                    # state machine if it has more work, so this block
+                    # of code won't be executed at the same time as
+                    # the thread trying to decide if the router is
+                    # done.
+                    if sm.send_message(message):
+                        self._journal_work(sm, [message.crud])
+                        self._add_resource_to_work_queue(sm)
 
     def _add_resource_to_work_queue(self, sm):
         """Queue up the state machine by resource name.
 
-        The work queue lock should be held before calling this method.
+        The resource's stripe lock should be held before calling this
+        method.
         """
-        l = self._resource_locks[sm.resource_id]
-        locked = l.acquire(False)
-        if locked:
+        if self._resource_locks.mark_busy(sm.resource_id):
             self.work_queue.put(sm)
-        else:
+            self._maybe_grow_pool()
+        elif self.work_queue.promote(sm):
             LOG.debug('%s is already in the work queue', sm.resource_id)
+        else:
+            LOG.debug('%s is being updated', sm.resource_id)
 
     def _release_resource_lock(self, sm):
-        self._resource_locks[sm.resource_id].release()
+        self._resource_locks.clear_busy(sm.resource_id)
 
     def report_status(self, show_config=True):
         if show_config:
@@ -557,18 +1292,62 @@ class Worker(object):
             'Number of state machines in work queue: %d'),
             self.work_queue.qsize()
         )
+        LOG.info(_LI('Number of resources queued or being updated: %d'),
+                 len(self._resource_locks))
+        backlog = self.work_queue.backlog()
+        for tenant_id in sorted(backlog, key=backlog.get, reverse=True):
+            LOG.info(_LI('Tenant %s has %d resources in work queue'),
+                     tenant_id, backlog[tenant_id])
         LOG.info(_LI(
             'Number of tenant resource managers managed: %d'),
             len(self.tenant_managers)
         )
-        for thread in self.threads:
+        LOG.info(_LI('Number of dormant resources: %d'),
+                 self.resource_index.dormant_count())
+        LOG.info(_LI('Number of deleted resources remembered: %d'),
+                 len(self.tombstones))
+        LOG.info(_LI(
+            'Load shedding: %(state)s, %(dropped)d polls dropped, '
+            '%(deferred)d deferred, %(resumed)d resumed, %(waiting)d '
+            'waiting'),
+            {'state': 'on' if self._overloaded else 'off',
+             'dropped': self._shed_stats['dropped'],
+             'deferred': self._shed_stats['deferred'],
+             'resumed': self._shed_stats['resumed'],
+             'waiting': len(self._deferred_polls)},
+        )
+        counts = self.resource_index.state_counts()
+        for instance_state in sorted(counts):
+            LOG.info(_LI('Resources in state %s: %d'),
+                     instance_state, counts[instance_state])
+        LOG.info(_LI(
+            'Resource cache: %(size)d tenants, %(hits)d hits, '
+            '%(negative_hits)d negative hits, %(misses)d misses, '
+            '%(evictions)d evictions, %(invalidations)d invalidations'),
+            self.resource_cache.stats()
+        )
+        with self._pool_lock:
+            threads = list(self.threads)
+            busy = len(self._busy_threads)
+        LOG.info(_LI(
+            'Worker threads: %(size)d (min %(min)d, max %(max)d), '
+            '%(busy)d busy, %(utilization)d%% utilization, '
+            '%(wait).1f seconds queue wait'),
+            {'size': len(threads),
+             'min': self._min_threads,
+             'max': self._max_threads,
+             'busy': busy,
+             'utilization': 100 * busy / len(threads) if threads else 0,
+             'wait': self.work_queue.wait_time()},
+        )
+        for thread in threads:
             LOG.info(_LI(
                 'Thread %s is %s. Last seen: %s'),
                 thread.name,
                 'alive' if thread.isAlive() else 'DEAD',
                 self._thread_status.get(thread.name, 'UNKNOWN'),
             )
-        debug_tenants = self.db_api.tenants_in_debug()
+        debug_tenants = self.debug_registry.tenants_in_debug()
         if debug_tenants:
             for t_uuid, reason in debug_tenants:
                 LOG.info(_LI('Debugging tenant: %s (reason: %s)'),
@@ -576,10 +1355,98 @@ class Worker(object):
         else:
             LOG.info(_LI('No tenants in debug mode'))
 
-        debug_resources = self.db_api.resources_in_debug()
+        debug_resources = self.debug_registry.resources_in_debug()
         if debug_resources:
             for resource_id, reason in debug_resources:
                 LOG.info(_LI('Debugging resource: %s (reason: %s)'),
                          resource_id, reason)
         else:
             LOG.info(_LI('No resources in debug mode'))
+
+
+class GreenWorker(Worker):
+    """A Worker that runs state machine traversals as green threads.
+
+    A traversal spends most of its time waiting on the APIs or
+    sleeping between retries, so instead of holding an OS thread each
+    one runs as a green thread from a GreenPool of green_pool_size,
+    driven by a single engine thread. The process must be monkey
+    patched for those waits to yield, see create_worker().
+
+    State machines still pass through the work queue and the
+    _resource_locks, so only one traversal runs per resource at a
+    time, just as with threads.
+    """
+
+    # Seconds the engine sleeps when the work queue is empty. The
+    # queue's blocking get() would stall every green thread.
+    IDLE_INTERVAL = 0.1
+
+    def _configure_pool(self):
+        self._pool_size = cfg.CONF.green_pool_size
+        # A single engine thread, unless threads are disabled.
+        self._min_threads = min(cfg.CONF.num_worker_threads, 1)
+        self._max_threads = self._min_threads
+        self._wait_threshold = cfg.CONF.worker_thread_wait_threshold
+        self._idle_timeout = cfg.CONF.worker_thread_idle_timeout
+        self._green_running = 0
+        with self._pool_lock:
+            while len(self.threads) < self._min_threads:
+                self._start_thread()
+
+    def _thread_target(self):
+        """This method runs in the engine thread.
+        """
+        my_id = threading.current_thread().name
+        LOG.debug('starting green engine')
+        pool = eventlet.GreenPool(self._pool_size)
+        # The clients are not safe to share between green threads
+        # either, so each traversal borrows a context of its own.
+        contexts = []
+
+        def _traverse(sm):
+            context = contexts.pop() if contexts else WorkerContext()
+            self._green_running += 1
+            try:
+                self._update_state_machine(sm, context)
+            finally:
+                self._green_running -= 1
+                contexts.append(context)
+
+        while self._keep_going:
+            if pool.size != self._pool_size:
+                pool.resize(self._pool_size)
+            self._thread_status[my_id] = (
+                'running %d of %d traversals' % (pool.running(), pool.size)
+            )
+            try:
+                sm = self.work_queue.get_nowait()
+            except Queue.Empty:
+                eventlet.sleep(self.IDLE_INTERVAL)
+                continue
+            if sm is None:
+                LOG.info(_LI('received stop message'))
+                break
+            # Blocks this loop, but not the traversals, while the pool
+            # is full.
+            pool.spawn_n(_traverse, sm)
+        pool.waitall()
+        self._thread_status[my_id] = 'exiting'
+        return contexts
+
+    def report_status(self, show_config=True):
+        super(GreenWorker, self).report_status(show_config)
+        LOG.info(_LI('Green traversals running: %d of %d'),
+                 self._green_running, self._pool_size)
+
+
+def create_worker(notifier):
+    """Create the Worker for a worker process, using the configured engine.
+
+    This runs in the new worker process, so the green engine can
+    monkey patch the process before any clients are made.
+    """
+    if cfg.CONF.worker_engine == 'green':
+        eventlet.monkey_patch(socket=True, select=True, time=True)
+        return GreenWorker(notifier)
+    return Worker(notifier)
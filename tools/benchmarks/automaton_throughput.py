@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Measure how many events the state machines get through, without a cloud.
+
+Routers are managed through a fake driver and fake nova and neutron
+clients, which answer after a configurable delay and fail liveness
+checks and config pushes at a configurable rate. The same events are
+sent to three layers in turn:
+
+  automaton  the Automatons, updated directly
+  tenant     TenantResourceManagers routing to their Automatons
+  worker     a Worker, with its work queue and thread pool
+
+For each layer and number of routers, events/sec, the latency of the
+state machine traversals and the memory used per router are reported.
+Each run is done in a new process, so the memory is not hidden by what
+an earlier run left behind.
+
+Latencies are given as 0, fixed:SECONDS, uniform:LOW:HIGH or
+exp:MEAN.
+
+Usage: python tools/benchmarks/automaton_throughput.py
+           [--routers 1000,10000,100000] [--layers automaton,tenant,worker]
+           [--actions update,poll,update] [--latency SPEC]
+           [--failure-rate P] [--threads N]
+"""
+
+import argparse
+import array
+import gc
+import logging
+import multiprocessing
+import random
+import resource
+import time
+import uuid
+
+from oslo_config import cfg
+
+from akanda.rug.api import neutron
+from akanda.rug.api import nova
+from akanda.rug import drivers
+from akanda.rug.drivers import base
+from akanda.rug.drivers import states
+from akanda.rug import event
+from akanda.rug import state
+from akanda.rug import tenant
+from akanda.rug import worker
+
+
+DRIVER_LOG = logging.getLogger('akanda.rug.benchmark')
+
+
+def _distribution(spec, rand):
+    """Returns a function giving delays in seconds for a latency spec."""
+    kind, _, params = spec.partition(':')
+    params = [float(p) for p in params.split(':') if p]
+    if kind in ('0', 'none'):
+        return lambda: 0
+    if kind == 'fixed':
+        return lambda: params[0]
+    if kind == 'uniform':
+        return lambda: rand.uniform(params[0], params[1])
+    if kind == 'exp':
+        return lambda: rand.expovariate(1.0 / params[0])
+    raise ValueError('unknown latency distribution %r' % spec)
+
+
+class Faults(object):
+    """Delays and failures injected into the fake API calls."""
+
+    def __init__(self, latency='0', failure_rate=0.0, seed=0):
+        self._random = random.Random(seed)
+        self._delay = _distribution(latency, self._random)
+        self.failure_rate = failure_rate
+
+    def wait(self):
+        delay = self._delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def call(self):
+        """Wait like an API call, then return whether it succeeded."""
+        self.wait()
+        return self._random.random() >= self.failure_rate
+
+
+def _mac(resource_id, n):
+    h = resource_id.replace('-', '')
+    return 'fa:16:%s:%s:%s:%02x' % (h[0:2], h[2:4], h[4:6], n)
+
+
+def _port(resource_id, n):
+    """Port n of a router, 0 being its management port."""
+    return neutron.Port(
+        id_='%s-%d' % (resource_id, n),
+        device_id=resource_id,
+        fixed_ips=[neutron.FixedIp('subnet-%d' % n, 'fdca:3ba5::%x' % n)],
+        mac_address=_mac(resource_id, n),
+        network_id='network-%d' % n,
+    )
+
+
+class FakeDriver(base.BaseDriver):
+    RESOURCE_NAME = 'fake'
+    faults = Faults()
+
+    def __init__(self, worker_context, id, log=None):
+        # One shared logger, so the loggers are not counted as part of
+        # the memory used by each router.
+        super(FakeDriver, self).__init__(worker_context, id,
+                                         log=log or DRIVER_LOG)
+        self.image_uuid = 'fake-image'
+        self.flavor = 'fake-flavor'
+
+    @property
+    def ports(self):
+        return [_port(self.id, 1)]
+
+    def get_state(self, worker_context):
+        return states.UP
+
+    def get_interfaces(self, management_address):
+        self.faults.wait()
+        return [{'lladdr': _mac(self.id, n), 'ifname': 'ge%d' % n}
+                for n in (0, 1)]
+
+    def is_alive(self, management_address):
+        return self.faults.call()
+
+    def build_config(self, worker_context, mgt_port, iface_map):
+        return {'id': self.id, 'interfaces': iface_map}
+
+    def update_config(self, management_address, config):
+        if not self.faults.call():
+            raise IOError('injected failure')
+
+    def make_ports(self, worker_context):
+        def _make_ports():
+            return _port(self.id, 0), [_port(self.id, 1)]
+        return _make_ports
+
+
+class FakeNova(object):
+    def __init__(self, faults):
+        self.faults = faults
+
+    def _instance(self, name, booting=False):
+        resource_id = name.split('-', 2)[2]
+        return nova.InstanceInfo(
+            instance_id='i-' + resource_id,
+            name=name,
+            management_port=_port(resource_id, 0),
+            ports=[_port(resource_id, 1)],
+            image_uuid='fake-image',
+            booting=booting,
+        )
+
+    def get_instance_info(self, name):
+        self.faults.wait()
+        return self._instance(name)
+
+    def get_instance_for_obj(self, resource_id):
+        self.faults.wait()
+        return object()
+
+    def boot_instance(self, prev_instance_info, name, image_uuid, flavor,
+                      make_ports_callback):
+        self.faults.wait()
+        return self._instance(name, booting=True)
+
+    def destroy_instance(self, instance_info):
+        self.faults.wait()
+
+    def get_instance_by_id(self, instance_id):
+        self.faults.wait()
+        return None
+
+
+class FakeNeutron(object):
+    def __init__(self, faults):
+        self.faults = faults
+
+    def get_ports_for_instance(self, instance_id):
+        self.faults.wait()
+        resource_id = instance_id[len('i-'):]
+        return _port(resource_id, 0), [_port(resource_id, 1)]
+
+
+class FakeWorkerContext(object):
+    def __init__(self):
+        self.nova_client = FakeNova(FakeDriver.faults)
+        self.neutron = FakeNeutron(FakeDriver.faults)
+
+
+class FakeDB(object):
+    """Debug mode settings for the Worker, with nothing in debug mode."""
+
+    def debug_version(self):
+        return 0
+
+    def global_debug(self):
+        return (False, None)
+
+    def tenants_in_debug(self):
+        return []
+
+    def resources_in_debug(self):
+        return []
+
+
+class FakeNotifier(object):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, *args, **kwargs):
+        pass
+
+
+def _ignore(*args, **kwargs):
+    pass
+
+
+def _traverse(sm, context, errors):
+    """Update a state machine the way a worker thread does."""
+    while sm.has_more_work():
+        try:
+            sm.update(context)
+        except Exception:
+            errors[0] += 1
+            return
+
+
+def _run_automaton(messages, args):
+    context = FakeWorkerContext()
+    errors = [0]
+    sms = {}
+    for tenant_id, message in messages:
+        resource_id = message.resource.id
+        sm = sms.get(resource_id)
+        if sm is None:
+            sm = sms[resource_id] = state.Automaton(
+                driver=FakeDriver(context, resource_id),
+                resource_id=resource_id,
+                tenant_id=tenant_id,
+                delete_callback=None,
+                bandwidth_callback=_ignore,
+                worker_context=context,
+                queue_warning_threshold=cfg.CONF.queue_warning_threshold,
+                reboot_error_threshold=cfg.CONF.reboot_error_threshold,
+                trace_size=cfg.CONF.transition_trace_size,
+            )
+        if sm.send_message(message):
+            _traverse(sm, context, errors)
+    return errors[0], sms
+
+
+def _run_tenant(messages, args):
+    context = FakeWorkerContext()
+    errors = [0]
+    trms = {}
+    for tenant_id, message in messages:
+        trm = trms.get(tenant_id)
+        if trm is None:
+            trm = trms[tenant_id] = tenant.TenantResourceManager(
+                tenant_id=tenant_id,
+                notify_callback=_ignore,
+                queue_warning_threshold=cfg.CONF.queue_warning_threshold,
+                reboot_error_threshold=cfg.CONF.reboot_error_threshold,
+                trace_size=cfg.CONF.transition_trace_size,
+            )
+        for sm in trm.get_state_machines(message, context):
+            if sm.send_message(message):
+                _traverse(sm, context, errors)
+    return errors[0], trms
+
+
+def _run_worker(messages, args):
+    w = worker.Worker(FakeNotifier())
+    for tenant_id, message in messages:
+        w.handle_message(tenant_id, message)
+    # A resource is busy while its state machine waits in the work
+    # queue or is being updated.
+    while len(w._resource_locks):
+        time.sleep(0.01)
+    shed = sum(w._shed_stats.values())
+    return shed, w
+
+
+LAYERS = [
+    ('automaton', _run_automaton),
+    ('tenant', _run_tenant),
+    ('worker', _run_worker),
+]
+
+
+def _make_messages(count, args):
+    tenant_ids = [str(uuid.uuid4())
+                  for i in xrange(max(1, count // args.routers_per_tenant))]
+    resources = [
+        event.Resource('fake', str(uuid.uuid4()),
+                       tenant_ids[i % len(tenant_ids)])
+        for i in xrange(count)
+    ]
+    return [
+        (r.tenant_id, event.Event(resource=r, crud=crud, body={}))
+        for crud in args.actions
+        for r in resources
+    ]
+
+
+def _rss():
+    """Returns the resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Only the peak is available, in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _time_updates(durations):
+    update = state.Automaton.update
+
+    def timed_update(self, worker_context):
+        started = time.time()
+        try:
+            return update(self, worker_context)
+        finally:
+            durations.append(time.time() - started)
+
+    state.Automaton.update = timed_update
+
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def _measure(layer, count, args, results):
+    """Runs in a child process, so each measurement starts afresh."""
+    messages = _make_messages(count, args)
+    durations = array.array('d')
+    _time_updates(durations)
+    run = dict(LAYERS)[layer]
+    gc.collect()
+    before = _rss()
+    start = time.time()
+    # Keep what was built alive until the memory has been measured.
+    errors, built = run(messages, args)
+    elapsed = time.time() - start
+    gc.collect()
+    used = _rss() - before
+    results.put((len(messages) / elapsed,
+                 [_percentile(sorted(durations), p) for p in (50, 90, 99)],
+                 len(durations),
+                 used / float(count),
+                 errors))
+    if layer == 'worker':
+        built._shutdown()
+
+
+def _configure(args):
+    cfg.CONF(args=[], project='akanda-rug', default_config_files=[])
+    cfg.CONF.set_override('retry_delay', 0)
+    cfg.CONF.set_override('journal_dir', '')
+    cfg.CONF.set_override('debug_mode_check_interval', 0)
+    if args.threads:
+        cfg.CONF.set_override('num_worker_threads', args.threads)
+        cfg.CONF.set_override('max_worker_threads', args.threads)
+    FakeDriver.faults = Faults(args.latency, args.failure_rate, args.seed)
+    drivers.AVAILABLE_DRIVERS[FakeDriver.RESOURCE_NAME] = FakeDriver
+    worker.WorkerContext = FakeWorkerContext
+    worker.db_api.get_instance = FakeDB
+    logging.basicConfig(level=logging.ERROR)
+    # Failures the driver reports are injected, don't show them.
+    DRIVER_LOG.setLevel(logging.CRITICAL + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--routers', default='1000,10000,100000')
+    parser.add_argument('--layers', default=','.join(n for n, _ in LAYERS))
+    parser.add_argument('--actions', default='update,poll,update',
+                        help='the action sent to every router, per round')
+    parser.add_argument('--latency', default='0',
+                        help='delay of each fake API call')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of liveness checks and config '
+                             'pushes that fail')
+    parser.add_argument('--routers-per-tenant', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='worker threads, instead of the configured '
+                             'pool bounds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.actions = [a.strip() for a in args.actions.split(',')]
+    for a in args.actions:
+        if a not in (event.CREATE, event.READ, event.UPDATE, event.DELETE,
+                     event.POLL, event.REBUILD):
+            parser.error('unknown action %r' % a)
+    _configure(args)
+
+    for layer in args.layers.split(','):
+        # From the fewest routers, so the slow runs come last.
+        for count in sorted(int(n) for n in args.routers.split(',')):
+            results = multiprocessing.Queue()
+            child = multiprocessing.Process(
+                target=_measure, args=(layer, count, args, results))
+            child.start()
+            rate, (p50, p90, p99), traversals, per_router, errors = \
+                results.get()
+            child.join()
+            print('%-9s %7d routers  %9.0f events/sec  %8d traversals  '
+                  'p50/p90/p99 %.2f/%.2f/%.2f ms  %7.1f KiB/router  '
+                  '%d %s' %
+                  (layer, count, rate, traversals,
+                   p50 * 1000, p90 * 1000, p99 * 1000, per_router / 1024,
+                   errors, 'polls shed' if layer == 'worker' else 'errors'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Compare per-event and batched delivery from the scheduler to a worker.
+
+Usage: python tools/benchmarks/ipc_transport.py [--events N] [--batch-size N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+import uuid
+
+from akanda.rug import event
+from akanda.rug import scheduler
+
+
+def _consume(inq, batched, done):
+    count = 0
+    while True:
+        data = inq.get()
+        if data is None:
+            break
+        count += len(data) if batched else 1
+    done.put(count)
+
+
+def _make_events(n):
+    tenant_id = str(uuid.uuid4())
+    body = {
+        'event_type': 'port.change.end',
+        'payload': {'port': {'id': str(uuid.uuid4()),
+                             'device_id': str(uuid.uuid4()),
+                             'fixed_ips': [{'ip_address': '10.0.0.%d' % i}
+                                           for i in range(4)]}},
+    }
+    return [
+        (tenant_id,
+         event.Event(
+             resource=event.Resource('router', str(uuid.uuid4()), tenant_id),
+             crud=event.UPDATE,
+             body=body))
+        for i in xrange(n)
+    ]
+
+
+def _run(events, batch_size):
+    inq = multiprocessing.JoinableQueue()
+    done = multiprocessing.Queue()
+    consumer = multiprocessing.Process(
+        target=_consume, args=(inq, batch_size is not None, done))
+    consumer.start()
+
+    start_cpu = sum(os.times()[:2])
+    start = time.time()
+    if batch_size is None:
+        for item in events:
+            inq.put(item)
+    else:
+        writer = scheduler.BatchWriter(inq, batch_size)
+        for target, message in events:
+            writer.put(target, message)
+        writer.flush()
+    inq.put(None)
+    count = done.get()
+    elapsed = time.time() - start
+    # The feeder thread runs in this process, so its pickling shows
+    # up in our CPU time.
+    cpu = sum(os.times()[:2]) - start_cpu
+    consumer.join()
+    assert count == len(events), (count, len(events))
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    events = _make_events(args.events)
+    for label, batch_size in [('JoinableQueue, one put per event', None),
+                              ('BatchWriter, batch size %d' % args.batch_size,
+                               args.batch_size)]:
+        elapsed, cpu = _run(events, batch_size)
+        print ('%-40s %8.0f events/sec  %6.2fs wall  '
+               '%6.2fs main-process cpu' %
+               (label, len(events) / elapsed, elapsed, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Measure how long the worker threads wait on the worker's locks.
+
+One thread delivers messages to random resources and a pool of threads
+updates them, following the locking of Worker._deliver_message() and
+Worker._update_state_machine(). The traversals themselves are replaced
+by a sleep, since they mostly wait on the APIs. Two designs are
+compared:
+
+  single   every thread finishing a traversal takes the worker lock,
+           and each resource has its own lock in a defaultdict, as
+           before the locks were striped
+  striped  a thread finishing a traversal takes only the stripe lock
+           of its resource, from a ResourceLocks
+
+For each design and thread count, messages/sec and the time threads
+waited for the lock when finishing a traversal are reported.
+
+Usage: python tools/benchmarks/lock_contention.py [--threads 4,16,64]
+           [--resources 10000] [--messages 100000] [--stripes 64]
+           [--work SECONDS]
+"""
+
+import argparse
+import collections
+import Queue
+import random
+import threading
+import time
+
+from akanda.rug import resource_locks
+
+
+class FakeStateMachine(object):
+    def __init__(self, resource_id):
+        self.resource_id = resource_id
+        self.pending = 0
+
+    def send_message(self):
+        self.pending += 1
+        return True
+
+    def has_more_work(self):
+        return bool(self.pending)
+
+    def update(self, work):
+        self.pending = 0
+        if work:
+            time.sleep(work)
+
+
+class NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+class SingleLock(object):
+    """The locking used before, with the worker lock held to finish."""
+
+    def __init__(self, stripes):
+        self.lock = threading.Lock()
+        self._resource_locks = collections.defaultdict(threading.Lock)
+        self._nolock = NoLock()
+
+    def deliver_lock(self, resource_id):
+        # The worker lock is already held.
+        return self._nolock
+
+    def finish_lock(self, resource_id):
+        return self.lock
+
+    def mark_busy(self, resource_id):
+        return self._resource_locks[resource_id].acquire(False)
+
+    def clear_busy(self, resource_id):
+        self._resource_locks[resource_id].release()
+
+
+class Striped(object):
+    """The striped locks, with only the resource's stripe held to finish.
+
+    Messages are still delivered under the worker lock, and then the
+    stripe, as the worker does.
+    """
+
+    def __init__(self, stripes):
+        self.lock = threading.Lock()
+        self._resource_locks = resource_locks.ResourceLocks(stripes)
+
+    def deliver_lock(self, resource_id):
+        return self._resource_locks.lock(resource_id)
+
+    def finish_lock(self, resource_id):
+        return self._resource_locks.lock(resource_id)
+
+    def mark_busy(self, resource_id):
+        return self._resource_locks.mark_busy(resource_id)
+
+    def clear_busy(self, resource_id):
+        self._resource_locks.clear_busy(resource_id)
+
+
+DESIGNS = [
+    ('single', SingleLock),
+    ('striped', Striped),
+]
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def _run(design, threads, args):
+    locks = design(args.stripes)
+    sms = [FakeStateMachine('r%06d' % i) for i in range(args.resources)]
+    rand = random.Random(args.seed)
+    targets = [rand.choice(sms) for i in range(args.messages)]
+    work_queue = Queue.Queue()
+    waits = []
+
+    def _target():
+        my_waits = []
+        while True:
+            sm = work_queue.get()
+            if sm is None:
+                break
+            sm.update(args.work)
+            started = time.time()
+            with locks.finish_lock(sm.resource_id):
+                my_waits.append(time.time() - started)
+                locks.clear_busy(sm.resource_id)
+                if sm.has_more_work() and locks.mark_busy(sm.resource_id):
+                    work_queue.put(sm)
+        waits.extend(my_waits)
+
+    pool = [threading.Thread(target=_target) for i in range(threads)]
+    for t in pool:
+        t.start()
+    start = time.time()
+    for sm in targets:
+        with locks.lock:
+            with locks.deliver_lock(sm.resource_id):
+                if sm.send_message() and locks.mark_busy(sm.resource_id):
+                    work_queue.put(sm)
+    # Wait for the work to be picked up before stopping the threads.
+    while not work_queue.empty():
+        time.sleep(0.001)
+    for t in pool:
+        work_queue.put(None)
+    for t in pool:
+        t.join()
+    elapsed = time.time() - start
+    return args.messages / elapsed, sorted(waits)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', default='4,16,64')
+    parser.add_argument('--resources', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--stripes', type=int,
+                        default=resource_locks.DEFAULT_STRIPES)
+    parser.add_argument('--work', type=float, default=0.0005,
+                        help='seconds each traversal sleeps')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for name, design in DESIGNS:
+        for threads in sorted(int(n) for n in args.threads.split(',')):
+            rate, waits = _run(design, threads, args)
+            print('%-8s %3d threads  %9.0f messages/sec  %8d traversals  '
+                  'finish lock wait mean/p99 %.1f/%.1f us' %
+                  (name, threads, rate, len(waits),
+                   sum(waits) / max(1, len(waits)) * 1e6,
+                   _percentile(waits, 99) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Measure what the resources' logging costs in memory and CPU.
+
+memory  creates and drops the logs of --resources routers, as
+        ResourceLogAdapters over the shared logger and as the named
+        loggers each driver used to get, and reports how much memory
+        each router leaves behind and how many loggers stay registered
+cpu     runs CalcAction.execute() over a queue of collapsible events
+        with debug logging off, as it is now and as it was before its
+        debug lines were guarded, and reports the time per call
+
+Usage: python tools/benchmarks/resource_logging.py [--resources 100000]
+           [--calls 100000]
+"""
+
+import argparse
+import collections
+import gc
+import logging
+import sys
+import time
+import uuid
+
+from akanda.rug.common import resource_log
+from akanda.rug.event import CREATE, POLL, UPDATE
+from akanda.rug import state
+
+
+def _sizes():
+    """Returns the ids and sizes of the objects the collector tracks,
+    and of the names of the registered loggers, which it does not.
+    """
+    sizes = dict((id(o), sys.getsizeof(o)) for o in gc.get_objects())
+    for name in logging.Logger.manager.loggerDict:
+        sizes[id(name)] = sys.getsizeof(name)
+    return sizes
+
+
+def _adapters(resource_ids):
+    return [resource_log.ResourceLogAdapter('ak-router-%s' % i)
+            for i in resource_ids]
+
+
+def _named_loggers(resource_ids):
+    return [logging.getLogger('ak-router-%s' % i) for i in resource_ids]
+
+
+def _memory(args):
+    for name, make_logs in [('adapters', _adapters),
+                            ('named', _named_loggers)]:
+        resource_ids = [str(uuid.uuid4()) for i in range(args.resources)]
+        gc.collect()
+        before = _sizes()
+        logs = make_logs(resource_ids)
+        del logs
+        gc.collect()
+        after = _sizes()
+        retained = sum(size for i, size in after.items() if i not in before)
+        print('%-8s %7d routers  %6d bytes/router left  '
+              '%7d loggers registered' %
+              (name, args.resources, retained / args.resources,
+               len(logging.Logger.manager.loggerDict)))
+
+
+def _legacy_execute(st, action, worker_context):
+    """CalcAction.execute() as it was before its debug lines were
+    guarded.
+    """
+    queue = st.queue
+    while queue:
+        st.params.driver.log.debug(
+            'action = %s, len(queue) = %s, queue = %s',
+            action,
+            len(queue),
+            list(queue)
+        )
+        if action == UPDATE and queue[0] == CREATE:
+            st.params.driver.log.debug('upgrading from update to create')
+            action = queue.popleft()
+            continue
+        elif action == CREATE and queue[0] == UPDATE:
+            st.params.driver.log.debug('merging create and update')
+            queue.popleft()
+            continue
+        elif queue[0] == POLL:
+            st.params.driver.log.debug('discarding poll event following '
+                                       'action %s',
+                                       action)
+            queue.popleft()
+            continue
+        st.params.driver.log.debug('popping action from queue')
+        action = queue.popleft()
+    return action
+
+
+class FakeDriver(object):
+    def __init__(self, log):
+        self.log = log
+        self.image_uuid = None
+
+
+def _cpu(args):
+    events = [UPDATE, CREATE, UPDATE, POLL, POLL]
+    for name, log in [('named', logging.getLogger('ak-router-bench')),
+                      ('adapter',
+                       resource_log.ResourceLogAdapter('ak-router-bench'))]:
+        getattr(log, 'logger', log).setLevel(logging.INFO)
+        params = state.StateParams(FakeDriver(log), None,
+                                   collections.deque(), None, 0)
+        st = params.state(state.CalcAction)
+        for impl, execute in [('before', _legacy_execute),
+                              ('now', state.CalcAction.execute)]:
+            start = time.time()
+            for i in range(args.calls):
+                params.queue.extend(events)
+                execute(st, POLL, None)
+            elapsed = time.time() - start
+            print('%-8s %-7s %7d calls  %6.2f us/call' %
+                  (name, impl, args.calls, elapsed / args.calls * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resources', type=int, default=100000)
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+    _memory(args)
+    _cpu(args)
+
+
+if __name__ == '__main__':
+    main()
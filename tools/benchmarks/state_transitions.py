@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# Copyright 2015 Akanda, Inc
+#
+# Author: Akanda, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Compare the table-driven state transitions with the if/elif chains
+they replaced.
+
+Every pass walks each state through every action and instance state,
+so both implementations do the same transitions. The old one builds a
+new State for each of them.
+
+Usage: python tools/benchmarks/state_transitions.py [--passes N]
+"""
+
+import argparse
+import itertools
+import time
+
+import mock
+
+from akanda.rug.drivers import states
+from akanda.rug.event import POLL, READ, DELETE, REBUILD
+from akanda.rug import state
+
+
+def _legacy_transition(st, action):
+    """The transition() methods as they were before the table."""
+    s = st.instance.state
+    p = st.params
+    cls = type(st)
+    if cls is state.CalcAction:
+        if s == states.GONE:
+            next_action = state.StopInstance(p)
+        elif action == DELETE:
+            next_action = state.StopInstance(p)
+        elif action == REBUILD:
+            next_action = state.RebuildInstance(p)
+        elif s == states.BOOTING:
+            next_action = state.CheckBoot(p)
+        elif s == states.DOWN:
+            next_action = state.CreateInstance(p)
+        else:
+            next_action = state.Alive(p)
+        if s == states.ERROR:
+            if action == POLL:
+                next_action = st
+            elif st.instance.error_cooldown:
+                next_action = st
+            else:
+                next_action = state.ClearError(p, next_action)
+        return next_action
+    if cls is state.PushUpdate or cls is state.ReadStats:
+        return state.CalcAction(p)
+    if cls is state.ClearError:
+        return st._next_state or state.CalcAction(p)
+    if cls is state.Alive:
+        if s == states.GONE:
+            return state.StopInstance(p)
+        elif s == states.DOWN:
+            return state.CreateInstance(p)
+        elif action == POLL and s == states.CONFIGURED:
+            return state.CalcAction(p)
+        elif action == READ and s == states.CONFIGURED:
+            return state.ReadStats(p)
+        return state.ConfigureInstance(p)
+    if cls is state.CreateInstance:
+        if s == states.GONE:
+            return state.StopInstance(p)
+        elif s == states.ERROR:
+            return state.CalcAction(p)
+        elif s == states.DOWN:
+            return state.CreateInstance(p)
+        return state.CheckBoot(p)
+    if cls is state.CheckBoot:
+        if s == states.REPLUG:
+            return state.ReplugInstance(p)
+        if s in (states.DOWN, states.GONE):
+            return state.StopInstance(p)
+        if s == states.UP:
+            return state.ConfigureInstance(p)
+        return state.CalcAction(p)
+    if cls is state.ReplugInstance:
+        if s == states.RESTART:
+            return state.StopInstance(p)
+        return state.ConfigureInstance(p)
+    if cls is state.StopInstance:
+        if s not in (states.DOWN, states.GONE):
+            return st
+        if s == states.GONE:
+            return state.Exit(p)
+        if action == DELETE:
+            return state.Exit(p)
+        return state.CreateInstance(p)
+    if cls is state.RebuildInstance:
+        if s not in (states.DOWN, states.GONE):
+            return st
+        if s == states.GONE:
+            return state.Exit(p)
+        return state.CreateInstance(p)
+    if cls is state.ConfigureInstance:
+        if s == states.REPLUG:
+            return state.ReplugInstance(p)
+        if s in (states.RESTART, states.DOWN, states.GONE):
+            return state.StopInstance(p)
+        if s == states.UP:
+            return state.PushUpdate(p)
+        if action == READ:
+            return state.ReadStats(p)
+        return state.CalcAction(p)
+    return st
+
+
+class _Instance(object):
+    state = states.UP
+    error_cooldown = False
+
+
+def _params():
+    driver = mock.Mock()
+    return state.StateParams(driver, _Instance(), state.Inbox(),
+                             mock.Mock(), 3)
+
+
+def _cases(params):
+    state_classes = sorted(set(rule[0] for rule in state.RULES),
+                           key=lambda cls: cls.__name__)
+    return [
+        (params.state(cls), action, instance_state)
+        for cls, action, instance_state in itertools.product(
+            state_classes, state.ACTIONS, state.INSTANCE_STATES)
+    ]
+
+
+def _check(params, cases):
+    for st, action, instance_state in cases:
+        params.instance.state = instance_state
+        new = st.transition(action, None)
+        old = _legacy_transition(st, action)
+        assert type(new) is type(old), (st, action, instance_state)
+        assert (type(getattr(new, '_next_state', None)) is
+                type(getattr(old, '_next_state', None)))
+
+
+def _run(params, cases, passes, transition):
+    instance = params.instance
+    start = time.time()
+    for i in range(passes):
+        for st, action, instance_state in cases:
+            instance.state = instance_state
+            transition(st, action)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--passes', type=int, default=2000)
+    args = parser.parse_args()
+
+    params = _params()
+    cases = _cases(params)
+    _check(params, cases)
+    count = len(cases) * args.passes
+    for label, transition in [
+            ('if/elif, new State per transition', _legacy_transition),
+            ('transition table, flyweight States',
+             lambda st, action: st.transition(action, None))]:
+        elapsed = _run(params, cases, args.passes, transition)
+        print('%-40s %10.0f transitions/sec' % (label, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()